@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+==================================
+python-mwdump-tools - benchmark
+==================================
+
+Compares the throughput of the page parsing engines of XmlStreamParser on a
+dump file. The handler only reads the fields that handlers typically use
+(ns, title and text, of every revision with the revisions engine), so the
+numbers are dominated by the parsing itself.
+
+With --images, imagedownloader is run on the dump against a local httpstub
+server, once per download engine, so nothing goes over the network.
+
+Every run happens in a fresh process, which reports its peak RSS and the
+largest peak RSS of its child processes (e.g. scaling processes), and the
+time spent in each stage. Use mwdumptools.syntheticdump to generate dumps of
+any size. With --results, every measurement is appended to a JSON lines file
+with the current commit, and compared with the previous measurement of the
+same benchmark on the same file, so regressions show up between commits.
+
+Example:
+  python3 -m mwdumptools.benchmark mwdumptools/tests/data/ngwiki-20130702-pages-articles-multistream.xml
+  python3 -m mwdumptools.syntheticdump --pages=20000 /tmp/synthetic.xml
+  python3 -m mwdumptools.benchmark --images --results=benchmarks.jsonl /tmp/synthetic.xml
+
+Usage:
+  benchmark [--repeat=N] [--engine=ENGINE]... [--images]
+            [--downloader=ENGINE]... [--results=FILE] FILE
+  benchmark (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --repeat=N         Run each engine N times and report the fastest run
+                     [default: 3]
+  --engine=ENGINE    Only run the given engine(s), "lines", "pull" or
+                     "revisions"
+  --images           Also benchmark imagedownloader against a local HTTP
+                     stub, with --revisiontext and --scale
+  --downloader=ENGINE  Only run the given imagedownloader download engine(s)
+  --results=FILE     Append the results to FILE and compare them with the
+                     previous results found there
+"""
+import concurrent.futures
+import io
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+from . import rawpages
+from . import settings
+from . import streamparser
+
+# Slower than the previous result by more than this is reported
+REGRESSION_THRESHOLD = 0.1
+
+BENCHMARK_PARSE = "parse"
+BENCHMARK_IMAGES = "images"
+
+IMAGE_ENGINES = ("threads", "async")
+
+
+class BenchmarkParser(streamparser.XmlStreamParser):
+
+    def __init__(self, *args, **kwargs):
+        streamparser.XmlStreamParser.__init__(self, *args, **kwargs)
+        self.handle_seconds = 0.0
+
+    def handle_page(self, page):
+        started = time.perf_counter()
+        page.ns
+        page.title
+        page.text
+        self.handle_seconds += time.perf_counter() - started
+
+    def handle_page_start(self, page):
+        started = time.perf_counter()
+        page.ns
+        page.title
+        self.handle_seconds += time.perf_counter() - started
+
+    def handle_revision(self, page, revision):
+        started = time.perf_counter()
+        revision.text
+        self.handle_seconds += time.perf_counter() - started
+
+    def handle_page_end(self, page):
+        pass
+
+
+def peak_rss():
+    """Peak resident set size in kB of this process, and of the largest of
+    its child processes that have been waited for"""
+    return {
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_children_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def measure_engine(dump_file, engine):
+    """Parse dump_file once, returns a result dict. Stages are the time
+    spent in handle_page and the time of everything else."""
+    with BenchmarkParser(in_file=dump_file, engine=engine) as parser:
+        started = time.perf_counter()
+        parser.execute()
+        seconds = time.perf_counter() - started
+    return {
+        "seconds": seconds,
+        "pages": parser.pages_processed,
+        **peak_rss(),
+        "stages": {
+            "parse": seconds - parser.handle_seconds,
+            "handle": parser.handle_seconds,
+        },
+    }
+
+
+def measure_split(dump_file):
+    """Time of only splitting dump_file into raw pages, the lower bound of
+    what parsing can cost"""
+    started = time.perf_counter()
+    pages = 0
+    with open(dump_file, "rb") as f:
+        for __ in rawpages.iter_pages(f):
+            pages += 1
+    return {
+        "seconds": time.perf_counter() - started,
+        "pages": pages,
+        **peak_rss(),
+        "stages": {},
+    }
+
+
+def measure_images(dump_file, download_engine):
+    """Run imagedownloader on dump_file against a local stub server,
+    returns a result dict with the time to parse (and queue downloads), to
+    drain the outstanding downloads and to write the image table"""
+    # Imported here, imagedownloader and httpstub need Pillow
+    from . import httpstub
+    from . import imagedownloader
+
+    server = httpstub.serve()
+    output = tempfile.mkdtemp(prefix="mwdump-benchmark-")
+    try:
+        parser = imagedownloader.ImageDownloader(
+            in_file=dump_file,
+            output=output,
+            namespaces=["0"],
+            revisiontext=True,
+            scale=True,
+            downloader=download_engine,
+            dlurls=["http://127.0.0.1:{:d}/{{h1:s}}/{{h2:s}}/{{fname:s}}".format(
+                server.server_address[1])],
+        )
+        parser.output_stream = io.StringIO()
+        started = time.perf_counter()
+        streamparser.XmlStreamParser.execute(parser)
+        parsed = time.perf_counter()
+        parser.shutdown()
+        drained = time.perf_counter()
+        parser.write_table()
+        parser.manifest.close()
+        finished = time.perf_counter()
+        return {
+            "seconds": finished - started,
+            "pages": parser.pages_processed,
+            "files": server.requests,
+            **peak_rss(),
+            "stages": {
+                "parse": parsed - started,
+                "drain": drained - parsed,
+                "table": finished - drained,
+            },
+        }
+    finally:
+        server.shutdown()
+        shutil.rmtree(output, ignore_errors=True)
+
+
+def quiet():
+    # Progress messages would be part of the measurement
+    settings.logger.setLevel(logging.WARNING)
+
+
+def in_process(fn, *args):
+    """Call fn in a fresh process, so its peak RSS is its own"""
+    # Spawned rather than forked, so nothing is inherited from this process
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=context, initializer=quiet) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def benchmark_engines(dump_file, engines=streamparser.ENGINES, repeat=3):
+    """Yields (engine, result) with the fastest of repeat runs, the engine
+    "split" being the raw page splitting alone"""
+    for engine in ("split",) + tuple(engines):
+        if engine == "split":
+            runs = [in_process(measure_split, dump_file) for __ in range(repeat)]
+        else:
+            runs = [in_process(measure_engine, dump_file, engine) for __ in range(repeat)]
+        yield engine, min(runs, key=lambda result: result["seconds"])
+
+
+def get_commit():
+    """Short hash of the checked out commit, None outside of git"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(ln) for ln in f if ln.strip()]
+
+
+def find_previous(results, record):
+    """The last result of the same benchmark, engine and dump"""
+    for previous in reversed(results):
+        if all(previous.get(key) == record[key]
+               for key in ("benchmark", "engine", "file", "file_size")):
+            return previous
+    return None
+
+
+def format_result(record, previous=None):
+    line = ("{:6s} {:9s} {:8d} pages {:8.3f} s {:10.1f} pages/s {:8.2f} MB/s "
+            "{:8.1f} MB RSS {:8.1f} MB children").format(
+        record["benchmark"], record["engine"], record["pages"], record["seconds"],
+        record["pages_per_second"], record["mb_per_second"],
+        record["peak_rss_kb"] / 1024.0, record["peak_children_rss_kb"] / 1024.0)
+    if record["stages"]:
+        line += "  " + " ".join(
+            "{}={:.3f}s".format(stage, seconds)
+            for stage, seconds in record["stages"].items())
+    if previous is not None:
+        change = record["pages_per_second"] / previous["pages_per_second"] - 1
+        line += "  {:+.1%} vs {}".format(change, previous.get("commit") or "previous")
+        if change < -REGRESSION_THRESHOLD:
+            line += "  REGRESSION"
+    return line
+
+
+def make_record(benchmark, engine, dump_file, result):
+    file_size = os.path.getsize(dump_file)
+    record = {
+        "benchmark": benchmark,
+        "engine": engine,
+        "file": os.path.basename(dump_file),
+        "file_size": file_size,
+        "commit": get_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pages_per_second": result["pages"] / result["seconds"],
+        "mb_per_second": file_size / 1024.0 / 1024.0 / result["seconds"],
+    }
+    record.update(result)
+    return record
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    quiet()
+    dump_file = arguments["FILE"]
+    results_file = arguments["--results"]
+    previous_results = read_results(results_file) if results_file else []
+    records = []
+    engines = arguments["--engine"] or streamparser.ENGINES
+    for engine in engines:
+        if engine not in streamparser.ENGINES:
+            sys.exit("Unknown engine {!r}, engines are: {}".format(
+                engine, ", ".join(streamparser.ENGINES)))
+    for engine, result in benchmark_engines(dump_file, engines, int(arguments["--repeat"])):
+        records.append(make_record(BENCHMARK_PARSE, engine, dump_file, result))
+    if arguments["--images"]:
+        for engine in arguments["--downloader"] or IMAGE_ENGINES:
+            result = in_process(measure_images, dump_file, engine)
+            records.append(make_record(BENCHMARK_IMAGES, engine, dump_file, result))
+    for record in records:
+        print(format_result(record, find_previous(previous_results, record)))
+    if results_file:
+        with open(results_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
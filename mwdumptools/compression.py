@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed dump files. Output formats are chosen by the file name extension,
+input formats are recognized by their magic bytes, so compressed dumps can
+also be piped in.
+
+zstd needs the zstandard package.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import parallelbz2
+
+# Extension -> function opening a file like open()
+OPENERS = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+FORMAT_BZ2 = "bz2"
+FORMAT_GZIP = "gzip"
+FORMAT_XZ = "xz"
+FORMAT_ZSTD = "zstd"
+
+# Magic bytes -> format
+MAGIC_BYTES = {
+    b"BZh": FORMAT_BZ2,
+    b"\x1f\x8b": FORMAT_GZIP,
+    b"\xfd7zXZ\x00": FORMAT_XZ,
+    b"\x28\xb5\x2f\xfd": FORMAT_ZSTD,
+}
+MAGIC_LENGTH = max(map(len, MAGIC_BYTES))
+
+
+def get_opener(path):
+    for extension, opener in OPENERS.items():
+        if path.endswith(extension):
+            return opener
+    return open
+
+
+def open_output(path):
+    """Binary stream writing to path, compressed if path ends with the
+    extension of a compressed format"""
+    return get_opener(path)(path, "wb")
+
+
+def peek(stream, size):
+    """The first size bytes of stream without consuming them, or None if
+    the stream can neither peek nor seek"""
+    if hasattr(stream, "peek"):
+        return stream.peek(size)[:size]
+    if stream.seekable():
+        position = stream.tell()
+        data = stream.read(size)
+        stream.seek(position)
+        return data
+    return None
+
+
+def detect_format(stream):
+    """The compression format of a binary stream, None if uncompressed"""
+    data = peek(stream, MAGIC_LENGTH)
+    if not data:
+        return None
+    for magic, compression in MAGIC_BYTES.items():
+        if data.startswith(magic):
+            return compression
+    return None
+
+
+def open_input(stream, processes=None):
+    """Binary stream of the decompressed data of stream, or stream itself if
+    it is not compressed. bz2 is decompressed by processes processes (all
+    cores by default), in this process if that is 1."""
+    compression = detect_format(stream)
+    if compression == FORMAT_BZ2:
+        if (processes or os.cpu_count() or 1) == 1:
+            return bz2.BZ2File(stream)
+        return parallelbz2.open_parallel(stream, processes)
+    if compression == FORMAT_GZIP:
+        return gzip.GzipFile(fileobj=stream)
+    if compression == FORMAT_XZ:
+        return lzma.LZMAFile(stream)
+    if compression == FORMAT_ZSTD:
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed dumps needs the zstandard package")
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True))
+    return stream
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio download engine for imagedownloader.
+
+One event loop, running in a background thread, keeps all downloads of the
+process in flight. Connections are kept alive and reused per host, a
+semaphore per host limits the number of connections to it, and bodies are
+streamed to disk in chunks. Only the stdlib is used, so this is a small
+HTTP/1.1 client that understands what a file server sends: Content-Length
+or chunked bodies and redirects.
+
+submit() returns a concurrent.futures.Future, just like the thread pool of
+ImagePoolWorker, so results are picked up with add_done_callback(). Its
+callbacks run in a completion thread of their own, never in the event loop,
+so whatever they do (writing the manifest, reading files, submitting scale
+jobs) doesn't hold up the downloads in flight. Like urlopen() of the threads
+engine, the timeout applies to connecting and to every read, not to the whole
+transfer, so large files that keep arriving are never cut off. Bodies
+are either streamed to a file or, for images that are scaled before they are
+saved, returned as bytes, in a Response with the SHA-1 of the body and the
+validators of the server. Given those, a download is a conditional request
+and a body that hasn't changed fails with status NOT_MODIFIED.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import queue
+import random
+import ssl
+import threading
+import urllib.parse
+
+from . import VERSION
+from . import metrics
+from . import settings
+
+# Connections kept open to a single host at most
+DEFAULT_CONNECTIONS_PER_HOST = 16
+
+# Downloads in progress at once, others wait for a slot
+DEFAULT_MAX_IN_FLIGHT = 1000
+
+DEFAULT_TIMEOUT = 10  # seconds to connect, or waiting for data
+
+# Attempts after the first one, waiting BACKOFF * 2 ** attempt seconds plus
+# some jitter in between
+DEFAULT_RETRIES = 2
+BACKOFF = 0.5
+
+MAX_REDIRECTS = 5
+
+CHUNK_SIZE = 64 * 1024
+
+USER_AGENT = "python-mwdump-tools/{}".format(VERSION)
+
+# Status of a conditional request for a body that hasn't changed
+NOT_MODIFIED = 304
+
+# content is the body or the path it has been saved to, sha1 the hex SHA-1
+# of the body, etag and last_modified the validators sent by the server
+Response = collections.namedtuple("Response", "content sha1 etag last_modified")
+
+
+class DownloadError(Exception):
+
+    def __init__(self, url, message, status=None):
+        Exception.__init__(self, "{}: {}".format(url, message))
+        self.url = url
+        self.status = status
+
+
+def quote_path(path):
+    """File names go into URLs as they are, so quote spaces etc. but keep
+    what has been quoted already"""
+    return urllib.parse.quote(path, safe="/%:@!$&'()*+,;=~")
+
+
+def quote_url(url):
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(parts._replace(path=quote_path(parts.path)))
+
+
+def conditional_headers(etag=None, last_modified=None):
+    """Request headers to download a body only if it has changed since the
+    Response with etag and last_modified"""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def is_not_modified(exc):
+    """True for the error of a conditional request, by either engine, for
+    a body that hasn't changed"""
+    return getattr(exc, "status", None) == NOT_MODIFIED
+
+
+class HashingWriter:
+
+    """Writes to a file and computes the SHA-1 of what has been written"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        return self.f.write(data)
+
+
+def is_transient(exc):
+    """Network errors, timeouts and 5xx responses are worth retrying"""
+    if isinstance(exc, DownloadError):
+        return exc.status is None or exc.status >= 500
+    return isinstance(exc, (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError))
+
+
+class ConnectionPool:
+
+    """Idle keep-alive connections to one host"""
+
+    def __init__(self, scheme, host, port, limit, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context if scheme == "https" else None
+        self.semaphore = asyncio.Semaphore(limit)
+        self.idle = []
+
+    async def connect(self, timeout):
+        """Returns (reader, writer, reused)"""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                metrics.incr("connections_reused")
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context), timeout)
+        metrics.incr("connections_opened")
+        return reader, writer, False
+
+    def release(self, reader, writer, reusable):
+        if reusable:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for __, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class AsyncDownloader:
+
+    def __init__(self, connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES):
+        self.connections_per_host = int(connections_per_host)
+        self.timeout = float(timeout)
+        self.retries = int(retries)
+        self.ssl_context = ssl.create_default_context()
+        self.pools = {}
+        self.loop = asyncio.new_event_loop()
+        self.in_flight = None
+        self.active = 0  # Downloads holding an in_flight slot
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # (loop future, future returned by submit) of finished downloads
+        self.completed = queue.Queue()
+        self.completion_thread = threading.Thread(target=self.run_completions, daemon=True)
+        self.completion_thread.start()
+        self.call(self._setup(int(max_in_flight))).result()
+
+    async def _setup(self, max_in_flight):
+        # Created inside the loop that will use it
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, url, local_path=None, headers=None):
+        """Download url to local_path, the future's result is a Response
+        with local_path as content. Without local_path, the content is the
+        body. headers are added to the request, see conditional_headers()."""
+        future = concurrent.futures.Future()
+        # The loop only queues the result, the completion thread sets it
+        # and runs the callbacks
+        self.call(self.download(url, local_path, headers)).add_done_callback(
+            lambda done: self.completed.put((done, future)))
+        return future
+
+    def run_completions(self):
+        while True:
+            item = self.completed.get()
+            if item is None:
+                return
+            done, future = item
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+    def shutdown(self):
+        self.call(self._close_pools()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        # After the futures of the cancelled downloads
+        self.completed.put(None)
+        self.completion_thread.join()
+
+    async def _close_pools(self):
+        # Downloads still in flight are cancelled, their futures too
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for pool in self.pools.values():
+            pool.close()
+
+    def get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(
+                scheme, host, port, self.connections_per_host, self.ssl_context)
+        return self.pools[key]
+
+    async def download(self, url, local_path=None, headers=None):
+        async with self.in_flight:
+            self.active += 1
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        return await self.fetch(url, local_path, headers)
+                    except Exception as exc:
+                        if attempt >= self.retries or not is_transient(exc):
+                            raise
+                        delay = BACKOFF * 2 ** attempt * (1 + random.random())
+                        settings.logger.debug("Retrying %s in %.1fs: %r", url, delay, exc)
+                        metrics.incr("download_retries")
+                        attempt += 1
+                        await asyncio.sleep(delay)
+            finally:
+                self.active -= 1
+
+    async def fetch(self, url, local_path=None, headers=None, redirects=MAX_REDIRECTS):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        pool = self.get_pool(parts.scheme, parts.hostname, port)
+        path = quote_path(parts.path or "/")
+        if parts.query:
+            path += "?" + parts.query
+        request = (
+            "GET {} HTTP/1.1\r\n"
+            "Host: {}\r\n"
+            "User-Agent: {}\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: keep-alive\r\n".format(path, parts.netloc, USER_AGENT)
+        )
+        for name, value in (headers or {}).items():
+            request += "{}: {}\r\n".format(name, value)
+        request = (request + "\r\n").encode("latin-1")
+
+        async with pool.semaphore:
+            location, result = await self.get(pool, url, request, local_path)
+        if location is None:
+            return result
+        if redirects <= 0:
+            raise DownloadError(url, "Too many redirects")
+        return await self.fetch(
+            urllib.parse.urljoin(url, location), local_path, headers, redirects - 1)
+
+    async def get(self, pool, url, request, local_path):
+        """Send request over a connection of pool, returns (location, None)
+        for a redirect and (None, Response) when the body has been saved to
+        local_path or read into memory"""
+        timeout = self.timeout
+        reader, writer, reused = await pool.connect(timeout)
+        reusable = False
+        try:
+            try:
+                writer.write(request)
+                status, headers = await read_head(reader, timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server closed the idle connection, try a new one
+                writer.close()
+                reader, writer, reused = await pool.connect(timeout)
+                writer.write(request)
+                status, headers = await read_head(reader, timeout)
+
+            location = headers.get("location")
+            if status in (301, 302, 303, 307, 308) and location:
+                reusable = await read_body(reader, headers, None, timeout)
+                return location, None
+            if status == NOT_MODIFIED:
+                # Never has a body
+                reusable = headers.get("connection", "").lower() != "close"
+                raise DownloadError(url, "Not modified", status)
+            if status != 200:
+                reusable = await read_body(reader, headers, None, timeout)
+                raise DownloadError(url, "HTTP {}".format(status), status)
+            etag, last_modified = headers.get("etag"), headers.get("last-modified")
+            if local_path is None:
+                body = io.BytesIO()
+                reusable = await read_body(reader, headers, body, timeout)
+                body = body.getvalue()
+                return None, Response(
+                    body, hashlib.sha1(body).hexdigest(), etag, last_modified)
+            os.makedirs(os.path.dirname(local_path), mode=0o755, exist_ok=True)
+            # Write to a temporary name, so an interrupted download never
+            # looks like a finished file
+            part_path = local_path + ".part"
+            with open(part_path, "wb") as f:
+                hashed = HashingWriter(f)
+                reusable = await read_body(reader, headers, hashed, timeout)
+            os.replace(part_path, local_path)
+            return None, Response(
+                local_path, hashed.sha1.hexdigest(), etag, last_modified)
+        finally:
+            pool.release(reader, writer, reusable)
+
+
+async def read_line(reader, timeout):
+    return await asyncio.wait_for(reader.readuntil(b"\r\n"), timeout)
+
+
+async def read_head(reader, timeout):
+    """Returns (status, headers) with lower case header names, waiting at
+    most timeout seconds for each line"""
+    status_line = await read_line(reader, timeout)
+    try:
+        status = int(status_line.split(None, 2)[1])
+    except (IndexError, ValueError):
+        raise DownloadError("", "Bad status line: {!r}".format(status_line))
+    headers = {}
+    while True:
+        ln = await read_line(reader, timeout)
+        if ln == b"\r\n":
+            return status, headers
+        name, __, value = ln.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def read_body(reader, headers, f, timeout):
+    """Stream the body to f (or discard it if f is None), waiting at most
+    timeout seconds for each read. Returns whether the connection can be
+    used for another request."""
+    reusable = headers.get("connection", "").lower() != "close"
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size = int((await read_line(reader, timeout)).split(b";")[0], 16)
+            if size == 0:
+                # Trailer headers end with an empty line
+                while await read_line(reader, timeout) != b"\r\n":
+                    pass
+                return reusable
+            await copy(reader, size, f, timeout)
+            await asyncio.wait_for(reader.readexactly(2), timeout)
+    elif "content-length" in headers:
+        await copy(reader, int(headers["content-length"]), f, timeout)
+        return reusable
+    # Body ends when the server closes the connection
+    while True:
+        data = await asyncio.wait_for(reader.read(CHUNK_SIZE), timeout)
+        if not data:
+            return False
+        metrics.incr("bytes_downloaded", len(data))
+        if f is not None:
+            f.write(data)
+
+
+async def copy(reader, size, f, timeout):
+    while size > 0:
+        # Whatever has arrived, so the timeout is between reads like for a
+        # socket, however slowly the body comes in
+        data = await asyncio.wait_for(reader.read(min(size, CHUNK_SIZE)), timeout)
+        if not data:
+            raise asyncio.IncompleteReadError(b"", size)
+        size -= len(data)
+        metrics.incr("bytes_downloaded", len(data))
+        if f is not None:
+            f.write(data)
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+
+class ParseError(Exception):
+    pass
+
+
+class ShardError(Exception):
+    pass
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================
+python-mwdump-tools - httpstub
+=====================================
+
+A local stand-in for upload.wikimedia.org, to try out and benchmark
+imagedownloader without the network. Every GET for a path ending in a file
+name with an image extension is answered with a small generated image of that
+format, over keep-alive HTTP/1.1 connections. Other paths give 404.
+Images are served with an ETag and Last-Modified, conditional requests for
+them are answered with 304 Not Modified.
+
+With --dump, only the file names referenced in the dump (File: titles and
+[[File:...]] links in the texts) are served.
+
+Example:
+  python3 -m mwdumptools.httpstub --port=8080 --dump=mwdumptools/tests/data/ngwiki-20130702-pages-articles-multistream.xml
+  imagedownloader --dlurls="http://localhost:8080/{h1:s}/{h2:s}/{fname:s}" ...
+
+Usage:
+  httpstub [--port=N] [--delay=SECONDS] [--dump=FILE]
+  httpstub (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --port=N           Port to listen on [default: 8080]
+  --delay=SECONDS    Wait before answering, to simulate a slow network
+                     [default: 0]
+  --dump=FILE        Only serve the file names found in this dump
+"""
+import email.utils
+import hashlib
+import http.server
+import io
+import os
+import threading
+import time
+import urllib.parse
+
+from PIL import Image
+from docopt import docopt
+
+from . import rawpages
+from .page import Page
+
+# Formats by (lower case) extension
+FORMATS = {
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "gif": "GIF",
+    "bmp": "BMP",
+    "tiff": "TIFF",
+}
+
+IMAGE_SIZE = (1600, 1200)
+
+
+def make_image(extension, size=IMAGE_SIZE):
+    image = Image.new("RGB", size, (40, 120, 200))
+    output = io.BytesIO()
+    image.save(output, format=FORMATS[extension])
+    return output.getvalue()
+
+
+def get_dump_filenames(dump_file):
+    """File names of File: pages and [[File:...]] links in a dump"""
+    # Imported here, imagedownloader is a script with its own dependencies
+    from .imagedownloader import ARTICLE_FILE_PATTERN
+    names = set()
+    with open(dump_file, "rb") as f:
+        for __, __, raw in rawpages.iter_pages(f):
+            page = Page.from_bytes(raw)
+            if page.title and page.title.startswith("File:"):
+                names.add(page.title[len("File:"):])
+            for match in ARTICLE_FILE_PATTERN.findall(page.text or ""):
+                names.add(match[1])
+    return names
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    # Keep-alive, like the real thing
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+        fname = urllib.parse.unquote(self.path.split("?")[0].rsplit("/", 1)[-1])
+        extension = os.path.splitext(fname)[1][1:].lower()
+        if extension not in FORMATS or (
+                server.names is not None and fname not in server.names):
+            body = b"Not found"
+            self.send_response(404)
+        else:
+            body = server.get_image(extension)
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                server.requests += 1
+                server.not_modified += 1
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", server.last_modified)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, delay=0, names=None):
+        http.server.ThreadingHTTPServer.__init__(self, address, StubHandler)
+        self.delay = delay
+        self.names = names
+        self.requests = 0
+        self.not_modified = 0  # Requests answered with 304
+        self.last_modified = email.utils.formatdate(usegmt=True)
+        self.images = {}
+        self.images_lock = threading.Lock()
+
+    def get_image(self, extension):
+        with self.images_lock:
+            if extension not in self.images:
+                self.images[extension] = make_image(extension)
+            return self.images[extension]
+
+
+def serve(port=0, delay=0, names=None):
+    """Start a stub server in a background thread. Use port 0 to pick a free
+    port and read it from server.server_address."""
+    server = StubServer(("127.0.0.1", port), delay=delay, names=names)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    names = get_dump_filenames(arguments["--dump"]) if arguments["--dump"] else None
+    server = StubServer(
+        ("127.0.0.1", int(arguments["--port"])),
+        delay=float(arguments["--delay"]),
+        names=names,
+    )
+    server.serve_forever()
@@ -10,22 +10,70 @@ File:XXX articles. Reads from STDIN.
 Example:
   imagedownloader --output=images/ --scale < tests/data/ngwiki-20130702-pages-articles-multistream.xml
 
-Uses concurrency to download and scale images.
+Uses concurrency to download and scale images. Downloads run in threads (or an
+asyncio loop) and scaling in a process pool, each sized on its own. With
+the --scale option, downloaded bytes are handed to the scaler in memory,
+decoded once and written to disk in every one of --sizes.
 
 The final output is the SQL to reconstruct the Mediawiki image table. You
 should do this because the script is not guaranteed to successfully download
-all images.
+all images. It is written from a manifest in the output directory, which
+records every file that has been handled, so each file is downloaded and
+listed once, also across restarts. Instead of INSERT statements, the table
+can be written as TSV for LOAD DATA INFILE / COPY or to an SQLite database.
+
+Monthly dumps are processed incrementally with --page-state and --refresh:
+pages with the same revision as in the last run are skipped before they are
+parsed, unless one of their files failed, and the files of the other pages
+are downloaded with conditional requests, so files that haven't changed are
+neither transferred nor scaled again.
+
+With --coordinator, the dump is read from the shards planned in the
+coordinator file (see mwdumptools.shards), on as many machines as there are
+workers sharing the output directory. Every shard has a manifest of its own,
+which are merged into --manifest before the table is written.
 
 
 Usage:
   imagedownloader [--dlurls=URL]...
                   [--output=PATH]
                   [--scale]
-                  [--parse-articles]
+                  [--sizes=SIZES]
+                  [--keep-original]
+                  [--max-pixels=N]
+                  [--revisiontext]
                   [--ext=EXT]...
                   [--resume=N]
                   [--namespaces=NS]...
-                  [--treads=N]
+                  [--threads=N]
+                  [--scale-processes=N]
+                  [--in-file=FILE]
+                  [--index=FILE]
+                  [--decompress-processes=N]
+                  [--page-index=FILE]
+                  [--titles=FILE]
+                  [--parse-processes=N]
+                  [--checkpoint=FILE]
+                  [--checkpoint-interval=N]
+                  [--engine=ENGINE]
+                  [--pipeline]
+                  [--batch-size=N]
+                  [--unordered]
+                  [--downloader=ENGINE]
+                  [--connections-per-host=N]
+                  [--max-jobs=N]
+                  [--low-jobs=N]
+                  [--manifest=FILE]
+                  [--page-state=FILE]
+                  [--refresh]
+                  [--metrics=FILE]
+                  [--metrics-interval=SECONDS]
+                  [--table-format=FORMAT]
+                  [--table-file=FILE]
+                  [--insert-rows=N]
+                  [--coordinator=FILE]
+                  [--worker-id=ID]
+                  [--lease=SECONDS]
   imagedownloader (-h | --help)
   imagedownloader --version
 
@@ -37,6 +85,15 @@ Options:
                      "http://upload.wikimedia.org/wikipedia/commons/{h1:s}/{h2:s}/{fname:s}"
   --savepath=PATH    Where to save images
   --scale            Should images be scaled after downloading?
+  --sizes=SIZES      Comma separated thumbnail sizes made with --scale, as
+                     WIDTHxHEIGHT[:FORMAT], e.g. 1024x1024,320x320:webp. The
+                     first replaces the original in its format, the others
+                     are saved in thumb/. All are made from one decode.
+                     [default: 1024x1024]
+  --keep-original    Keep the original and save all thumbnails in thumb/.
+                     Sizes added later are made from the kept originals.
+  --max-pixels=N     Reject images with more pixels, before decoding them
+                     [default: 89478485]
   --revisiontext     Instead of parsing 'File:...' revision titles, it's possible
                      to parse texts of article revisions for patterns matching
                      [[File:...]] like patterns. This is slower but fetches
@@ -48,14 +105,88 @@ Options:
   --resume=N         Resume from line no (if the script has been interrupted)
   --namespaces=NS    The mediawiki dump namespace to read from
                      [default: 0, 10]
-  --threads=N        Number of concurrent threads that should download and scale
-                     images (most likely you should set this to the number of
-                     CPU cores but depending on how slow your internet connection
-                     is, you can set it higher).
+  --threads=N        Number of concurrent threads that download images. The
+                     slower your internet connection, the more you need.
                      [default: 8]
+  --scale-processes=N  Number of processes scaling images
+                     (defaults to the number of CPU cores)
+  --in-file=FILE     Read the dump from FILE instead of STDIN. bz2, gzip, xz
+                     and zstd compressed dumps are recognized, also on STDIN
+  --decompress-processes=N  Number of processes decompressing a bz2 dump
+                     (defaults to the number of CPU cores)
+  --page-index=FILE  Page index of the dump given by --in-file, built with
+                     mwdumptools.pageindex
+  --titles=FILE      Only read the pages with the titles listed in FILE, one
+                     per line with their namespace (e.g. File:Example.jpg),
+                     through --page-index instead of parsing the whole dump
+  --index=FILE       Parse a *-pages-articles-multistream.xml.bz2 dump given
+                     by --in-file in parallel, using the offsets of its
+                     *-multistream-index.txt.bz2 companion file
+  --parse-processes=N  Number of processes parsing multistream chunks or
+                     pipeline batches
+                     (defaults to the number of CPU cores)
+  --checkpoint=FILE  Periodically save the byte offset of the last completed
+                     page and unfinished downloads to FILE. If FILE exists,
+                     the job resumes from there by seeking in the dump.
+  --checkpoint-interval=N  Write the checkpoint every N pages [default: 1000]
+  --engine=ENGINE    How <page> nodes are parsed: "lines" collects the lines
+                     of each page and parses them at once, "pull" feeds the
+                     raw stream to an incremental parser, which is faster and
+                     does not depend on line breaks, "revisions" reads the
+                     revisions of a page one at a time, for full history
+                     dumps with pages too large for memory [default: lines]
+  --pipeline         Find the file names of pages in --parse-processes worker
+                     processes, which is worthwhile with --revisiontext
+  --batch-size=N     Pages sent to a worker process at a time [default: 100]
+  --unordered        Start downloads as soon as a batch is done, not in dump
+                     order
+  --downloader=ENGINE  "threads" downloads each image with a new connection
+                     in one of --threads threads, "async" keeps thousands of
+                     downloads in flight from one thread, reusing keep-alive
+                     connections [default: threads]
+  --connections-per-host=N  Connections the async downloader opens to a
+                     single host at most [default: 16]
+  --max-jobs=N       Files being downloaded or scaled at once. Reading the
+                     dump pauses when there are this many, until they are
+                     down to --low-jobs (defaults to 4 per thread, or 1000
+                     with --downloader=async)
+  --low-jobs=N       Resume reading the dump when this many files are left
+                     (defaults to half of --max-jobs)
+  --manifest=FILE    SQLite file recording the status, size, dimensions and
+                     URL of every file (defaults to manifest.sqlite in the
+                     output directory). Files that are done are skipped.
+  --page-state=FILE  SQLite file recording the revision of every page
+                     handled. Pages with the same revision as recorded are
+                     skipped, so the next dump only costs what changed.
+                     Pages are recorded once all their files are done.
+  --refresh          Download files that are done again, if they have
+                     changed: requests are conditional (If-None-Match,
+                     If-Modified-Since) and files with the same SHA-1 as
+                     before are not scaled again
+  --metrics=FILE     Write counters, gauges and timers to FILE, once every
+                     interval of --metrics-interval seconds, as JSON lines
+                     or, if FILE ends with .prom, as a Prometheus textfile
+  --metrics-interval=SECONDS  [default: 10]
+  --table-format=FORMAT  How the image table is written: "sql" INSERT
+                     statements, "tsv" for LOAD DATA INFILE or COPY, or
+                     "sqlite" [default: sql]
+  --table-file=FILE  Write the image table to FILE instead of STDOUT (for
+                     "sqlite", defaults to image.sqlite in the output
+                     directory)
+  --insert-rows=N    Rows per INSERT statement [default: 1000]
+  --coordinator=FILE  Download the files of the shards planned in FILE with
+                     mwdumptools.shards instead of --in-file, together with
+                     the workers on other machines. One of them writes the
+                     table of all shards.
+  --worker-id=ID     Name of this worker in the coordinator file (defaults to
+                     the host name and process id)
+  --lease=SECONDS    A shard is issued again if its worker hasn't renewed its
+                     lease for this long [default: 300]
 """
 import concurrent.futures
-from hashlib import md5
+import functools
+import hashlib
+import io
 import os
 import re
 import socket
@@ -70,8 +201,18 @@ from PIL import Image
 from docopt import docopt
 
 from . import VERSION
+from . import downloader
+from . import imagetable
+from . import manifest
+from . import metrics
+from . import pageindex
+from . import pagestate
+from . import rawpages
 from . import settings
+from . import shards
 from . import streamparser
+from . import thumbnails
+from .exceptions import ShardError
 
 
 ################################################################
@@ -90,22 +231,34 @@ OUTPUT_ROOT = os.path.abspath("./images")
 SCALE = True
 MAX_IMAGE_SIZE = (1024, 1024)
 
-# Should match your CPU count and bandwidth speed.
-# If threads are handling image scaling and you have many cores, you
-# can increase the number.
-# The higher your bandwidth, the less threads you want, because they
-# finish faster!!
+# Thumbnails other than the one replacing the original are saved in
+# thumb/h1/h2/fname/, like MediaWiki does
+THUMB_DIRECTORY = "thumb"
+
+# Threads downloading images. The higher your bandwidth, the less threads
+# you want, because they finish faster!! Scaling has its own process pool,
+# which is sized to the number of CPU cores.
 DEFAULT_MAX_THREADS = 8
 
+# Files being downloaded or scaled at once per thread, unless --max-jobs
+# is given. The async downloader defaults to its own in-flight limit.
+JOBS_PER_PROCESS = 4
+
 # Output SQL for mediawiki images insert to STDOUT
 OUTPUT_SQL = True
 
-SQL_VALUES = "('{name:s}', '{width:d}', '{height:d}', '{filesize:d}'),\n"
+# Database for --table-format=sqlite, in the output directory
+SQLITE_TABLE_FILENAME = "image.sqlite"
 
-DOWNLOAD_TIMEOUT = 10  # seconds
+DOWNLOAD_TIMEOUT = 10  # seconds to connect, or waiting for data
 
 DOWNLOAD_RETRIES = 2
 
+# Download engines, see --downloader
+DOWNLOAD_ENGINE_THREADS = "threads"
+DOWNLOAD_ENGINE_ASYNC = "async"
+DEFAULT_DOWNLOAD_ENGINE = DOWNLOAD_ENGINE_THREADS
+
 SKIP_EXISTING = True
 
 SEARCH_TITLES, SEARCH_ARTICLES = range(2)
@@ -113,46 +266,104 @@ SEARCH_TITLES, SEARCH_ARTICLES = range(2)
 ARTICLE_FILE_PATTERN = re.compile(r"\[\[\s*(File|Media|Image):(?P<fname>[^|\]]+)[^\]]*\]\]")
 REVISION_TITLE_PATTERN = re.compile(r"^File:")
 
-# Retrieve a single page and report the url and contents
-def load_url(url, local_path, timeout):
+# Retrieve a single page and return a downloader.Response with its contents,
+# or save them to local_path. A conditional request (headers) for contents
+# that haven't changed raises an HTTPError with status 304.
+def load_url(url, timeout, local_path=None, headers=None):
+    error = None
+    request = urllib.request.Request(downloader.quote_url(url), headers=headers or {})
     for __ in range(DOWNLOAD_RETRIES):
         try:
-            conn = urllib.request.urlopen(url, timeout=timeout)
-            data = conn.readall()
-            settings.logger.debug("Got image, length: {0:d}".format(len(data)))
-            os.makedirs(os.path.dirname(local_path), mode=0o755, exist_ok=True)
-            f = open(local_path, "wb")
-            f.write(data)
-            f.close()
-            return local_path
-        except urllib.error.URLError:
-            continue  # DNS error
-        except socket.gaierror:
-            continue  # Network error
+            conn = urllib.request.urlopen(request, timeout=timeout)
+            data = conn.read()
+            metrics.incr("bytes_downloaded", len(data))
+            settings.logger.debug("Got image, length: %d", len(data))
+            sha1 = hashlib.sha1(data).hexdigest()
+            etag, last_modified = conn.headers.get("ETag"), conn.headers.get("Last-Modified")
+            if local_path is None:
+                return downloader.Response(data, sha1, etag, last_modified)
+            thumbnails.save_file(data, local_path)
+            return downloader.Response(local_path, sha1, etag, last_modified)
         except urllib.error.HTTPError:
             raise
-
-
-# Scale image bytes and save to local_path
-def scale_image(fname, local_path, size, output_to=None):
-    if not output_to:
-        output_to = local_path
-    img = Image.open(local_path)
-    img.thumbnail(size, Image.ANTIALIAS)
-    img.save(output_to, format=local_path.split(".")[-1])
-    return img.size
-
-
-# Decorator to add blocking waits when the job pool is saturated
-def job(fn):
-    def decorated(self, *args, **kwargs):
-        # Don't let the main thread add millions of jobs... just block it
-        while self.jobs_running > self.processes:
-            time.sleep(1)
-        self.jobs_running += 1
-        fn(self, *args, **kwargs)
-        self.jobs_running -= 1
-    return decorated
+        except urllib.error.URLError as e:
+            error = e
+            metrics.incr("download_retries")
+            continue  # DNS error
+        except socket.gaierror as e:
+            error = e
+            metrics.incr("download_retries")
+            continue  # Network error
+    raise error
+
+
+# Scale downloaded image bytes to thumbnails, a list of (path, size, format),
+# runs in the scale process pool. With keep_original, the bytes are saved to
+# local_path as they are, unless they were read from there (from_local_path),
+# otherwise the first thumbnail is local_path. Returns the size of the image at
+# local_path and the seconds it took, metrics are only collected in the main
+# process.
+def scale_image(data, local_path, thumbs, keep_original=False,
+                max_pixels=thumbnails.MAX_PIXELS, from_local_path=False):
+    started = time.perf_counter()
+    original_size, sizes = thumbnails.make_thumbnails(data, thumbs, max_pixels)
+    if not keep_original:
+        return sizes[0], time.perf_counter() - started
+    # A download replaces the original, which may be an older version
+    if not from_local_path:
+        thumbnails.save_file(data, local_path)
+    return original_size, time.perf_counter() - started
+
+
+def get_image_size(local_path):
+    """Dimensions of an image file, only its header is read"""
+    try:
+        with Image.open(local_path) as img:
+            return img.size
+    except (OSError, ValueError):
+        return 0, 0
+
+
+class JobQueue:
+
+    """
+    Bounded number of jobs in flight, a job being everything that happens to
+    one file: download, scaling and output.
+
+    acquire() blocks the main thread once high jobs are running, until they
+    have finished down to low. Slots are freed by release() when a job has
+    completely finished, not when it has been submitted, and join() waits for
+    exactly the outstanding jobs.
+    """
+
+    def __init__(self, high, low=None):
+        self.high = int(high)
+        self.low = int(low) if low is not None else self.high // 2
+        if not 0 <= self.low < self.high:
+            raise ValueError("Expected 0 <= low < high watermark")
+        self.running = 0
+        self.blocked = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            if self.running >= self.high:
+                self.blocked = True
+            while self.blocked:
+                self.condition.wait()
+            self.running += 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            if self.running <= self.low:
+                self.blocked = False
+                self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until no jobs are running, returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.running == 0, timeout)
 
 
 # http://docs.python.org/dev/library/concurrent.futures#processpoolexecutor
@@ -170,93 +381,348 @@ def job(fn):
 class ImagePoolWorker:
 
     def __init__(self, processes, dlurls, output_dir,
-                 max_image_size, timeout, output_stream):
-        self.processes = processes
-        self.executor = concurrent.futures.ProcessPoolExecutor(
-            max_workers=processes)
-        self.jobs_running = 0
+                 max_image_size, timeout, output_stream,
+                 download_engine=DEFAULT_DOWNLOAD_ENGINE,
+                 connections_per_host=downloader.DEFAULT_CONNECTIONS_PER_HOST,
+                 max_jobs=None, low_jobs=None,
+                 scale=SCALE, scale_processes=None, manifest_file=None,
+                 table_format=imagetable.FORMAT_SQL, table_file=None,
+                 insert_rows=imagetable.DEFAULT_BATCH_SIZE,
+                 sizes=None, keep_original=False, max_pixels=thumbnails.MAX_PIXELS,
+                 refresh=False):
+        if table_format not in imagetable.WRITERS:
+            raise ValueError("Unknown table format: {}".format(table_format))
+        self.processes = int(processes)
+        self.scale = scale
+        self.scale_processes = int(scale_processes) if scale_processes else os.cpu_count()
+        # I/O stage: downloads mostly wait for the network, so threads do
+        self.download_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.processes)
+        # CPU stage: scaling needs the cores. Both pools only start their
+        # workers once something is submitted.
+        self.scale_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.scale_processes)
+        if max_jobs is None:
+            if download_engine == DOWNLOAD_ENGINE_ASYNC:
+                max_jobs = downloader.DEFAULT_MAX_IN_FLIGHT
+            else:
+                max_jobs = self.processes * JOBS_PER_PROCESS
+        self.jobs = JobQueue(max_jobs, low_jobs)
         self.dlurls = dlurls
         self.output_dir = output_dir
         self.max_image_size = max_image_size
+        # ((width, height), format or None) of the thumbnails of each image
+        if isinstance(sizes, str):
+            sizes = thumbnails.parse_sizes(sizes)
+        self.sizes = sizes or [(tuple(max_image_size), None)]
+        self.keep_original = keep_original
+        if not keep_original and self.sizes[0][1] is not None:
+            raise ValueError("The first size replaces the original and keeps its "
+                             "format, unless the original is kept")
+        self.max_pixels = int(max_pixels)
         self.timeout = timeout
-        self.max_processes = processes
-        self.output_lock = threading.Lock()
         self.output_stream = output_stream
+        self.table_format = table_format
+        self.table_file = table_file
+        self.insert_rows = int(insert_rows)
+        self.download_engine = download_engine
+        self.connections_per_host = int(connections_per_host)
+        self.downloader = None  # Started on first use
+        self.manifest_file = manifest_file or os.path.join(
+            output_dir, manifest.DEFAULT_FILENAME)
+        self.manifest = None  # Opened on first use, by the main process only
+        # Check files that are done for changes
+        self.refresh = refresh
+        # File names that have been started but not yet written out
+        self.outstanding = set()
+        self.outstanding_lock = threading.Lock()
+        # A pagestate.PendingPages told about the jobs of the pages being
+        # handled, if pages are recorded
+        self.pending_pages = None
     
     def get_images(self, urls, fname, local_path, timeout, callback, error_callback):
         """Try a series of URLs"""
-        if SKIP_EXISTING and os.path.exists(local_path):
-            settings.logger.debug("{:s} exists, skipping".format(local_path))
-            self.image_resized(fname, local_path)
+        refresh = self.refresh and self.get_manifest().is_done(fname)
+        if not self.get_manifest().claim(fname, self.refresh):
+            metrics.incr("files_skipped")
+            settings.logger.debug("%s done or already started, skipping", fname)
+            if self.pending_pages is not None:
+                self.pending_pages.depend(fname)
             return
-        else:
-            self.get_image(urls, 0, fname, local_path, timeout, callback, error_callback)
-    
-    @job
-    def get_image(self, urls, index, fname, local_path, timeout, callback, error_callback):
-        settings.logger.debug("Downloading {:s}".format(urls[index]))
+        self.jobs.acquire()
+        with self.outstanding_lock:
+            self.outstanding.add(fname)
+        if self.pending_pages is not None:
+            self.pending_pages.start(fname)
         try:
-            future = self.executor.submit(load_url, urls[index], local_path, timeout)
-            future.add_done_callback(
-                lambda future: callback(fname, local_path, future.result(), urls[index]))
-        except Exception as exc:
-            if index < len(urls):
-                self.get_image(urls, index + 1, fname, local_path, timeout, callback, error_callback)
+            if refresh and os.path.exists(local_path):
+                __, etag, last_modified = self.get_manifest().get_validators(fname)
+                self.get_image(urls, 0, fname, local_path, timeout, callback, error_callback,
+                               downloader.conditional_headers(etag, last_modified))
+            elif SKIP_EXISTING and os.path.exists(local_path):
+                self.use_existing(fname, local_path)
             else:
+                self.get_image(urls, 0, fname, local_path, timeout, callback, error_callback)
+        except Exception as exc:
+            # The job has its slot, error_callback frees it
+            error_callback(fname, exc)
+
+    def use_existing(self, fname, local_path):
+        """Finish the job of a file that is at local_path already"""
+        missing = [thumb for thumb in self.get_thumbnails(fname, local_path)
+                   if not os.path.exists(thumb[0])]
+        if self.scale and self.keep_original and missing:
+            # New sizes are scaled from the kept original
+            settings.logger.debug("%s exists, scaling to new sizes", local_path)
+            with open(local_path, "rb") as f:
+                data = f.read()
+            self.scale_image(fname, data, local_path, missing,
+                             self.image_resized, self.image_resize_error,
+                             from_local_path=True)
+            return
+        settings.logger.debug("%s exists, skipping", local_path)
+        self.image_resized(fname, local_path)
+
+    def get_image(self, urls, index, fname, local_path, timeout, callback, error_callback,
+                  headers=None):
+        settings.logger.debug("Downloading %s", urls[index])
+        metrics.incr("downloads_started")
+        started = time.perf_counter()
+
+        def done(future):
+            metrics.observe("download", time.perf_counter() - started)
+            if future.cancelled():
+                error_callback(fname, "Cancelled at shutdown")
+                return
+            exc = future.exception()
+            try:
+                if exc is None:
+                    callback(fname, local_path, future.result(), urls[index])
+                elif downloader.is_not_modified(exc):
+                    self.image_unchanged(fname, local_path)
+                elif index + 1 < len(urls):
+                    self.get_image(urls, index + 1, fname, local_path, timeout, callback,
+                                   error_callback, headers)
+                else:
+                    error_callback(fname, exc)
+            except Exception as exc:
+                # Exceptions of callbacks are only logged by the future, the
+                # job would never reach job_done and shutdown() would wait
+                # for it forever. Whatever has raised hasn't ended the job,
+                # the error callbacks and image_resized never raise.
                 error_callback(fname, exc)
 
-    @job
-    def scale_image(self, fname, local_path, size, callback, error_callback):
         try:
-            future = self.executor.submit(scale_image, fname, local_path, size)
-            future.add_done_callback(
-                lambda future: callback(fname, local_path, future=future))
+            # Images that are going to be scaled are kept in memory, others
+            # are saved right away
+            save_path = None if self.scale else local_path
+            if self.download_engine == DOWNLOAD_ENGINE_ASYNC:
+                future = self.get_downloader().submit(urls[index], save_path, headers)
+            else:
+                future = self.download_executor.submit(
+                    load_url, urls[index], timeout, save_path, headers)
+            future.add_done_callback(done)
         except Exception as exc:
-            error_callback(local_path, exc)
+            error_callback(fname, exc)
+
+    def get_downloader(self):
+        if self.downloader is None:
+            self.downloader = downloader.AsyncDownloader(
+                connections_per_host=self.connections_per_host,
+                timeout=self.timeout,
+                retries=DOWNLOAD_RETRIES,
+            )
+        return self.downloader
+
+    def get_manifest(self):
+        if self.manifest is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file)),
+                        mode=0o755, exist_ok=True)
+            self.manifest = manifest.Manifest(self.manifest_file)
+        return self.manifest
+
+    def get_thumbnails(self, fname, local_path):
+        """(path, size, format) of every thumbnail of a file"""
+        h1, h2 = self.get_hash(fname)
+        thumbs = []
+        for n, (size, img_format) in enumerate(self.sizes):
+            if n == 0 and not self.keep_original:
+                thumbs.append((local_path, size, img_format))
+                continue
+            thumbs.append((
+                os.path.join(self.output_dir, THUMB_DIRECTORY, h1, h2, fname,
+                             thumbnails.thumbnail_filename(fname, size, img_format)),
+                size,
+                img_format,
+            ))
+        return thumbs
+
+    def scale_image(self, fname, data, local_path, thumbs, callback, error_callback,
+                    from_local_path=False):
+        try:
+            future = self.scale_executor.submit(
+                scale_image, data, local_path, thumbs, self.keep_original, self.max_pixels,
+                from_local_path)
+            started = time.perf_counter()
 
-    def shutdown(self, timeout, wait=True):
-        time.sleep(timeout)
-        self.executor.shutdown(wait=wait)
+            def done(future):
+                # Includes the time waiting for a free process
+                metrics.observe("scale_latency", time.perf_counter() - started)
+                callback(fname, local_path, future=future)
 
-    def image_downloaded(self, fname, local_path, results, url):
-        """Callback from WorkerThread"""
+            future.add_done_callback(done)
+        except Exception as exc:
+            error_callback(fname, exc)
+
+    def shutdown(self, timeout=None, wait=True):
+        """Wait for the outstanding jobs, at most timeout seconds, and stop
+        the pools. With wait=False, unfinished jobs are abandoned."""
+        if wait:
+            settings.logger.info("Waiting for {} outstanding jobs".format(self.jobs.running))
+            if not self.jobs.join(timeout):
+                settings.logger.warning(
+                    "Gave up on {} outstanding jobs".format(self.jobs.running))
+        if self.downloader is not None:
+            self.downloader.shutdown()
+        self.download_executor.shutdown(wait=wait)
+        self.scale_executor.shutdown(wait=wait)
+        if self.manifest is not None:
+            self.manifest.commit()
+
+    def image_downloaded(self, fname, local_path, response, url):
+        """Callback from WorkerThread, the content of the downloader.Response
+        is the downloaded bytes when scaling"""
+        if (self.refresh and self.get_manifest().is_done(fname) and
+                response.sha1 == self.get_manifest().get_validators(fname)[0]):
+            # Served again, e.g. without validators, but the same file
+            self.image_unchanged(fname, local_path)
+            return
+        # The bytes are not kept until the job is done
+        download = response._replace(content=None)
+        if not self.scale:
+            self.image_resized(fname, local_path, url=url, download=download)
+            return
         self.scale_image(
             fname,
+            response.content,
             local_path,
-            self.max_image_size,
-            self.image_resized,
+            self.get_thumbnails(fname, local_path),
+            functools.partial(self.image_resized, url=url, download=download),
             self.image_resize_error
         )
 
+    def image_unchanged(self, fname, local_path):
+        """A file that is done hasn't changed since it was downloaded"""
+        settings.logger.debug("%s has not changed", fname)
+        metrics.incr("files_unchanged")
+        self.use_existing(fname, local_path)
+
     def image_download_error(self, fname, exception):
-        """Callback from WorkerThread"""
-        settings.logger.error("Could not download: {0:s}".format(fname))
+        """Callback from WorkerThread, ends the job and never raises"""
+        settings.logger.error("Could not download: {0:s}: {1}".format(fname, exception))
+        metrics.incr("downloads_failed")
+        try:
+            # A file that is done stays done when refreshing it fails
+            if not self.get_manifest().is_done(fname):
+                self.get_manifest().add(fname, manifest.STATUS_FAILED)
+        except Exception as exc:
+            settings.logger.error("Could not record {:s}: {}".format(fname, exc))
+        finally:
+            self.job_done(fname, ok=False)
+
+    def job_done(self, fname, ok=True):
+        """Every job ends here exactly once, successful or not"""
+        with self.outstanding_lock:
+            self.outstanding.discard(fname)
+        try:
+            # Before the slot is freed, so the pages are recorded when
+            # shutdown() returns
+            if self.pending_pages is not None:
+                self.pending_pages.end(fname, ok)
+        except Exception as exc:
+            settings.logger.error("Could not record the pages of {:s}: {}".format(fname, exc))
+        finally:
+            self.jobs.release()
 
-    def image_resized(self, fname, local_path, future=None):
+    def image_resized(self, fname, local_path, future=None, url=None, download=None):
+        """Ends the job and never raises"""
+        ok = False
+        try:
+            ok = self.record_image(fname, local_path, future, url, download)
+        except Exception as exc:
+            settings.logger.error("Could not record {:s}: {}".format(fname, exc))
+            metrics.incr("downloads_failed")
+        finally:
+            self.job_done(fname, ok)
+
+    def record_image(self, fname, local_path, future=None, url=None, download=None):
+        """Record a file that is done, with the SHA-1 and validators of the
+        downloader.Response download, if it has been downloaded. Returns
+        False if scaling it has failed."""
         if future:
             exc = future.exception()
             if exc is not None:
                 settings.logger.error("Could not resize {:s}: {}".format(fname, exc))
-                return
-            size = future.result()
+                self.get_manifest().add(fname, manifest.STATUS_FAILED, url=url)
+                return False
+            size, seconds = future.result()
+            metrics.observe("scale", seconds)
         else:
-            size = [0, 0]
-        if not OUTPUT_SQL:
-            return
-        self.output_lock.acquire()
-        self.output_stream.write(SQL_VALUES.format(
+            size = get_image_size(local_path)
+        filesize = os.path.getsize(local_path)
+        metrics.incr("images_done")
+        metrics.incr("image_bytes_written", filesize)
+        self.get_manifest().add(
+            fname,
+            manifest.STATUS_DONE,
+            size=filesize,
             width=size[0],
             height=size[1],
-            filesize=os.path.getsize(local_path),
-            name=os.path.split(local_path)[-1],
-        ))
-        self.output_lock.release()
-
-    def image_resize_error(self, fname, local_path):
-        settings.logger.error("Error resize: {}".format(local_path))
+            url=url,
+            sha1=download.sha1 if download else None,
+            etag=download.etag if download else None,
+            last_modified=download.last_modified if download else None,
+        )
+        return True
+
+    def write_table(self):
+        """Write a row of the image table for every file in the manifest"""
+        stream = None
+        if self.table_format == imagetable.FORMAT_SQLITE:
+            target = self.table_file or os.path.join(
+                self.output_dir, SQLITE_TABLE_FILENAME)
+        elif self.table_file:
+            target = stream = open(self.table_file, "w", encoding="utf-8")
+        else:
+            target = self.output_stream
+        try:
+            writer = imagetable.get_writer(self.table_format, target, self.insert_rows)
+            with metrics.timer("write_table"):
+                for row in self.get_manifest().iter_done():
+                    writer.write(*row)
+                    metrics.incr("table_rows_written")
+                writer.close()
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def get_outstanding_jobs(self):
+        with self.outstanding_lock:
+            return list(self.outstanding)
+
+    def image_resize_error(self, fname, exception):
+        """Ends the job and never raises"""
+        settings.logger.error("Error resize: {}: {}".format(fname, exception))
+        metrics.incr("downloads_failed")
+        try:
+            self.get_manifest().add(fname, manifest.STATUS_FAILED)
+        except Exception as exc:
+            settings.logger.error("Could not record {:s}: {}".format(fname, exc))
+        finally:
+            self.job_done(fname, ok=False)
 
     def get_hash(self, filename):
-        m = md5()
+        m = hashlib.md5()
         m.update(filename.encode('utf-8'))
         c = m.hexdigest()
         return c[0], c[0:2]
@@ -271,88 +737,251 @@ class ImageDownloader(streamparser.XmlStreamParser, ImagePoolWorker):
                  output=OUTPUT_ROOT, namespaces=DEFAULT_NAMESPACES,
                  max_image_size=MAX_IMAGE_SIZE, threads=DEFAULT_MAX_THREADS,
                  timeout=DOWNLOAD_TIMEOUT,
-                 revisiontext=False, **kwargs):
+                 revisiontext=False,
+                 downloader=DEFAULT_DOWNLOAD_ENGINE,
+                 connections_per_host=downloader.DEFAULT_CONNECTIONS_PER_HOST,
+                 max_jobs=None, low_jobs=None,
+                 scale=SCALE, scale_processes=None, manifest=None,
+                 table_format=imagetable.FORMAT_SQL, table_file=None,
+                 insert_rows=imagetable.DEFAULT_BATCH_SIZE,
+                 sizes=None, keep_original=False, max_pixels=thumbnails.MAX_PIXELS,
+                 refresh=False, output_table=True, **kwargs):
+        # docopt gives an empty list when --dlurls isn't used
+        dlurls = dlurls or DEFAULT_DOWNLOAD_PATHS
         self.method = SEARCH_ARTICLES if revisiontext else SEARCH_TITLES
         self.namespaces = namespaces
         self.output_stream = sys.stdout
+        # Shards write their manifest only, the table is written once merged
+        self.output_table = output_table
+        # Skip pages from other namespaces before they are parsed
+        kwargs.setdefault("page_filter", rawpages.PageFilter(namespaces=namespaces))
         streamparser.XmlStreamParser.__init__(self, in_file=in_file,
                                               out_file=sys.stdout, **kwargs)
+        if self.page_state is not None and self.pipeline and self.unordered:
+            raise ValueError("Unordered batches cannot be matched to their pages "
+                             "in the page state")
         ImagePoolWorker.__init__(self, threads, dlurls, output,
-                                 max_image_size, timeout, output_stream=self.output_stream)
+                                 max_image_size, timeout, output_stream=self.output_stream,
+                                 download_engine=downloader,
+                                 connections_per_host=connections_per_host,
+                                 max_jobs=max_jobs, low_jobs=low_jobs,
+                                 scale=scale, scale_processes=scale_processes,
+                                 manifest_file=manifest,
+                                 table_format=table_format, table_file=table_file,
+                                 insert_rows=insert_rows,
+                                 sizes=sizes, keep_original=keep_original,
+                                 max_pixels=max_pixels, refresh=refresh)
+        if self.page_state is not None:
+            # Pages are recorded once their downloads have succeeded
+            self.pending_pages = pagestate.PendingPages(self.page_state)
 
     def parse_site_info(self, lines):
         streamparser.XmlStreamParser.parse_site_info(self, lines)
 
+    def get_worker_kwargs(self):
+        kwargs = streamparser.XmlStreamParser.get_worker_kwargs(self)
+        kwargs.update(
+            dlurls=self.dlurls,
+            output=self.output_dir,
+            namespaces=self.namespaces,
+            max_image_size=self.max_image_size,
+            threads=self.processes,
+            timeout=self.timeout,
+            revisiontext=self.method == SEARCH_ARTICLES,
+            downloader=self.download_engine,
+            connections_per_host=self.connections_per_host,
+            max_jobs=self.jobs.high,
+            low_jobs=self.jobs.low,
+            scale=self.scale,
+            scale_processes=self.scale_processes,
+            manifest=self.manifest_file,
+            table_format=self.table_format,
+            table_file=self.table_file,
+            insert_rows=self.insert_rows,
+            sizes=self.sizes,
+            keep_original=self.keep_original,
+            max_pixels=self.max_pixels,
+            refresh=self.refresh,
+        )
+        return kwargs
+
     def handle_page(self, page):
-        if page.find("ns").text in self.namespaces:
-            if self.method == SEARCH_TITLES:
-                fnames = self.get_filenames_from_title_tag(page)
-            else:
-                fnames = self.get_filenames_from_article_text(page)
-            for fname in fnames:
-                h1, h2 = self.get_hash(fname)
-                local_path = self.get_local_path(h1, h2, fname)
-                urls = list(map(
-                    lambda s: s.format(h1=h1, h2=h2, fname=fname),
-                    DEFAULT_DOWNLOAD_PATHS
-                ))
-                self.get_images(
-                    urls,
-                    fname,
-                    local_path,
-                    self.timeout,
-                    self.image_downloaded,
-                    self.image_download_error
-                )
+        self.handle_result(self.process_page(page))
+
+    def process_page(self, page):
+        """Returns the file names found in a page. This is the CPU heavy part,
+        which runs in the worker processes in pipeline and multistream mode."""
+        if str(page.ns) not in self.namespaces:
+            return None
+        if self.method == SEARCH_TITLES:
+            fnames = self.get_filenames_from_title_tag(page)
+        else:
+            fnames = self.get_filenames_from_article_text(page)
+        return list(fnames) or None
+
+    def handle_page_start(self, page):
+        """Revisions engine: the title is all that is needed of File: pages"""
+        if self.method == SEARCH_TITLES:
+            self.handle_page(page)
+
+    def handle_revision(self, page, revision):
+        """Revisions engine: files linked from the text of any revision"""
+        if self.method == SEARCH_ARTICLES and str(page.ns) in self.namespaces:
+            self.handle_result(list(self.get_filenames_from_text(revision.text)))
+
+    def handle_result(self, fnames):
+        """Downloads happen in the main process, which owns the pool"""
+        for fname in fnames or ():
+            self.download_file(fname)
+
+    def download_file(self, fname):
+        h1, h2 = self.get_hash(fname)
+        local_path = self.get_local_path(h1, h2, fname)
+        urls = list(map(
+            lambda s: s.format(h1=h1, h2=h2, fname=fname),
+            self.dlurls
+        ))
+        self.get_images(
+            urls,
+            fname,
+            local_path,
+            self.timeout,
+            self.image_downloaded,
+            self.image_download_error
+        )
+
+    def pages_done(self, keys):
+        """The keys wait for the jobs started by handle_page or
+        handle_result since the last call"""
+        self.pending_pages.add(keys)
+
+    def resume_jobs(self, jobs):
+        """Restart downloads that were unfinished at the last checkpoint"""
+        for fname in jobs:
+            self.download_file(fname)
 
     def get_filenames_from_title_tag(self, page):
         """Titles are usually found in namespace 6 and the title is then stored
         as <title>filename.ext</title>."""
-        try:
-            title = page.find("title").text
-        except AttributeError:
+        title = page.title
+        if title is None:
             settings.logging.warning(
-                "No title in <page>, line: %d", self.line_no)
+                "No title in <page>, %s", self.describe_position())
             return
         if not REVISION_TITLE_PATTERN.search(title):
             settings.logging.warning(
-                "Title '%s' starting with 'File:' in <page>, line: %d", title, self.line_no)
+                "Title '%s' starting with 'File:' in <page>, %s", title,
+                self.describe_position())
             return
         fname = title.replace("File:", "")
-        settings.logger.debug("Started download job for: " + fname)
+        settings.logger.debug("Started download job for: %s", fname)
         yield fname
 
     def get_filenames_from_article_text(self, page):
         """Titles are usually found in namespace 6 and the title is then stored
         as <title>filename.ext</title>."""
-        try:
-            text = page.find("revision").find("text").text
-        except AttributeError:
+        return self.get_filenames_from_text(page.text)
+
+    def get_filenames_from_text(self, text):
+        if not text:
             return
         for match in ARTICLE_FILE_PATTERN.findall(text):
             if "{{{" in match[1]:
                 raise NotImplementedError("Does not know what to do with variables")
             yield match[1]
 
+    def register_metrics(self):
+        streamparser.XmlStreamParser.register_metrics(self)
+        metrics.gauge("jobs_running", lambda: self.jobs.running)
+        # 1 while reading the dump waits for jobs to finish
+        metrics.gauge("jobs_blocked", lambda: int(self.jobs.blocked))
+        metrics.gauge("downloads_in_flight", lambda: (
+            self.downloader.active if self.downloader is not None else 0))
+
     def execute(self):
+        # Also covers waiting for the downloads and writing the table
+        started = self.start_metrics()
+        try:
+            self.parse_dump()
+            self.shutdown()
+            # Only now have the pages of the last downloads been recorded
+            if self.page_state is not None:
+                self.page_state.commit()
+            if OUTPUT_SQL and self.output_table:
+                self.write_table()
+            if self.manifest is not None:
+                self.manifest.close()
+        finally:
+            self.close()
+            if started:
+                self.stop_metrics()
+
+
+def run_shards(coordinator_file, worker_id=None, lease=shards.DEFAULT_LEASE, **kwargs):
+    """Download the files of the shards of coordinator_file until all are
+    done, and write the table of all shards if this worker gets to merge them"""
+    kwargs.pop("in_file", None)
+    manifest_file = kwargs.pop("manifest", None)
+    coordinator = shards.Coordinator(coordinator_file)
+
+    def process_shard(stream, output):
+        p = ImageDownloader(in_file=stream, manifest=output, output_table=False, **kwargs)
+        # Written even if the shard has no files
+        p.get_manifest()
+        try:
+            p.execute()
+        except BaseException:
+            p.shutdown(0, wait=False)
+            raise
+
+    def merge_outputs(paths):
+        merged = ImageDownloader(in_file=io.BytesIO(), manifest=manifest_file, **kwargs)
+        for path in paths:
+            merged.get_manifest().merge(path)
         if OUTPUT_SQL:
-            self.output_stream.write("INSERT INTO image(img_name, img_width, img_height, img_size) VALUES \n")
-        streamparser.XmlStreamParser.execute(self)
-        self.shutdown(self.timeout)
+            merged.write_table()
+        merged.shutdown()
+        merged.get_manifest().close()
+
+    try:
+        shards.run_worker(coordinator, process_shard, merge_outputs, worker_id, lease, ".sqlite")
+    finally:
+        coordinator.close()
 
 
 if __name__ == "__main__":
     arguments = docopt(__doc__, version='python-mw-tools imagedownloader ' + str(VERSION))
-    arguments = dict((k.replace("--", ""), v) for k, v in arguments.items())
+    coordinator_file = arguments.pop("--coordinator")
+    worker_id = arguments.pop("--worker-id")
+    lease = arguments.pop("--lease")
+    arguments = dict((k.replace("--", "").replace("-", "_"), v) for k, v in arguments.items())
     arguments = dict(
         filter(lambda kv: not kv[1] is None, [(k, v) for k, v in arguments.items()]))
+    if "titles" in arguments:
+        arguments["titles"] = pageindex.read_titles(arguments["titles"])
+    if coordinator_file:
+        try:
+            run_shards(coordinator_file, worker_id, lease, **arguments)
+        except ShardError as e:
+            settings.logger.error(e)
+            sys.exit(1)
+        sys.exit(0)
     p = ImageDownloader(**arguments)
     try:
         p.execute()
     except Exception as e:
-        settings.logger.error("Failed to parse, line no: {}".format(p.line_no))
+        settings.logger.error("Failed to parse, {}".format(p.describe_position()))
         settings.logger.error(e)
         settings.logger.debug(traceback.print_tb(sys.exc_info()[2]))
-        settings.logger.error(
-            "You can set --resume={} after fixing to resume".format(p.line_no))
+        if p.checkpoint and p.last_page_offset:
+            p.write_checkpoint()
+            settings.logger.error(
+                "Run again with --checkpoint={} to resume".format(p.checkpoint))
+        elif p.counts_lines:
+            settings.logger.error(
+                "You can set --resume={} after fixing to resume".format(p.line_no))
+        else:
+            settings.logger.error(
+                "Run again with --checkpoint=FILE to be able to resume after the "
+                "last completed page")
         p.shutdown(0, wait=False)
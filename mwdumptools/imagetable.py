@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Writers for the rows of the Mediawiki image table.
+
+imagedownloader writes the table from its manifest at the end of a run, so
+the download and scale callbacks never wait for output. Rows are written as:
+
+sql     INSERT statements of a limited number of rows each, which MySQL can
+        swallow however many images there are
+tsv     Tab separated values for LOAD DATA INFILE or COPY ... FROM, escaped
+        the way both expect
+sqlite  An image table in an SQLite database
+"""
+import sqlite3
+
+FORMAT_SQL = "sql"
+FORMAT_TSV = "tsv"
+FORMAT_SQLITE = "sqlite"
+
+# Rows per INSERT statement
+DEFAULT_BATCH_SIZE = 1000
+
+COLUMNS = ("img_name", "img_width", "img_height", "img_size")
+
+SQL_INSERT = "INSERT INTO image({}) VALUES\n".format(", ".join(COLUMNS))
+SQL_VALUES = "('{name:s}', '{width:d}', '{height:d}', '{filesize:d}')"
+
+TSV_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+})
+
+
+class ImageTableWriter:
+
+    """Base class, rows are passed to write() and close() finishes up"""
+
+    def __init__(self, stream, batch_size=DEFAULT_BATCH_SIZE):
+        self.stream = stream
+        self.batch_size = int(batch_size)
+        self.rows = []
+
+    def write(self, name, width, height, filesize):
+        self.rows.append((name, width or 0, height or 0, filesize or 0))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+
+    def write_rows(self, rows):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+
+class SQLWriter(ImageTableWriter):
+
+    def write_rows(self, rows):
+        self.stream.write(SQL_INSERT)
+        self.stream.write(",\n".join(
+            SQL_VALUES.format(
+                name=name.replace("\\", "\\\\").replace("'", "''"),
+                width=width,
+                height=height,
+                filesize=filesize,
+            ) for name, width, height, filesize in rows))
+        self.stream.write(";\n")
+
+
+class TSVWriter(ImageTableWriter):
+
+    def write_rows(self, rows):
+        self.stream.write("".join(
+            "{}\t{:d}\t{:d}\t{:d}\n".format(
+                name.translate(TSV_ESCAPES), width, height, filesize)
+            for name, width, height, filesize in rows))
+
+
+class SQLiteWriter(ImageTableWriter):
+
+    """stream is the path of the database"""
+
+    def __init__(self, stream, batch_size=DEFAULT_BATCH_SIZE):
+        ImageTableWriter.__init__(self, stream, batch_size)
+        self.connection = sqlite3.connect(stream)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS image ("
+            "img_name TEXT PRIMARY KEY, img_width INTEGER, "
+            "img_height INTEGER, img_size INTEGER)")
+
+    def write_rows(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO image({}) VALUES (?, ?, ?, ?)".format(
+                    ", ".join(COLUMNS)),
+                rows)
+
+    def close(self):
+        ImageTableWriter.close(self)
+        self.connection.close()
+
+
+WRITERS = {
+    FORMAT_SQL: SQLWriter,
+    FORMAT_TSV: TSVWriter,
+    FORMAT_SQLITE: SQLiteWriter,
+}
+
+
+def get_writer(table_format, stream, batch_size=DEFAULT_BATCH_SIZE):
+    try:
+        writer_class = WRITERS[table_format]
+    except KeyError:
+        raise ValueError("Unknown table format {!r}, expected one of {}".format(
+            table_format, ", ".join(sorted(WRITERS))))
+    return writer_class(stream, batch_size)
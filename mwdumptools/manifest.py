@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent record of the files handled by imagedownloader.
+
+An SQLite database in the output directory keeps the status, size,
+dimensions and source URL of every file name. Names that are done are loaded
+into memory when the manifest is opened, so a restarted job skips them
+without looking at the file system, and every name is claimed at most once
+per run, however many articles reference it. The rows of the image table are
+written from the manifest at the end, once per file.
+
+The SHA-1 of every downloaded file and the ETag and Last-Modified headers
+it was served with are kept too. In a refresh run, files that are done are
+claimed once more and downloaded with a conditional request.
+"""
+import sqlite3
+import threading
+import time
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+DEFAULT_FILENAME = "manifest.sqlite"
+
+# Records written before they are committed
+COMMIT_INTERVAL = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    url TEXT,
+    updated REAL,
+    sha1 TEXT,
+    etag TEXT,
+    last_modified TEXT
+)
+"""
+
+# Columns added since the first version, added to older manifests
+ADDED_COLUMNS = (
+    ("sha1", "TEXT"),
+    ("etag", "TEXT"),
+    ("last_modified", "TEXT"),
+)
+
+
+class Manifest:
+
+    def __init__(self, path, commit_interval=COMMIT_INTERVAL):
+        self.path = path
+        self.commit_interval = commit_interval
+        # Records come from the callback threads of the download and scale
+        # pools, so the connection is shared behind a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(SCHEMA)
+        columns = set(row[1] for row in self.connection.execute("PRAGMA table_info(files)"))
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self.connection.execute(
+                    "ALTER TABLE files ADD COLUMN {} {}".format(name, column_type))
+        self.connection.commit()
+        self.uncommitted = 0
+        self.done = set(
+            name for name, in self.connection.execute(
+                "SELECT name FROM files WHERE status = ?", (STATUS_DONE,)))
+        # Names claimed in this run, done or not
+        self.claimed = set()
+
+    def claim(self, name, refresh=False):
+        """Returns True if name should be processed: it isn't done, unless
+        refresh, and hasn't been claimed before in this run"""
+        with self.lock:
+            if (name in self.done and not refresh) or name in self.claimed:
+                return False
+            self.claimed.add(name)
+            return True
+
+    def is_done(self, name):
+        return name in self.done
+
+    def get_validators(self, name):
+        """(sha1, etag, last_modified) of the last download of name, each
+        None if unknown"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sha1, etag, last_modified FROM files WHERE name = ?",
+                (name,)).fetchone()
+        return row or (None, None, None)
+
+    def add(self, name, status, size=None, width=None, height=None, url=None,
+            sha1=None, etag=None, last_modified=None):
+        """Record name, the URL and validators of the last download are
+        kept if not given"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO files "
+                "(name, status, size, width, height, url, updated, sha1, etag, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                "status = excluded.status, size = excluded.size, "
+                "width = excluded.width, height = excluded.height, "
+                "url = COALESCE(excluded.url, url), updated = excluded.updated, "
+                "sha1 = COALESCE(excluded.sha1, sha1), "
+                "etag = COALESCE(excluded.etag, etag), "
+                "last_modified = COALESCE(excluded.last_modified, last_modified)",
+                (name, status, size, width, height, url, time.time(),
+                 sha1, etag, last_modified))
+            if status == STATUS_DONE:
+                self.done.add(name)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self._commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def iter_done(self):
+        """Yields (name, width, height, size) of all files that are done.
+        Meant for the end of a run, when no more records are added."""
+        self.commit()
+        yield from self.connection.execute(
+            "SELECT name, width, height, size FROM files "
+            "WHERE status = ? ORDER BY name", (STATUS_DONE,))
+
+    def merge(self, path):
+        """Add the records of the manifest at path, e.g. that of a shard.
+        Files done there replace the records here, failed files are only
+        added if they aren't recorded yet."""
+        columns = "name, status, size, width, height, url, updated, sha1, etag, last_modified"
+        with self.lock:
+            self._commit()
+            self.connection.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files ({0}) SELECT {0} FROM other.files "
+                    "WHERE status = ?".format(columns), (STATUS_DONE,))
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO files ({0}) SELECT {0} FROM other.files "
+                    "WHERE status != ?".format(columns), (STATUS_DONE,))
+                self.done.update(
+                    name for name, in self.connection.execute(
+                        "SELECT name FROM other.files WHERE status = ?", (STATUS_DONE,)))
+                self._commit()
+            finally:
+                self.connection.execute("DETACH DATABASE other")
+
+    def __len__(self):
+        return len(self.done)
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.connection.close()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, gauges and timers for finding out what a job is bound by.
+
+Metrics are off unless an exporter is started, and then every call to
+incr(), observe() and timer() returns right after checking a module flag, so
+they can stay in hot paths. Gauges that are cheap to read anyway, like the
+byte offset of the parser or the number of jobs in flight, are registered as
+callables and only evaluated when a snapshot is exported.
+
+Worker processes have metrics of their own. They are turned on in the
+workers with enable(), and take() hands what a worker has recorded back to
+the exporting process with the results of each task, where merge() adds it.
+
+Snapshots are written every few seconds by a background thread, either
+appended as JSON lines or, for files ending with .prom, as a Prometheus
+textfile (for the textfile collector of node_exporter) that is replaced as a
+whole.
+"""
+import json
+import os
+import threading
+import time
+
+PROMETHEUS_EXTENSION = ".prom"
+PROMETHEUS_PREFIX = "mwdump_"
+
+DEFAULT_INTERVAL = 10  # seconds
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_timers = {}  # name -> [count, total seconds, max seconds]
+_gauges = {}  # name -> callable
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    """Record metrics without exporting them, in a worker process whose
+    metrics are merged into the exporting process"""
+    global _enabled
+    reset()
+    _enabled = True
+
+
+def incr(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name, seconds):
+    if not _enabled:
+        return
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+
+class _Timer:
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started)
+
+
+class _NoTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name):
+    """Context manager observing the time spent in its block"""
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(name)
+
+
+def gauge(name, fn):
+    """Register fn, which returns the current value of a gauge"""
+    _gauges[name] = fn
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+    _gauges.clear()
+
+
+def take():
+    """The counters and timers recorded since the last call, which are
+    cleared, for merge() in another process. None if nothing is recorded."""
+    if not _enabled:
+        return None
+    with _lock:
+        data = (dict(_counters), dict(_timers))
+        _counters.clear()
+        _timers.clear()
+    return data
+
+
+def merge(data):
+    """Add counters and timers returned by take()"""
+    if not _enabled or data is None:
+        return
+    counters, timers = data
+    with _lock:
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+        for name, (count, total, longest) in timers.items():
+            timer = _timers.get(name)
+            if timer is None:
+                _timers[name] = [count, total, longest]
+            else:
+                timer[0] += count
+                timer[1] += total
+                if longest > timer[2]:
+                    timer[2] = longest
+
+
+def snapshot():
+    """All metrics as a dict"""
+    with _lock:
+        counters = dict(_counters)
+        timers = dict((name, list(timer)) for name, timer in _timers.items())
+    gauges = {}
+    for name, fn in list(_gauges.items()):
+        try:
+            gauges[name] = fn()
+        except Exception:
+            # A gauge of an object that is shutting down
+            continue
+    return {
+        "timestamp": time.time(),
+        "counters": counters,
+        "gauges": gauges,
+        "timers": dict(
+            (name, {"count": count, "seconds": total, "max_seconds": longest})
+            for name, (count, total, longest) in timers.items()),
+    }
+
+
+def format_prometheus(data):
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        name = PROMETHEUS_PREFIX + name + "_total"
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(name, value))
+    for name, value in sorted(data["gauges"].items()):
+        name = PROMETHEUS_PREFIX + name
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{} {}".format(name, value))
+    for name, timer in sorted(data["timers"].items()):
+        name = PROMETHEUS_PREFIX + name + "_seconds"
+        lines.append("# TYPE {} summary".format(name))
+        lines.append("{}_count {}".format(name, timer["count"]))
+        lines.append("{}_sum {}".format(name, timer["seconds"]))
+    return "\n".join(lines) + "\n"
+
+
+class Exporter:
+
+    """Writes a snapshot to path every interval seconds, and once more when
+    stopped"""
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = float(interval)
+        self.prometheus = path.endswith(PROMETHEUS_EXTENSION)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        global _enabled
+        reset()
+        _enabled = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        global _enabled
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        _enabled = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        data = snapshot()
+        if self.prometheus:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(format_prometheus(data))
+            os.replace(tmp_path, self.path)
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(data) + "\n")
+
+
+def start(path, interval=DEFAULT_INTERVAL):
+    """Enable metrics and export them to path"""
+    return Exporter(path, interval).start()
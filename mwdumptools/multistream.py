@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Random access to bz2 multistream dumps (*-pages-articles-multistream.xml.bz2)
+
+A multistream dump is a concatenation of independent bz2 streams: the first
+stream holds the <mediawiki> header and <siteinfo>, every following stream
+holds ~100 <page> nodes and the dump ends with a stream closing </mediawiki>.
+
+The companion index (*-multistream-index.txt.bz2) has one line per page:
+
+    offset:page_id:title
+
+...where offset is the byte offset of the bz2 stream holding the page, so all
+streams can be located without decompressing the dump itself.
+"""
+import bz2
+import os
+
+
+def read_index(index_file):
+    """Yield (offset, page_id, title) for every line of an index file, which
+    may be bz2 compressed or plain text."""
+    opener = bz2.open if index_file.endswith(".bz2") else open
+    with opener(index_file, "rt", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.rstrip("\n")
+            if not ln:
+                continue
+            offset, page_id, title = ln.split(":", 2)
+            yield int(offset), int(page_id), title
+
+
+def get_stream_offsets(index_file):
+    """Sorted list of the distinct offsets of streams holding pages"""
+    return sorted(set(offset for offset, __, __ in read_index(index_file)))
+
+
+def get_stream_ranges(dump_file, index_file):
+    """Returns (header_length, ranges) where ranges is a list of
+    (offset, length) for every stream holding pages. The last range is
+    extended to the end of the dump so it includes the closing stream."""
+    offsets = get_stream_offsets(index_file)
+    if not offsets:
+        raise ValueError("Empty multistream index: " + index_file)
+    dump_size = os.path.getsize(dump_file)
+    ends = offsets[1:] + [dump_size]
+    ranges = [(start, end - start) for start, end in zip(offsets, ends)]
+    return offsets[0], ranges
+
+
+def read_stream(dump_file, offset, length):
+    """Read and decompress the bz2 stream(s) found at offset"""
+    with open(dump_file, "rb") as f:
+        f.seek(offset)
+        return bz2.decompress(f.read(length))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Compact records for <page> and <revision> nodes, passed to handle_page.
+
+Fields are read from the raw bytes of a page with a few regular expressions,
+which is a lot cheaper than building an ElementTree. The revision text, which
+is most of a page, stays an undecoded slice of the raw bytes until it is
+accessed. Both classes use __slots__, so they are small and pickle without a
+__dict__ when they are shipped to worker processes.
+"""
+import hashlib
+import re
+
+from .rawpages import REVISION_END
+from .rawpages import REVISION_START
+
+PAGE_TITLE_PATTERN = re.compile(rb"<title>(.*?)</title>", re.S)
+PAGE_NS_PATTERN = re.compile(rb"<ns>(-?\d+)</ns>")
+PAGE_REDIRECT_PATTERN = re.compile(rb"<redirect\s+title=\"([^\"]*)\"")
+ID_PATTERN = re.compile(rb"<id>(\d+)</id>")
+PARENTID_PATTERN = re.compile(rb"<parentid>(\d+)</parentid>")
+TIMESTAMP_PATTERN = re.compile(rb"<timestamp>([^<]*)</timestamp>")
+SHA1_PATTERN = re.compile(rb"<sha1>([^<]*)</sha1>")
+TEXT_START_PATTERN = re.compile(rb"<text\b([^>]*?)(/?)>")
+TEXT_END = b"</text>"
+CHAR_REF_PATTERN = re.compile(r"&#(x?)([0-9a-fA-F]+);")
+
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+SHA1_BASE36_LENGTH = 31
+
+
+def _char_ref(match):
+    return chr(int(match.group(2), 16 if match.group(1) else 10))
+
+
+def unescape(raw):
+    """Decode XML character data. Dumps only use the predefined entities and
+    character references, which str.replace handles much faster than
+    html.unescape. &amp; goes last, so "&amp;lt;" becomes "&lt;"."""
+    value = raw.decode("utf-8")
+    if "&" not in value:
+        return value
+    value = value.replace("&lt;", "<").replace("&gt;", ">")
+    value = value.replace("&quot;", '"').replace("&apos;", "'")
+    if "&#" in value:
+        value = CHAR_REF_PATTERN.sub(_char_ref, value)
+    return value.replace("&amp;", "&")
+
+
+def escape(value):
+    """Encode character data the way dumps do"""
+    value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return value.replace('"', "&quot;").encode("utf-8")
+
+
+def sha1_base36(data):
+    """The <sha1> of a text in dumps: the SHA-1 of its UTF-8 bytes in base
+    36, zero padded"""
+    n = int(hashlib.sha1(data).hexdigest(), 16)
+    digits = []
+    while n:
+        n, digit = divmod(n, 36)
+        digits.append(BASE36_DIGITS[digit])
+    return "".join(reversed(digits)).rjust(SHA1_BASE36_LENGTH, "0").encode("ascii")
+
+
+def _int(match):
+    return int(match.group(1)) if match else None
+
+
+def _str(match):
+    return unescape(match.group(1)) if match and match.group(1) else None
+
+
+class Revision:
+
+    """
+    A single <revision>. text is None when the text is missing or has been
+    deleted and an empty string when the revision is empty.
+    """
+
+    __slots__ = ("id", "parentid", "timestamp", "sha1",
+                 "_raw", "_text_start", "_text_end", "_text")
+
+    def __init__(self, id=None, parentid=None, timestamp=None, sha1=None, text=None):
+        self.id = id
+        self.parentid = parentid
+        self.timestamp = timestamp
+        self.sha1 = sha1
+        self._raw = None
+        self._text_start = self._text_end = 0
+        self._text = text
+
+    @classmethod
+    def from_bytes(cls, raw, start=0, end=None):
+        """Read the revision found in raw[start:end] without copying it"""
+        if end is None:
+            end = len(raw)
+        revision = cls()
+        text_match = TEXT_START_PATTERN.search(raw, start, end)
+        if text_match is None:
+            meta_end = end
+            rest_start = start
+        elif text_match.group(2):
+            # <text ... /> has no content
+            meta_end = text_match.start()
+            rest_start = text_match.end()
+            if b"deleted" not in text_match.group(1):
+                revision._text = ""
+        else:
+            meta_end = text_match.start()
+            rest_start = raw.index(TEXT_END, text_match.end(), end)
+            revision._raw = raw
+            revision._text_start = text_match.end()
+            revision._text_end = rest_start
+        # <id> of the revision comes before the <id> of the contributor
+        revision.id = _int(ID_PATTERN.search(raw, start, meta_end))
+        revision.parentid = _int(PARENTID_PATTERN.search(raw, start, meta_end))
+        revision.timestamp = _str(TIMESTAMP_PATTERN.search(raw, start, meta_end))
+        revision.sha1 = _str(SHA1_PATTERN.search(raw, rest_start, end))
+        return revision
+
+    @classmethod
+    def from_element(cls, element):
+        text = element.find("text")
+        if text is None or text.get("deleted") is not None:
+            text = None
+        else:
+            text = text.text or ""
+        return cls(
+            id=_element_int(element, "id"),
+            parentid=_element_int(element, "parentid"),
+            timestamp=element.findtext("timestamp"),
+            sha1=element.findtext("sha1") or None,
+            text=text,
+        )
+
+    @property
+    def text(self):
+        if self._raw is not None:
+            self._text = unescape(self._raw[self._text_start:self._text_end])
+            self._raw = None
+        return self._text
+
+    @property
+    def text_span(self):
+        """(start, end) of the escaped text in the raw bytes of the page, or
+        None if the revision wasn't read from bytes or has no text"""
+        if self._text_end:
+            return self._text_start, self._text_end
+        return None
+
+    @property
+    def text_bytes(self):
+        """The still escaped, undecoded text, without materializing it. Texts
+        that were not read from bytes are escaped like dumps do."""
+        if self._raw is not None:
+            return self._raw[self._text_start:self._text_end]
+        if self._text is None:
+            return None
+        return escape(self._text)
+
+
+def _element_int(element, tag):
+    value = element.findtext(tag)
+    return int(value) if value else None
+
+
+class Page:
+
+    """
+    A <page> with its revisions, in dump order. Articles dumps have a single
+    revision, which is also available as page.revision, and page.text,
+    page.timestamp and page.sha1 are those of the last revision.
+    """
+
+    __slots__ = ("id", "ns", "title", "redirect", "revisions", "_raw")
+
+    def __init__(self, id=None, ns=None, title=None, redirect=None, revisions=None):
+        self.id = id
+        self.ns = ns
+        self.title = title
+        self.redirect = redirect
+        self.revisions = revisions or []
+        self._raw = None
+
+    @classmethod
+    def from_bytes(cls, raw):
+        """Read a page from the raw bytes of its <page> node"""
+        page = cls()
+        page._raw = raw
+        header_end = raw.find(REVISION_START)
+        if header_end == -1:
+            header_end = len(raw)
+        page.title = _str(PAGE_TITLE_PATTERN.search(raw, 0, header_end))
+        page.ns = _int(PAGE_NS_PATTERN.search(raw, 0, header_end))
+        page.id = _int(ID_PATTERN.search(raw, 0, header_end))
+        page.redirect = _str(PAGE_REDIRECT_PATTERN.search(raw, 0, header_end))
+        start = header_end
+        while start != -1:
+            end = raw.find(REVISION_END, start)
+            if end == -1:
+                break
+            page.revisions.append(Revision.from_bytes(raw, start, end))
+            start = raw.find(REVISION_START, end)
+        return page
+
+    @classmethod
+    def from_element(cls, element):
+        """Read a page from a parsed <page> element"""
+        redirect = element.find("redirect")
+        return cls(
+            id=_element_int(element, "id"),
+            ns=_element_int(element, "ns"),
+            title=element.findtext("title"),
+            redirect=redirect.get("title") if redirect is not None else None,
+            revisions=[Revision.from_element(r) for r in element.iterfind("revision")],
+        )
+
+    @property
+    def revision(self):
+        return self.revisions[-1] if self.revisions else None
+
+    @property
+    def text(self):
+        revision = self.revision
+        return revision.text if revision else None
+
+    @property
+    def timestamp(self):
+        revision = self.revision
+        return revision.timestamp if revision else None
+
+    @property
+    def sha1(self):
+        revision = self.revision
+        return revision.sha1 if revision else None
+
+    @property
+    def raw(self):
+        """The raw bytes of the <page> node, if the page was read from bytes"""
+        return self._raw
+
+    def __repr__(self):
+        return "<Page {} ns={} {!r}>".format(self.id, self.ns, self.title)
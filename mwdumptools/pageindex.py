@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+=================================
+python-mwdump-tools - pageindex
+=================================
+
+Builds an index of the pages of a dump in one pass, to fetch single pages by
+title or page id without reading the dump again.
+
+For uncompressed dumps, the index holds the byte range of every <page> node,
+and pages are read through mmap. For bz2 multistream dumps
+(*-pages-articles-multistream.xml.bz2), it holds the range of the bz2 stream
+holding the page and the range of the page in the decompressed stream, so
+only that stream (~100 pages) is decompressed. Other compressed dumps cannot
+be read at random and must be decompressed first.
+
+The index is a binary file: a header, fixed size records sorted by page id,
+the record numbers sorted by title and the titles. Lookups are binary
+searches in the mmapped file, a few page faults each. While building, records
+and titles are sorted in runs that are spilled to temporary files next to the
+index and merged, so memory does not grow with the size of the dump.
+
+Example:
+  pageindex dump.xml dump.pageindex
+  pageindex --title="Main Page" dump.xml dump.pageindex
+  imagedownloader --in-file=dump.xml --page-index=dump.pageindex --titles=files.txt
+
+Usage:
+  pageindex [--title=TITLE]... [--id=ID]... DUMP INDEX
+  pageindex (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --title=TITLE      Write the <page> node of TITLE to STDOUT instead of
+                     building the index
+  --id=ID            Write the <page> node with page id ID to STDOUT instead of
+                     building the index
+"""
+import bz2
+import collections
+import functools
+import heapq
+import html
+import io
+import itertools
+import mmap
+import operator
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from docopt import docopt
+
+from . import compression
+from . import rawpages
+from . import settings
+from .exceptions import ParseError
+
+MAGIC = b"MWPIDX02"
+
+KIND_PLAIN = 0
+KIND_MULTISTREAM = 1
+
+# Magic, kind, number of pages
+HEADER = struct.Struct("<8sB7xQ")
+# Page id, ns, offset and length of the page (plain) or its stream
+# (multistream), offset and length of the page in the decompressed stream,
+# offset and length of the title
+RECORD = struct.Struct("<QiQQIQQI")
+TITLE_ORDER = struct.Struct("<I")
+# Record number and length of a title in the sorted runs of titles
+TITLE_RUN = struct.Struct("<II")
+
+# Bytes read at a time while building
+READ_SIZE = 1024 * 1024
+
+# Records or titles sorted in memory at a time while building, more are
+# spilled to sorted runs in temporary files
+SORT_RUN_SIZE = 500000
+
+# Multistream dumps have streams of ~100 pages, a larger stream means that
+# the dump was compressed as a whole
+MAX_STREAM_SIZE = 256 * 1024 * 1024
+
+# Decompressed streams kept for lookups of pages in the same stream
+STREAM_CACHE_SIZE = 8
+
+IndexEntry = collections.namedtuple(
+    "IndexEntry", "page_id ns title offset length page_offset page_length")
+
+
+def normalize_title(title):
+    """Titles in dumps have spaces, not underscores"""
+    return title.replace("_", " ").strip()
+
+
+def read_titles(path):
+    """One title per line, empty lines are skipped"""
+    with open(path, encoding="utf-8") as f:
+        return [normalize_title(ln) for ln in f if ln.strip()]
+
+
+def iter_streams(f):
+    """Yields (offset, length, data) of every bz2 stream of a file"""
+    offset = 0  # Of the current stream
+    read = 0
+    decompressor = bz2.BZ2Decompressor()
+    parts = []
+    size = 0
+    pending = b""
+    while True:
+        if not pending:
+            pending = f.read(READ_SIZE)
+            if not pending:
+                break
+            read += len(pending)
+        data = decompressor.decompress(pending)
+        parts.append(data)
+        size += len(data)
+        if size > MAX_STREAM_SIZE:
+            raise ValueError("Not a multistream dump: stream at {:d} is larger than "
+                             "{:d} bytes".format(offset, MAX_STREAM_SIZE))
+        pending = b""
+        if decompressor.eof:
+            pending = decompressor.unused_data
+            end = read - len(pending)
+            yield offset, end - offset, b"".join(parts)
+            offset = end
+            decompressor = bz2.BZ2Decompressor()
+            parts = []
+            size = 0
+    if offset != read:
+        raise ParseError("Unexpected end of bz2 stream at {:d}".format(offset))
+
+
+def parse_header(raw):
+    """(page id, ns, title) from the raw bytes of a page"""
+    header_end = raw.find(rawpages.REVISION_START)
+    if header_end == -1:
+        header_end = len(raw)
+    header = raw[:header_end]
+    page_id = rawpages.HEADER_ID_PATTERN.search(header)
+    ns = rawpages.HEADER_NS_PATTERN.search(header)
+    title = rawpages.HEADER_TITLE_PATTERN.search(header)
+    if not (page_id and ns and title):
+        raise ParseError("Page without id, ns or title: {!r}".format(header[:200]))
+    return (int(page_id.group(1)), int(ns.group(1)),
+            html.unescape(title.group(1).decode("utf-8")))
+
+
+def iter_plain_entries(f):
+    """Yields the IndexEntry of every page of an uncompressed dump"""
+    for start, end, raw in rawpages.iter_pages(f):
+        yield IndexEntry(*parse_header(raw), start, end - start, 0, end - start)
+
+
+def iter_multistream_entries(f):
+    """Yields the IndexEntry of every page of a bz2 multistream dump"""
+    for offset, length, data in iter_streams(f):
+        for start, end, raw in rawpages.iter_pages(io.BytesIO(data)):
+            yield IndexEntry(*parse_header(raw), offset, length, start, end - start)
+
+
+def iter_records(entries, titles_file):
+    """Yields the record of every IndexEntry, in the order of entries, and
+    appends its title to titles_file"""
+    title_offset = 0
+    for entry in entries:
+        title = entry.title.encode("utf-8")
+        titles_file.write(title)
+        yield (entry.page_id, entry.ns, entry.offset, entry.length,
+               entry.page_offset, entry.page_length, title_offset, len(title))
+        title_offset += len(title)
+
+
+def pack_record(record):
+    return RECORD.pack(*record)
+
+
+def read_record(f):
+    data = f.read(RECORD.size)
+    return RECORD.unpack(data) if data else None
+
+
+def pack_title(item):
+    title, n = item
+    return TITLE_RUN.pack(n, len(title)) + title
+
+
+def read_title(f):
+    data = f.read(TITLE_RUN.size)
+    if not data:
+        return None
+    n, length = TITLE_RUN.unpack(data)
+    return f.read(length), n
+
+
+def spill_runs(items, key, pack, directory):
+    """Sort items in runs of SORT_RUN_SIZE, each written with pack() to a
+    temporary file in directory. Returns (files, number of items), the
+    files rewound."""
+    items = iter(items)
+    runs = []
+    count = 0
+    while True:
+        run = list(itertools.islice(items, SORT_RUN_SIZE))
+        if not run:
+            return runs, count
+        run.sort(key=key)
+        f = tempfile.TemporaryFile(dir=directory)
+        f.writelines(map(pack, run))
+        f.seek(0)
+        runs.append(f)
+        count += len(run)
+
+
+def merge_runs(runs, key, read):
+    """Yields the items of the runs written by spill_runs in order, read(f)
+    returns the next item of f or None. The files are closed at the end."""
+    try:
+        yield from heapq.merge(
+            *(iter(functools.partial(read, f), None) for f in runs), key=key)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def build_index(dump_file, index_file):
+    """Index all pages of dump_file, returns the number of pages"""
+    directory = os.path.dirname(os.path.abspath(index_file))
+    # Titles in dump order, records point into it
+    titles_file = tempfile.TemporaryFile(dir=directory)
+    try:
+        with open(dump_file, "rb") as f:
+            dump_format = compression.detect_format(f)
+            if dump_format is None:
+                kind = KIND_PLAIN
+                entries = iter_plain_entries(f)
+            elif dump_format == compression.FORMAT_BZ2:
+                kind = KIND_MULTISTREAM
+                entries = iter_multistream_entries(f)
+            else:
+                raise ValueError("{} dumps cannot be indexed, decompress them first".format(
+                    dump_format))
+            record_runs, count = spill_runs(
+                iter_records(entries, titles_file), None, pack_record, directory)
+        titles_file.flush()
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(HEADER.pack(MAGIC, kind, count))
+
+            def iter_titles():
+                """Writes the records sorted by page id, yields their
+                (title, record number)"""
+                for n, record in enumerate(merge_runs(record_runs, None, read_record)):
+                    f.write(pack_record(record))
+                    yield os.pread(titles_file.fileno(), record[7], record[6]), n
+
+            # Record numbers sorted by title
+            title_runs, __ = spill_runs(
+                iter_titles(), operator.itemgetter(0), pack_title, directory)
+            for __, n in merge_runs(title_runs, operator.itemgetter(0), read_title):
+                f.write(TITLE_ORDER.pack(n))
+            titles_file.seek(0)
+            shutil.copyfileobj(titles_file, f)
+    finally:
+        titles_file.close()
+    os.replace(tmp_file, index_file)
+    return count
+
+
+class PageIndex:
+
+    """An index file written by build_index, for lookups by title and id"""
+
+    def __init__(self, index_file):
+        with open(index_file, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.kind, self.count = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ParseError("Not a page index: " + index_file)
+        self.records_offset = HEADER.size
+        self.title_order_offset = self.records_offset + self.count * RECORD.size
+        self.titles_offset = self.title_order_offset + self.count * TITLE_ORDER.size
+
+    def __len__(self):
+        return self.count
+
+    def record(self, n):
+        return RECORD.unpack_from(self.mmap, self.records_offset + n * RECORD.size)
+
+    def title_bytes(self, record):
+        start = self.titles_offset + record[6]
+        return self.mmap[start:start + record[7]]
+
+    def entry(self, n):
+        record = self.record(n)
+        return IndexEntry(record[0], record[1], self.title_bytes(record).decode("utf-8"),
+                          *record[2:6])
+
+    def find_id(self, page_id):
+        """The IndexEntry of page_id, or None"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < page_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.record(lo)[0] == page_id:
+            return self.entry(lo)
+        return None
+
+    def find_title(self, title):
+        """The IndexEntry of title, or None"""
+        title = normalize_title(title).encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            n, = TITLE_ORDER.unpack_from(
+                self.mmap, self.title_order_offset + mid * TITLE_ORDER.size)
+            if self.title_bytes(self.record(n)) < title:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            n, = TITLE_ORDER.unpack_from(
+                self.mmap, self.title_order_offset + lo * TITLE_ORDER.size)
+            if self.title_bytes(self.record(n)) == title:
+                return self.entry(n)
+        return None
+
+    def __iter__(self):
+        """All entries, by page id"""
+        for n in range(self.count):
+            yield self.entry(n)
+
+    def close(self):
+        self.mmap.close()
+
+
+class IndexedDump:
+
+    """Random access to the pages of a dump through its PageIndex"""
+
+    def __init__(self, dump_file, index_file):
+        self.dump_file = dump_file
+        self.index = PageIndex(index_file)
+        with open(dump_file, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.streams = collections.OrderedDict()  # LRU of decompressed streams
+
+    def open_header(self):
+        """Binary stream starting with the <mediawiki> header and <siteinfo>
+        of the dump"""
+        if self.index.kind == KIND_PLAIN:
+            return open(self.dump_file, "rb")
+        with open(self.dump_file, "rb") as f:
+            for __, __, data in iter_streams(f):
+                return io.BytesIO(data)
+
+    def find(self, title=None, page_id=None):
+        if page_id is not None:
+            return self.index.find_id(int(page_id))
+        return self.index.find_title(title)
+
+    def read_stream(self, offset, length):
+        key = offset
+        data = self.streams.get(key)
+        if data is None:
+            data = bz2.decompress(self.mmap[offset:offset + length])
+            self.streams[key] = data
+            if len(self.streams) > STREAM_CACHE_SIZE:
+                self.streams.popitem(last=False)
+        else:
+            self.streams.move_to_end(key)
+        return data
+
+    def get_raw(self, entry):
+        """The raw bytes of the <page> node of an IndexEntry"""
+        if self.index.kind == KIND_PLAIN:
+            return self.mmap[entry.offset:entry.offset + entry.length]
+        data = self.read_stream(entry.offset, entry.length)
+        return data[entry.page_offset:entry.page_offset + entry.page_length]
+
+    def iter_raw(self, titles=(), page_ids=()):
+        """Yields (entry, raw) of the pages with titles or page_ids that
+        exist, in dump order. Missing pages are logged."""
+        entries = {}
+        for title in titles:
+            entry = self.find(title=title)
+            if entry is None:
+                settings.logger.warning("Not in the page index: %s", title)
+            else:
+                entries[entry.page_id] = entry
+        for page_id in page_ids:
+            entry = self.find(page_id=page_id)
+            if entry is None:
+                settings.logger.warning("Not in the page index: page id %s", page_id)
+            else:
+                entries[entry.page_id] = entry
+        for entry in sorted(entries.values(),
+                            key=lambda entry: (entry.offset, entry.page_offset)):
+            yield entry, self.get_raw(entry)
+
+    def close(self):
+        self.index.close()
+        self.mmap.close()
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    if arguments["--title"] or arguments["--id"]:
+        dump = IndexedDump(arguments["DUMP"], arguments["INDEX"])
+        for __, raw in dump.iter_raw(arguments["--title"], arguments["--id"]):
+            sys.stdout.buffer.write(raw + b"\n")
+        dump.close()
+    else:
+        pages = build_index(arguments["DUMP"], arguments["INDEX"])
+        settings.logger.info("Indexed {} pages".format(pages))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent record of the revision of every page handled, for incremental
+runs over the next dump.
+
+An SQLite database keeps the page id, the id of the last revision and its
+SHA-1 of every page that has been handled. In the next run, pages whose
+revision id and SHA-1 are unchanged are skipped before they are parsed, so
+a monthly dump costs about as much as the pages that changed since the last
+one. Both values are read from the raw bytes of the page with a few regular
+expression searches.
+
+Pages are recorded once they have been handled, so an interrupted run
+handles the rest of the pages again, however it is resumed. Parsers that
+start jobs for a page, like the downloads of imagedownloader, record it
+through PendingPages once all of its jobs have succeeded.
+"""
+import os
+import sqlite3
+import threading
+
+from . import metrics
+from .page import ID_PATTERN
+from .page import SHA1_PATTERN
+from .rawpages import HEADER_ID_PATTERN
+from .rawpages import REVISION_START
+
+# Records written before they are committed
+COMMIT_INTERVAL = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    revision_id INTEGER,
+    sha1 TEXT
+)
+"""
+
+
+def read_key(raw):
+    """(page id, revision id, sha1) of the last revision in the raw bytes
+    of a page, or None for a page without id. The revision id is the first
+    <id> of the revision, the id of the contributor comes later."""
+    revision_start = raw.rfind(REVISION_START)
+    header_end = raw.find(REVISION_START) if revision_start != -1 else len(raw)
+    page_id = HEADER_ID_PATTERN.search(raw, 0, header_end)
+    if page_id is None:
+        return None
+    if revision_start == -1:
+        return int(page_id.group(1)), None, None
+    revision_id = ID_PATTERN.search(raw, revision_start)
+    sha1 = SHA1_PATTERN.search(raw, revision_start)
+    return (int(page_id.group(1)),
+            int(revision_id.group(1)) if revision_id else None,
+            sha1.group(1).decode("ascii") if sha1 else None)
+
+
+class PageState:
+
+    def __init__(self, path, commit_interval=COMMIT_INTERVAL):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o755, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Worker processes of multistream mode read while the main process
+        # writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def is_unchanged(self, key):
+        """True if key, from read_key(), has been recorded with the same
+        revision id and sha1"""
+        if key is None or key[1] is None:
+            return False
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT revision_id, sha1 FROM pages WHERE id = ?", (key[0],)).fetchone()
+        return row is not None and row == (key[1], key[2])
+
+    def add(self, keys):
+        """Record the keys of handled pages"""
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pages (id, revision_id, sha1) VALUES (?, ?, ?)",
+                keys)
+            self.uncommitted += len(keys)
+            if self.uncommitted >= self.commit_interval:
+                self._commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.connection.close()
+
+
+class PendingPages:
+
+    """
+    Keys of handled pages waiting for the jobs they started, or found running
+    already, to end. A page is added to the PageState once all of them have
+    succeeded and left out if one has failed, so the next run handles it
+    again.
+
+    Jobs are named, e.g. by file name, and a name runs at most once per run.
+    start() and depend() collect the jobs of the pages being handled, until
+    add() is called with their keys. end() is called once per started job,
+    from any thread.
+    """
+
+    def __init__(self, page_state):
+        self.page_state = page_state
+        self.lock = threading.Lock()
+        self.running = set()
+        self.failed = set()  # Jobs that have failed in this run
+        self.jobs = set()  # Jobs of the pages being handled
+        # Job name -> groups of [keys, jobs left] waiting for it
+        self.waiting = {}
+
+    def start(self, name):
+        """A job is started for the pages being handled, call it before the
+        job can end"""
+        with self.lock:
+            self.running.add(name)
+            self.jobs.add(name)
+
+    def depend(self, name):
+        """The pages being handled need a job that has been started before,
+        in this run or in an earlier one"""
+        with self.lock:
+            self.jobs.add(name)
+
+    def add(self, keys):
+        """The pages with keys have been handled, with the jobs collected
+        since the last call"""
+        with self.lock:
+            jobs, self.jobs = self.jobs, set()
+            if jobs & self.failed:
+                metrics.incr("pages_failed", len(keys))
+                return
+            jobs &= self.running
+            if jobs:
+                group = [keys, jobs]
+                for name in jobs:
+                    self.waiting.setdefault(name, []).append(group)
+                return
+        self.page_state.add(keys)
+
+    def end(self, name, ok=True):
+        """A started job has ended, successfully or not"""
+        done = []
+        with self.lock:
+            self.running.discard(name)
+            if not ok:
+                self.failed.add(name)
+            for group in self.waiting.pop(name, ()):
+                keys, jobs = group
+                if not jobs:
+                    # Dropped when another job of it failed
+                    continue
+                if not ok:
+                    metrics.incr("pages_failed", len(keys))
+                    jobs.clear()
+                else:
+                    jobs.discard(name)
+                    if jobs:
+                        continue
+                    done.extend(keys)
+        self.page_state.add(done)
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+=================================
+python-mwdump-tools - pagestore
+=================================
+
+Converts a dump once into a page store, so repeated jobs over the same pages
+don't pay for parsing XML again. A page store is a directory of shards of
+SHARD_PAGES pages and a store.json listing them. Shards are columnar: each
+column of a group of pages is compressed on its own, and readers only read
+and decompress the columns they ask for, so a job that needs titles never
+reads the texts.
+
+Columns are id, ns, title, redirect and revision_id, timestamp, sha1 and text
+of the last revision of each page.
+
+Pages are stored in dump order. With --index, the bz2 streams are parsed in
+parallel and their pages are stored in the order the streams finish, so the
+order of the pages is not defined, within shards or across them. Sort by id
+when reading if the order matters; a shard is not sorted when written, as
+that would keep all of its texts in memory.
+
+Formats:
+
+columnar  Built in: per row group and column a zlib compressed block of
+          length prefixed values, with an index of the blocks at the end of
+          the file
+parquet   Parquet files with zstd compressed columns, needs pyarrow
+
+Example:
+  pagestore --in-file=dump.xml.bz2 --pipeline pages/
+  pagestore --read --columns=id,title pages/
+
+In Python, PageStore(path).iter_pages(columns=["title"]) yields page.Page
+objects that can be passed to the handle_page of a parser, with the columns
+that were not read set to None.
+
+Usage:
+  pagestore [--in-file=FILE]
+            [--decompress-processes=N]
+            [--format=FORMAT]
+            [--shard-pages=N]
+            [--namespaces=NS]...
+            [--engine=ENGINE]
+            [--index=FILE]
+            [--parse-processes=N]
+            [--pipeline]
+            [--batch-size=N]
+            OUTPUT
+  pagestore --read [--columns=COLUMNS] OUTPUT
+  pagestore (-h | --help)
+  pagestore --version
+
+Options:
+  -h --help          Show this screen.
+  --version          Show version.
+  --in-file=FILE     Read the dump from FILE instead of STDIN
+  --decompress-processes=N  Number of processes decompressing a bz2 dump
+                     (defaults to the number of CPU cores)
+  --format=FORMAT    "columnar" or "parquet" [default: columnar]
+  --shard-pages=N    Pages per shard [default: 100000]
+  --namespaces=NS    Only store pages in these namespaces (default: all)
+  --engine=ENGINE    How <page> nodes are parsed, "lines" or "pull"
+                     [default: pull]
+  --index=FILE       Parse a *-pages-articles-multistream.xml.bz2 dump given
+                     by --in-file in parallel, using the offsets of its
+                     *-multistream-index.txt.bz2 companion file. Pages are
+                     not stored in dump order.
+  --parse-processes=N  Number of processes parsing multistream chunks or
+                     pipeline batches
+                     (defaults to the number of CPU cores)
+  --pipeline         Parse pages in --parse-processes worker processes
+  --batch-size=N     Pages sent to a worker process at a time [default: 100]
+  --read             Write the pages of the store OUTPUT to STDOUT as tab
+                     separated values
+  --columns=COLUMNS  Comma separated columns to read [default: id,ns,title]
+"""
+import json
+import os
+import struct
+import sys
+import traceback
+import zlib
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from docopt import docopt
+
+from . import VERSION
+from . import imagetable
+from . import rawpages
+from . import settings
+from . import streamparser
+from .exceptions import ParseError
+from .page import Page, Revision
+
+FORMAT_COLUMNAR = "columnar"
+FORMAT_PARQUET = "parquet"
+
+# Column name -> type
+COLUMNS = (
+    ("id", int),
+    ("ns", int),
+    ("title", str),
+    ("redirect", str),
+    ("revision_id", int),
+    ("timestamp", str),
+    ("sha1", str),
+    ("text", str),
+)
+COLUMN_NAMES = tuple(name for name, __ in COLUMNS)
+COLUMN_TYPES = dict(COLUMNS)
+
+STORE_FILENAME = "store.json"
+
+SHARD_PAGES = 100000
+# Pages per group of column blocks
+ROW_GROUP_PAGES = 1000
+
+COMPRESSION_LEVEL = 6
+
+COLUMNAR_MAGIC = b"MWCOL01\n"
+# Length of the footer, followed by the magic again
+COLUMNAR_TRAILER = struct.Struct("<Q")
+VALUE_LENGTH = struct.Struct("<I")
+NULL_LENGTH = 0xFFFFFFFF
+
+PARQUET_COMPRESSION = "zstd"
+
+
+def page_row(page):
+    """The values of COLUMNS of a page.Page"""
+    revision = page.revision
+    if revision is None:
+        return (page.id, page.ns, page.title, page.redirect, None, None, None, None)
+    return (page.id, page.ns, page.title, page.redirect,
+            revision.id, revision.timestamp, revision.sha1, revision.text)
+
+
+def row_page(row):
+    """A page.Page of a dict of (some of the) COLUMNS"""
+    get = row.get
+    return Page(
+        id=get("id"),
+        ns=get("ns"),
+        title=get("title"),
+        redirect=get("redirect"),
+        revisions=[Revision(
+            id=get("revision_id"),
+            timestamp=get("timestamp"),
+            sha1=get("sha1"),
+            text=get("text"),
+        )],
+    )
+
+
+def encode_column(values):
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(VALUE_LENGTH.pack(NULL_LENGTH))
+            continue
+        data = str(value).encode("utf-8")
+        parts.append(VALUE_LENGTH.pack(len(data)))
+        parts.append(data)
+    return zlib.compress(b"".join(parts), COMPRESSION_LEVEL)
+
+
+def decode_column(block, column_type, rows):
+    data = zlib.decompress(block)
+    values = []
+    pos = 0
+    for __ in range(rows):
+        length, = VALUE_LENGTH.unpack_from(data, pos)
+        pos += VALUE_LENGTH.size
+        if length == NULL_LENGTH:
+            values.append(None)
+            continue
+        value = data[pos:pos + length].decode("utf-8")
+        pos += length
+        values.append(int(value) if column_type is int else value)
+    return values
+
+
+class ShardWriter:
+
+    """Base class, rows of COLUMNS are passed to write() and close() writes
+    what is left"""
+
+    def __init__(self, path, row_group_pages=ROW_GROUP_PAGES):
+        self.path = path
+        self.row_group_pages = row_group_pages
+        self.rows = []
+        self.pages = 0
+
+    def write(self, row):
+        self.rows.append(row)
+        self.pages += 1
+        if len(self.rows) >= self.row_group_pages:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write_columns(list(zip(*self.rows)), len(self.rows))
+            self.rows = []
+
+    def write_columns(self, columns, rows):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+
+class ColumnarWriter(ShardWriter):
+
+    def __init__(self, path, row_group_pages=ROW_GROUP_PAGES):
+        ShardWriter.__init__(self, path, row_group_pages)
+        self.f = open(path, "wb")
+        self.f.write(COLUMNAR_MAGIC)
+        self.row_groups = []
+
+    def write_columns(self, columns, rows):
+        blocks = {}
+        for name, values in zip(COLUMN_NAMES, columns):
+            block = encode_column(values)
+            blocks[name] = (self.f.tell(), len(block))
+            self.f.write(block)
+        self.row_groups.append({"rows": rows, "columns": blocks})
+
+    def close(self):
+        ShardWriter.close(self)
+        footer = json.dumps({
+            "columns": COLUMN_NAMES,
+            "row_groups": self.row_groups,
+        }).encode("utf-8")
+        self.f.write(footer)
+        self.f.write(COLUMNAR_TRAILER.pack(len(footer)))
+        self.f.write(COLUMNAR_MAGIC)
+        self.f.close()
+
+
+class ParquetWriter(ShardWriter):
+
+    def __init__(self, path, row_group_pages=ROW_GROUP_PAGES):
+        if pyarrow is None:
+            raise ImportError("The parquet format needs the pyarrow package")
+        ShardWriter.__init__(self, path, row_group_pages)
+        self.schema = pyarrow.schema([
+            (name, pyarrow.int64() if column_type is int else pyarrow.string())
+            for name, column_type in COLUMNS])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression=PARQUET_COMPRESSION)
+
+    def write_columns(self, columns, rows):
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type)
+             for values, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        ShardWriter.close(self)
+        self.writer.close()
+
+
+def iter_columnar(path, columns):
+    """Yields the rows of a columnar shard as dicts of columns"""
+    with open(path, "rb") as f:
+        f.seek(-(COLUMNAR_TRAILER.size + len(COLUMNAR_MAGIC)), os.SEEK_END)
+        footer_length, = COLUMNAR_TRAILER.unpack(f.read(COLUMNAR_TRAILER.size))
+        if f.read() != COLUMNAR_MAGIC:
+            raise ParseError("Not a columnar shard: " + path)
+        f.seek(-(footer_length + COLUMNAR_TRAILER.size + len(COLUMNAR_MAGIC)), os.SEEK_END)
+        footer = json.loads(f.read(footer_length).decode("utf-8"))
+        for row_group in footer["row_groups"]:
+            values = []
+            for name in columns:
+                offset, length = row_group["columns"][name]
+                f.seek(offset)
+                values.append(decode_column(
+                    f.read(length), COLUMN_TYPES[name], row_group["rows"]))
+            for row in zip(*values):
+                yield dict(zip(columns, row))
+
+
+def iter_parquet(path, columns):
+    """Yields the rows of a parquet shard as dicts of columns"""
+    if pyarrow is None:
+        raise ImportError("The parquet format needs the pyarrow package")
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(columns=list(columns)):
+        yield from batch.to_pylist()
+
+
+# Format -> (file name extension, writer class, reader function)
+FORMATS = {
+    FORMAT_COLUMNAR: (".mwcol", ColumnarWriter, iter_columnar),
+    FORMAT_PARQUET: (".parquet", ParquetWriter, iter_parquet),
+}
+
+
+def get_format(store_format):
+    try:
+        return FORMATS[store_format]
+    except KeyError:
+        raise ValueError("Unknown page store format {!r}, expected one of {}".format(
+            store_format, ", ".join(sorted(FORMATS))))
+
+
+class PageStoreWriter:
+
+    """Writes rows to shards of shard_pages pages in directory path, and
+    store.json once closed"""
+
+    def __init__(self, path, store_format=FORMAT_COLUMNAR, shard_pages=SHARD_PAGES,
+                 row_group_pages=ROW_GROUP_PAGES):
+        self.path = path
+        self.store_format = store_format
+        self.extension, self.writer_class, __ = get_format(store_format)
+        self.shard_pages = int(shard_pages)
+        self.row_group_pages = int(row_group_pages)
+        self.shards = []
+        self.writer = None
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, row):
+        if self.writer is None:
+            filename = "pages-{:05d}{}".format(len(self.shards), self.extension)
+            self.writer = self.writer_class(
+                os.path.join(self.path, filename), self.row_group_pages)
+        self.writer.write(row)
+        if self.writer.pages >= self.shard_pages:
+            self.close_shard()
+
+    def close_shard(self):
+        self.writer.close()
+        self.shards.append({
+            "file": os.path.basename(self.writer.path),
+            "pages": self.writer.pages,
+        })
+        self.writer = None
+
+    def close(self):
+        if self.writer is not None:
+            self.close_shard()
+        tmp_file = os.path.join(self.path, STORE_FILENAME + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({
+                "format": self.store_format,
+                "columns": COLUMN_NAMES,
+                "pages": sum(shard["pages"] for shard in self.shards),
+                "shards": self.shards,
+            }, f, indent=1)
+        os.replace(tmp_file, os.path.join(self.path, STORE_FILENAME))
+
+
+class PageStore:
+
+    """Reads a page store written by PageStoreWriter"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, STORE_FILENAME)) as f:
+            self.info = json.load(f)
+        __, __, self.reader = get_format(self.info["format"])
+        self.shards = self.info["shards"]
+
+    def __len__(self):
+        return self.info["pages"]
+
+    def iter_rows(self, columns=None, shards=None):
+        """Yields dicts with the given columns (all by default) of every page,
+        from all shards or the shards with the given numbers, in the order
+        they were written"""
+        columns = tuple(columns or COLUMN_NAMES)
+        for name in columns:
+            if name not in COLUMN_TYPES:
+                raise ValueError("Unknown column {!r}, expected some of {}".format(
+                    name, ", ".join(COLUMN_NAMES)))
+        for n, shard in enumerate(self.shards):
+            if shards is None or n in shards:
+                yield from self.reader(os.path.join(self.path, shard["file"]), columns)
+
+    def iter_pages(self, columns=None, shards=None):
+        """Yields a page.Page of every page, with the columns that were not
+        read set to None"""
+        for row in self.iter_rows(columns, shards):
+            yield row_page(row)
+
+
+class PageExporter(streamparser.XmlStreamParser):
+
+    def __init__(self, output, in_file=None, format=FORMAT_COLUMNAR,
+                 shard_pages=SHARD_PAGES, namespaces=None, **kwargs):
+        self.output = output
+        self.store_format = format
+        get_format(format)
+        self.shard_pages = int(shard_pages)
+        self.namespaces = namespaces or None
+        if self.namespaces:
+            kwargs.setdefault(
+                "page_filter", rawpages.PageFilter(namespaces=self.namespaces))
+        streamparser.XmlStreamParser.__init__(self, in_file=in_file, **kwargs)
+        # Opened by execute(), not in the worker processes
+        self.writer = None
+
+    def get_worker_kwargs(self):
+        kwargs = streamparser.XmlStreamParser.get_worker_kwargs(self)
+        kwargs.update(
+            output=self.output,
+            format=self.store_format,
+            shard_pages=self.shard_pages,
+            namespaces=self.namespaces,
+        )
+        return kwargs
+
+    def execute(self):
+        self.writer = PageStoreWriter(self.output, self.store_format, self.shard_pages)
+        streamparser.XmlStreamParser.execute(self)
+        self.writer.close()
+
+    def handle_page(self, page):
+        self.handle_result(self.process_page(page))
+
+    def process_page(self, page):
+        return page_row(page)
+
+    def handle_result(self, row):
+        self.writer.write(row)
+
+
+def write_tsv(store, columns, stream):
+    stream.write("\t".join(columns) + "\n")
+    for row in store.iter_rows(columns):
+        stream.write("\t".join(
+            "" if row[name] is None else str(row[name]).translate(imagetable.TSV_ESCAPES)
+            for name in columns) + "\n")
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__, version='python-mw-tools pagestore ' + str(VERSION))
+    output = arguments.pop("OUTPUT")
+    if arguments.pop("--read"):
+        write_tsv(PageStore(output), arguments["--columns"].split(","), sys.stdout)
+        sys.exit(0)
+    arguments.pop("--columns")
+    arguments = dict((k.replace("--", "").replace("-", "_"), v) for k, v in arguments.items())
+    arguments = dict(
+        filter(lambda kv: not kv[1] is None, [(k, v) for k, v in arguments.items()]))
+    p = PageExporter(output, **arguments)
+    try:
+        p.execute()
+    except Exception as e:
+        settings.logger.error("Failed to export, page: {}".format(p.pages_processed))
+        settings.logger.error(e)
+        settings.logger.debug(traceback.print_tb(sys.exc_info()[2]))
+        sys.exit(1)
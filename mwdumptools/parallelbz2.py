@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Decompressing a bz2 file with several processes.
+
+A bz2 file is a sequence of streams (one, or one per ~100 pages in
+multistream dumps), and every stream a sequence of blocks of at most 900 kB
+of uncompressed data. Blocks are compressed independently of each other, so
+they can be decompressed independently too, like pbzip2 and lbzip2 do.
+
+Blocks are not byte aligned. Each starts with the 48 bit magic number
+0x314159265359 at any bit position, and the last block of a stream is
+followed by the end of stream magic 0x177245385090 and the CRC of the stream.
+The reader scans the compressed data for both magic numbers, cuts out the
+bits of every block and sends them to a worker process. The worker turns the
+block into a stream of its own, by prepending a stream header and appending
+an end of stream marker with the CRC of the block, and decompresses it.
+
+The magic numbers may also occur by chance inside compressed data. A block
+that fails to decompress is merged with the next one and decompressed again.
+A file that doesn't end with an end of stream magic and its CRC has been
+truncated, which raises EOFError like bz2 does, after the blocks before.
+
+The output is returned in order. At most window blocks are decompressed
+ahead of the reader, which bounds the memory used.
+"""
+import bz2
+import collections
+import concurrent.futures
+import io
+import os
+
+BLOCK_MAGIC = 0x314159265359
+END_OF_STREAM_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+CRC_BITS = 32
+
+# The block size of the header only limits the size of the blocks that
+# follow, 9 allows any block
+STREAM_HEADER = b"BZh9"
+
+# Compressed bytes read at a time
+READ_SIZE = 1024 * 1024
+
+# Blocks decompressed ahead of the reader per process
+BLOCKS_PER_PROCESS = 2
+
+# The 7 bytes holding a magic number that starts at bit shift of the first
+MAGIC_WINDOW = 7
+
+TRUNCATED_MESSAGE = "Compressed file ended before the end-of-stream marker was reached"
+
+
+def _magic_needles(magic):
+    """For each bit shift 0-7 of magic within a 7 byte window, returns
+    (shift, first byte, bytes fully covered by magic). A match of those bytes
+    is a candidate, which is then checked bit by bit."""
+    needles = []
+    for shift in range(8):
+        window = (magic << (MAGIC_WINDOW * 8 - MAGIC_BITS - shift)).to_bytes(
+            MAGIC_WINDOW, "big")
+        first = 1 if shift else 0
+        last = (shift + MAGIC_BITS) // 8
+        needles.append((shift, first, window[first:last]))
+    return needles
+
+
+BLOCK_NEEDLES = _magic_needles(BLOCK_MAGIC)
+END_OF_STREAM_NEEDLES = _magic_needles(END_OF_STREAM_MAGIC)
+
+
+def find_magic(data, magic, needles, start=0):
+    """Sorted bit offsets in data of every magic at or after byte start.
+    Magics in the last 6 bytes of data may be missed."""
+    mask = (1 << MAGIC_BITS) - 1
+    found = []
+    for shift, first, needle in needles:
+        pos = data.find(needle, start + first)
+        while pos != -1:
+            window = pos - first
+            if window + MAGIC_WINDOW <= len(data):
+                value = int.from_bytes(data[window:window + MAGIC_WINDOW], "big")
+                if (value >> (MAGIC_WINDOW * 8 - MAGIC_BITS - shift)) & mask == magic:
+                    found.append(window * 8 + shift)
+            pos = data.find(needle, pos + 1)
+    found.sort()
+    return found
+
+
+def decompress_block(data, start, length):
+    """Decompress the block of length bits starting at bit start of data,
+    runs in the worker processes"""
+    value = int.from_bytes(data, "big")
+    block = (value >> (len(data) * 8 - start - length)) & ((1 << length) - 1)
+    # The CRC of the block follows its magic, and is the CRC of a stream
+    # with only this block
+    crc = (block >> (length - MAGIC_BITS - CRC_BITS)) & ((1 << CRC_BITS) - 1)
+    stream = (((block << MAGIC_BITS) | END_OF_STREAM_MAGIC) << CRC_BITS) | crc
+    bits = length + MAGIC_BITS + CRC_BITS
+    padding = -bits % 8
+    return bz2.decompress(
+        STREAM_HEADER + (stream << padding).to_bytes((bits + padding) // 8, "big"))
+
+
+class Block:
+
+    """The bits from one magic number to the next, cut from the compressed
+    data. Pieces starting with an end of stream magic are the gaps between
+    streams, which are not decompressed but kept for merging. A truncated
+    piece stands for the end of a file that has been cut off."""
+
+    __slots__ = ("data", "start", "length", "is_block", "truncated", "future")
+
+    def __init__(self, data, start, length, is_block=True, truncated=False):
+        self.data = data  # Bytes holding the block
+        self.start = start  # Bit offset of the block in data
+        self.length = length  # Bits
+        self.is_block = is_block
+        self.truncated = truncated
+        self.future = None
+
+    def merge(self, other):
+        """The block of self followed by other, which starts in the byte
+        where self ends"""
+        end = (self.start + self.length) // 8
+        return Block(self.data[:end] + other.data, self.start,
+                     self.length + other.length)
+
+
+class ParallelBz2Reader(io.RawIOBase):
+
+    """
+    Reads the decompressed data of a bz2 compressed binary stream. Wrap it
+    in an io.BufferedReader for readline().
+
+    The process pool is only started by the first read.
+    """
+
+    def __init__(self, stream, processes=None, window=None):
+        self.stream = stream
+        self.processes = processes or os.cpu_count() or 1
+        self.window = window or self.processes * BLOCKS_PER_PROCESS
+        self.executor = None
+        self.buffer = b""  # Compressed data not cut into blocks yet
+        self.buffer_offset = 0  # Bit offset of the buffer in the stream
+        # (bit offset, is block magic) of the magics found in buffer
+        self.magics = collections.deque()
+        self.last_magic = -1
+        self.scanned = 0  # Bytes of buffer searched for magics
+        self.piece_start = None  # (bit offset, is block) of the next piece
+        self.eof = False
+        self.end = None  # Bit offset of the end of the stream, once read
+        self.cut_all = False  # The last piece has been cut
+        self.pending = collections.deque()  # Blocks being decompressed
+        self.output = b""
+        self.output_pos = 0
+
+    def readable(self):
+        return True
+
+    def fill_buffer(self):
+        """Read more compressed data, returns False at the end of stream"""
+        if self.eof:
+            return False
+        data = self.stream.read(READ_SIZE)
+        if not data:
+            self.eof = True
+            self.end = self.buffer_offset + len(self.buffer) * 8
+            # Magics at the very end are found once padded
+            data = b"\x00" * MAGIC_WINDOW
+        # Only keep what follows the start of the next piece
+        if self.piece_start is not None:
+            keep = (self.piece_start[0] - self.buffer_offset) // 8
+        else:
+            keep = max(self.scanned - MAGIC_WINDOW, 0)
+        self.buffer = self.buffer[keep:] + data
+        self.buffer_offset += keep * 8
+        self.scanned -= keep
+        # Search again from where a magic could have been cut off
+        start = max(self.scanned - MAGIC_WINDOW, 0)
+        magics = sorted(
+            [(offset, True) for offset in find_magic(
+                self.buffer, BLOCK_MAGIC, BLOCK_NEEDLES, start)] +
+            [(offset, False) for offset in find_magic(
+                self.buffer, END_OF_STREAM_MAGIC, END_OF_STREAM_NEEDLES, start)])
+        for offset, is_block in magics:
+            offset += self.buffer_offset
+            if offset > self.last_magic:
+                self.magics.append((offset, is_block))
+                self.last_magic = offset
+        self.scanned = len(self.buffer)
+        return True
+
+    def cut(self, end):
+        """The piece from piece_start to bit offset end"""
+        start, is_block = self.piece_start
+        first = (start - self.buffer_offset) // 8
+        last = (end - self.buffer_offset + 7) // 8
+        return Block(self.buffer[first:last], start - self.buffer_offset - first * 8,
+                     end - start, is_block)
+
+    def next_block(self):
+        """Cut out the next piece, or return None at the end of stream"""
+        while True:
+            if self.magics:
+                magic = self.magics.popleft()
+                piece = self.cut(magic[0]) if self.piece_start is not None else None
+                self.piece_start = magic
+                if piece is not None:
+                    return piece
+                continue
+            if not self.fill_buffer():
+                break
+        if self.cut_all:
+            return None
+        self.cut_all = True
+        # A complete file ends with an end of stream magic and its CRC
+        if self.piece_start is None:
+            complete = self.end == 0
+        else:
+            start, is_block = self.piece_start
+            complete = not is_block and self.end - start >= MAGIC_BITS + CRC_BITS
+            self.piece_start = None
+        if complete:
+            return None
+        return Block(b"", 0, 0, is_block=False, truncated=True)
+
+    def submit_blocks(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        while len(self.pending) < self.window:
+            block = self.next_block()
+            if block is None:
+                break
+            if block.is_block:
+                block.future = self.executor.submit(
+                    decompress_block, block.data, block.start, block.length)
+            self.pending.append(block)
+
+    def next_output(self):
+        """Decompressed data of the next block, or b"" at the end"""
+        self.submit_blocks()
+        block = None
+        while self.pending and block is None:
+            block = self.pending.popleft()
+            if block.truncated:
+                raise EOFError(TRUNCATED_MESSAGE)
+            if not block.is_block:
+                block = None
+                self.submit_blocks()
+        if block is None:
+            return b""
+        while True:
+            try:
+                return block.future.result()
+            except (OSError, ValueError, EOFError):
+                # A magic number occurring by chance in compressed data
+                if not self.pending:
+                    self.submit_blocks()
+                    if not self.pending:
+                        raise
+                if self.pending[0].truncated:
+                    raise EOFError(TRUNCATED_MESSAGE)
+                block = block.merge(self.pending.popleft())
+                block.future = self.executor.submit(
+                    decompress_block, block.data, block.start, block.length)
+
+    def readinto(self, b):
+        while self.output_pos >= len(self.output):
+            self.output = self.next_output()
+            self.output_pos = 0
+            if not self.output:
+                return 0
+        n = min(len(b), len(self.output) - self.output_pos)
+        b[:n] = self.output[self.output_pos:self.output_pos + n]
+        self.output_pos += n
+        return n
+
+    def close(self):
+        if self.executor is not None:
+            for block in self.pending:
+                if block.future is not None:
+                    block.future.cancel()
+            self.executor.shutdown()
+            self.executor = None
+        self.pending.clear()
+        self.stream.close()
+        io.RawIOBase.close(self)
+
+
+def open_parallel(stream, processes=None, buffer_size=READ_SIZE):
+    """Buffered binary stream of the decompressed data of stream"""
+    return io.BufferedReader(ParallelBz2Reader(stream, processes), buffer_size)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================
+python-mwdump-tools - patternmatcher
+=====================================
+
+Counts the occurrences of a list of Python regular expressions in the
+revision texts of a dump. Reads from STDIN.
+
+Example:
+  patternmatcher patterns.txt < tests/data/ngwiki-20130702-pages-articles-multistream.xml
+
+PATTERNS is a file with one regular expression per line, lines starting with
+# are skipped. Thousands of patterns are fine: the texts are scanned once for
+literal strings that the patterns need, and a pattern only runs on the texts
+that contain one of its literals.
+
+The output is tab separated: pattern number, namespace, pages with a match,
+number of matches and the pattern, one line per namespace with matches and a
+line with the namespace "all" for every pattern.
+
+With --coordinator, the dump is read from the shards planned in the
+coordinator file (see mwdumptools.shards), on as many machines as there are
+workers, and the counts of all shards are added up at the end.
+
+Usage:
+  patternmatcher [--in-file=FILE]
+                 [--out-file=FILE]
+                 [--namespaces=NS]...
+                 [--ignore-case]
+                 [--engine=ENGINE]
+                 [--index=FILE]
+                 [--decompress-processes=N]
+                 [--parse-processes=N]
+                 [--pipeline]
+                 [--batch-size=N]
+                 [--coordinator=FILE]
+                 [--worker-id=ID]
+                 [--lease=SECONDS]
+                 PATTERNS
+  patternmatcher (-h | --help)
+  patternmatcher --version
+
+Options:
+  -h --help          Show this screen.
+  --version          Show version.
+  --in-file=FILE     Read the dump from FILE instead of STDIN. bz2, gzip, xz
+                     and zstd compressed dumps are recognized, also on STDIN
+  --decompress-processes=N  Number of processes decompressing a bz2 dump
+                     (defaults to the number of CPU cores)
+  --out-file=FILE    Write the counts to FILE instead of STDOUT
+  --namespaces=NS    Only count in these namespaces (default: all)
+  --ignore-case      Match the patterns case insensitively
+  --engine=ENGINE    How <page> nodes are parsed, "lines" or "pull"
+                     [default: pull]
+  --index=FILE       Parse a *-pages-articles-multistream.xml.bz2 dump given
+                     by --in-file in parallel, using the offsets of its
+                     *-multistream-index.txt.bz2 companion file
+  --parse-processes=N  Number of processes matching multistream chunks or
+                     pipeline batches
+                     (defaults to the number of CPU cores)
+  --pipeline         Match in --parse-processes worker processes
+  --batch-size=N     Pages sent to a worker process at a time [default: 100]
+  --coordinator=FILE  Match the shards planned in FILE with mwdumptools.shards
+                     instead of --in-file, together with the workers on other
+                     machines. One of them writes the counts of all shards.
+  --worker-id=ID     Name of this worker in the coordinator file (defaults to
+                     the host name and process id)
+  --lease=SECONDS    A shard is issued again if its worker hasn't renewed its
+                     lease for this long [default: 300]
+"""
+import collections
+import io
+import re
+import sys
+import traceback
+
+from docopt import docopt
+
+from . import VERSION
+from . import patterns
+from . import rawpages
+from . import settings
+from . import shards
+from . import streamparser
+from .exceptions import ShardError
+
+# Namespace of the totals of a pattern
+ALL_NAMESPACES = "all"
+
+
+class PatternMatcher(streamparser.XmlStreamParser):
+
+    def __init__(self, patterns_list, in_file=None, namespaces=None,
+                 ignore_case=False, **kwargs):
+        self.patterns_list = list(patterns_list)
+        self.namespaces = namespaces or None
+        self.ignore_case = ignore_case
+        self.pattern_set = patterns.PatternSet(
+            self.patterns_list, re.IGNORECASE if ignore_case else 0)
+        if self.namespaces:
+            kwargs.setdefault(
+                "page_filter", rawpages.PageFilter(namespaces=self.namespaces))
+        streamparser.XmlStreamParser.__init__(self, in_file=in_file, **kwargs)
+        # (pattern index, namespace) -> count
+        self.matches = collections.Counter()
+        self.pages_matched = collections.Counter()
+
+    def get_worker_kwargs(self):
+        kwargs = streamparser.XmlStreamParser.get_worker_kwargs(self)
+        kwargs.update(
+            patterns_list=self.patterns_list,
+            namespaces=self.namespaces,
+            ignore_case=self.ignore_case,
+        )
+        return kwargs
+
+    def handle_page(self, page):
+        self.handle_result(self.process_page(page))
+
+    def process_page(self, page):
+        """Returns (namespace, {pattern index: matches}) of the patterns that
+        match any revision of the page, or None"""
+        counts = collections.Counter()
+        for revision in page.revisions:
+            text = revision.text
+            if text:
+                counts.update(self.pattern_set.count(text))
+        if not counts:
+            return None
+        return page.ns, dict(counts)
+
+    def handle_result(self, result):
+        if result is None:
+            return
+        ns, counts = result
+        for index, n in counts.items():
+            self.matches[index, ns] += n
+            self.pages_matched[index, ns] += 1
+
+    def iter_counts(self):
+        """Yields (pattern index, namespace, pages, matches), per namespace
+        and for all namespaces"""
+        by_pattern = collections.defaultdict(list)
+        for index, ns in self.matches:
+            by_pattern[index].append(ns)
+        for index in range(len(self.patterns_list)):
+            pages = matches = 0
+            for ns in sorted(by_pattern[index]):
+                yield index, ns, self.pages_matched[index, ns], self.matches[index, ns]
+                pages += self.pages_matched[index, ns]
+                matches += self.matches[index, ns]
+            yield index, ALL_NAMESPACES, pages, matches
+
+    def write_counts(self, stream):
+        stream.write("pattern\tnamespace\tpages\tmatches\tregex\n")
+        for index, ns, pages, matches in self.iter_counts():
+            stream.write("{:d}\t{}\t{:d}\t{:d}\t{}\n".format(
+                index, ns, pages, matches, self.patterns_list[index]))
+
+    def read_counts(self, path):
+        """Add the counts of a file written by write_counts, e.g. those of
+        another shard"""
+        with open(path, encoding="utf-8") as f:
+            next(f)  # Column names
+            for ln in f:
+                index, ns, pages, matches, __ = ln.split("\t", 4)
+                if ns == ALL_NAMESPACES:
+                    continue
+                self.matches[int(index), int(ns)] += int(matches)
+                self.pages_matched[int(index), int(ns)] += int(pages)
+
+
+def run_shards(patterns_list, coordinator_file, out_file=None, worker_id=None,
+               lease=shards.DEFAULT_LEASE, **kwargs):
+    """Count in the shards of coordinator_file until all are done, and write
+    the counts of all shards if this worker gets to merge them"""
+    kwargs.pop("in_file", None)
+    coordinator = shards.Coordinator(coordinator_file)
+
+    def process_shard(stream, output):
+        p = PatternMatcher(patterns_list, in_file=stream, **kwargs)
+        p.execute()
+        with open(output, "w", encoding="utf-8") as f:
+            p.write_counts(f)
+
+    def merge_outputs(paths):
+        merged = PatternMatcher(patterns_list, in_file=io.BytesIO(), **kwargs)
+        for path in paths:
+            merged.read_counts(path)
+        if out_file:
+            with open(out_file, "w", encoding="utf-8") as f:
+                merged.write_counts(f)
+        else:
+            merged.write_counts(sys.stdout)
+
+    try:
+        shards.run_worker(coordinator, process_shard, merge_outputs, worker_id, lease, ".tsv")
+    finally:
+        coordinator.close()
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__, version='python-mw-tools patternmatcher ' + str(VERSION))
+    patterns_file = arguments.pop("PATTERNS")
+    out_file = arguments.pop("--out-file")
+    coordinator_file = arguments.pop("--coordinator")
+    worker_id = arguments.pop("--worker-id")
+    lease = arguments.pop("--lease")
+    arguments = dict((k.replace("--", "").replace("-", "_"), v) for k, v in arguments.items())
+    arguments = dict(
+        filter(lambda kv: not kv[1] is None, [(k, v) for k, v in arguments.items()]))
+    if coordinator_file:
+        try:
+            run_shards(patterns.read_patterns(patterns_file), coordinator_file,
+                       out_file, worker_id, lease, **arguments)
+        except ShardError as e:
+            settings.logger.error(e)
+            sys.exit(1)
+        sys.exit(0)
+    p = PatternMatcher(patterns.read_patterns(patterns_file), **arguments)
+    try:
+        p.execute()
+    except Exception as e:
+        settings.logger.error("Failed to parse, {}".format(p.describe_position()))
+        settings.logger.error(e)
+        settings.logger.debug(traceback.print_tb(sys.exc_info()[2]))
+        sys.exit(1)
+    if out_file:
+        with open(out_file, "w", encoding="utf-8") as f:
+            p.write_counts(f)
+    else:
+        p.write_counts(sys.stdout)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================
+python-mwdump-tools - patternreplacer
+=====================================
+
+Applies a list of (search, replace) pairs of Python regular expressions to
+the revision texts of a dump and writes the rewritten dump. Reads from STDIN
+and writes to STDOUT.
+
+Example:
+  patternreplacer replacements.txt < mywiki.xml > mywiki-replaced.xml
+  patternreplacer --out-file=mywiki-replaced.xml.bz2 replacements.txt < mywiki.xml
+
+REPLACEMENTS is a file with a search pattern and a replacement, separated by
+a tab, per line. Replacements are re.sub() templates, so \\1 and \\g<name>
+refer to groups. Lines starting with # are skipped. The pairs are applied in
+order.
+
+Everything but the texts that change is copied byte for byte: pages are
+scanned for the literals of the search patterns in their raw bytes, pages
+without any are written as they are, and in the other pages only the changed
+<text> nodes are replaced, with their bytes="..." attribute and <sha1>
+updated. Rewriting a dump costs little more than copying it.
+
+With --coordinator, the dump is read from the shards planned in the
+coordinator file (see mwdumptools.shards), on as many machines as there are
+workers, and the rewritten shards are joined into one dump at the end.
+
+Usage:
+  patternreplacer [--in-file=FILE]
+                  [--out-file=FILE]
+                  [--decompress-processes=N]
+                  [--namespaces=NS]...
+                  [--ignore-case]
+                  [--coordinator=FILE]
+                  [--worker-id=ID]
+                  [--lease=SECONDS]
+                  REPLACEMENTS
+  patternreplacer (-h | --help)
+  patternreplacer --version
+
+Options:
+  -h --help          Show this screen.
+  --version          Show version.
+  --in-file=FILE     Read the dump from FILE instead of STDIN. bz2, gzip, xz
+                     and zstd compressed dumps are recognized, also on STDIN
+  --decompress-processes=N  Number of processes decompressing a bz2 dump
+                     (defaults to the number of CPU cores)
+  --out-file=FILE    Write the dump to FILE instead of STDOUT, compressed if
+                     FILE ends with .bz2, .gz or .xz
+  --namespaces=NS    Only replace in these namespaces (default: all)
+  --ignore-case      Match the search patterns case insensitively
+  --coordinator=FILE  Rewrite the shards planned in FILE with
+                     mwdumptools.shards instead of --in-file, together with
+                     the workers on other machines. One of them writes the
+                     whole dump.
+  --worker-id=ID     Name of this worker in the coordinator file (defaults to
+                     the host name and process id)
+  --lease=SECONDS    A shard is issued again if its worker hasn't renewed its
+                     lease for this long [default: 300]
+"""
+from datetime import datetime
+import re
+import sys
+import traceback
+
+from docopt import docopt
+
+from . import VERSION
+from . import compression
+from . import patterns
+from . import rawpages
+from . import settings
+from . import shards
+from . import streamparser
+from .exceptions import ShardError
+from .page import Page, REVISION_END, SHA1_PATTERN, escape, sha1_base36
+
+TEXT_TAG_START = b"<text"
+TEXT_BYTES_PATTERN = re.compile(rb'\bbytes="\d*"')
+
+
+def read_replacements(path):
+    """(search, replace) pairs, separated by the first tab of each line"""
+    replacements = []
+    for ln in patterns.read_patterns(path):
+        search, __, replace = ln.partition("\t")
+        replacements.append((search, replace))
+    return replacements
+
+
+class PatternReplacer(streamparser.XmlStreamParser):
+
+    def __init__(self, replacements, in_file=None, out_file=None,
+                 namespaces=None, ignore_case=False, **kwargs):
+        flags = re.IGNORECASE if ignore_case else 0
+        self.replacements = list(replacements)
+        self.searches = [re.compile(search, flags) for search, __ in self.replacements]
+        self.templates = [replace for __, replace in self.replacements]
+        search_patterns = [search for search, __ in self.replacements]
+        # Finds candidate texts in the raw bytes of pages
+        self.prefilter = patterns.PatternSet(search_patterns, flags, binary=True)
+        # Finds candidates again in texts that have been changed
+        self.pattern_set = patterns.PatternSet(search_patterns, flags)
+        self.namespace_filter = None
+        if namespaces:
+            self.namespace_filter = rawpages.PageFilter(namespaces=namespaces)
+        # Written by execute(), not by the parser
+        self.out_file = out_file
+        streamparser.XmlStreamParser.__init__(self, in_file=in_file, **kwargs)
+        self.pages_changed = 0
+        self.revisions_changed = 0
+
+    def execute(self):
+        self.started_on = datetime.now()
+        if self.out_file:
+            out = compression.open_output(self.out_file)
+        else:
+            out = sys.stdout.buffer
+        try:
+            for start, end, raw in rawpages.iter_pages(self._in_stream, between=out.write):
+                out.write(self.replace_page(raw))
+                self.offset = end
+                self.page_handled()
+        finally:
+            self.close()
+            if self.out_file:
+                out.close()
+            else:
+                out.flush()
+        settings.logger.info("Changed {} revisions in {} of {} pages".format(
+            self.revisions_changed, self.pages_changed, self.pages_processed))
+
+    def replace_page(self, raw):
+        """Returns the raw bytes of the page with the replacements applied,
+        raw itself if nothing changes"""
+        if self.namespace_filter is not None:
+            header_end = raw.find(rawpages.REVISION_START)
+            if not self.namespace_filter.match_header(raw[:header_end]):
+                return raw
+        if not self.prefilter.candidates(raw):
+            return raw
+        edits = []
+        for revision in Page.from_bytes(raw).revisions:
+            span = revision.text_span
+            if span is None:
+                continue
+            candidates = self.prefilter.candidates(raw, *span)
+            if not candidates:
+                continue
+            text = revision.text
+            new_text = self.replace_text(text, candidates)
+            if new_text != text:
+                edits.append((span, new_text))
+        if not edits:
+            return raw
+        self.pages_changed += 1
+        self.revisions_changed += len(edits)
+        return self.serialize(raw, edits)
+
+    def replace_text(self, text, candidates):
+        for index in range(len(self.searches)):
+            if index not in candidates:
+                continue
+            new_text = self.searches[index].sub(self.templates[index], text)
+            if new_text != text:
+                text = new_text
+                # The following pairs may match what this one wrote
+                candidates = self.pattern_set.candidates(text)
+        return text
+
+    def serialize(self, raw, edits):
+        """Splice the new texts into the raw page. edits are ((start, end),
+        text) of the escaped texts, in page order."""
+        parts = []
+        pos = 0
+        for (start, end), text in edits:
+            data = text.encode("utf-8")
+            tag_start = raw.rfind(TEXT_TAG_START, pos, start)
+            parts.append(raw[pos:tag_start])
+            parts.append(TEXT_BYTES_PATTERN.sub(
+                b'bytes="%d"' % len(data), raw[tag_start:start]))
+            parts.append(escape(text))
+            pos = end
+            revision_end = raw.find(REVISION_END, end)
+            match = SHA1_PATTERN.search(raw, end, revision_end)
+            if match:
+                parts.append(raw[pos:match.start(1)])
+                parts.append(sha1_base36(data))
+                pos = match.end(1)
+        parts.append(raw[pos:])
+        return b"".join(parts)
+
+
+def copy_pages(stream, out, header=True):
+    """Copy a dump from stream to out. Unless header, what comes before the
+    first page is dropped, except for the indentation of its line."""
+    started = header
+    before = b""  # The end of what comes before the first page
+
+    def between(data):
+        nonlocal before
+        if started:
+            out.write(data)
+        else:
+            before = (before + data)[-shards.MAX_INDENT:]
+
+    for start, end, raw in rawpages.iter_pages(stream, between=between):
+        if not started:
+            out.write(before[before.rfind(b"\n") + 1:])
+            started = True
+        out.write(raw)
+
+
+def run_shards(replacements, coordinator_file, out_file=None, worker_id=None,
+               lease=shards.DEFAULT_LEASE, **kwargs):
+    """Rewrite the shards of coordinator_file until all are done, and join
+    them into out_file (or STDOUT) if this worker gets to merge them.
+    Shards are compressed like out_file."""
+    kwargs.pop("in_file", None)
+    suffix = ".xml"
+    for extension in compression.OPENERS:
+        if out_file and out_file.endswith(extension):
+            suffix += extension
+    coordinator = shards.Coordinator(coordinator_file)
+
+    def process_shard(stream, output):
+        PatternReplacer(replacements, in_file=stream, out_file=output, **kwargs).execute()
+
+    def merge_outputs(paths):
+        out = compression.open_output(out_file) if out_file else sys.stdout.buffer
+        try:
+            for n, path in enumerate(paths):
+                with open(path, "rb") as f:
+                    copy_pages(compression.open_input(f, 1), out, header=n == 0)
+        finally:
+            if out_file:
+                out.close()
+            else:
+                out.flush()
+
+    try:
+        shards.run_worker(coordinator, process_shard, merge_outputs, worker_id, lease, suffix)
+    finally:
+        coordinator.close()
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__, version='python-mw-tools patternreplacer ' + str(VERSION))
+    replacements_file = arguments.pop("REPLACEMENTS")
+    coordinator_file = arguments.pop("--coordinator")
+    worker_id = arguments.pop("--worker-id")
+    lease = arguments.pop("--lease")
+    arguments = dict((k.replace("--", "").replace("-", "_"), v) for k, v in arguments.items())
+    arguments = dict(
+        filter(lambda kv: not kv[1] is None, [(k, v) for k, v in arguments.items()]))
+    if coordinator_file:
+        out_file = arguments.pop("out_file", None)
+        try:
+            run_shards(read_replacements(replacements_file), coordinator_file,
+                       out_file, worker_id, lease, **arguments)
+        except ShardError as e:
+            settings.logger.error(e)
+            sys.exit(1)
+        sys.exit(0)
+    p = PatternReplacer(read_replacements(replacements_file), **arguments)
+    try:
+        p.execute()
+    except Exception as e:
+        settings.logger.error("Failed to rewrite, page: {}".format(p.pages_processed))
+        settings.logger.error(e)
+        settings.logger.debug(traceback.print_tb(sys.exc_info()[2]))
+        sys.exit(1)
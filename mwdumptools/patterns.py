@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Matching thousands of regular expressions against revision texts.
+
+Running every pattern over every text costs patterns x texts regex scans,
+even though most patterns never match most texts. Instead, PatternSet finds
+for each pattern the literal strings of which at least one has to occur in
+any match (from the parsed pattern, e.g. "[[File:" for r"\\[\\[File:(\\w+)") and
+compiles all of them into one scanner. Like an Aho-Corasick automaton, the
+scanner finds every literal occurring in a text in a single pass: it is a
+regular expression shaped like a trie of the literals, tried at each position
+of the text by the re engine. Only the patterns of which a literal occurs are
+then run on the text. Patterns without a usable literal are always run.
+
+The scanner ignores case, and what it finds is looked up folded the way
+re.IGNORECASE compares characters: by their simple lowercase mapping and the
+few extra equivalences of the re module (e.g. "ſ" and "s", "İ" and "i").
+str.lower() differs from both, so it would miss literals. Both are private
+to CPython: where they are missing, the scanner does not ignore case and
+patterns that ignore case are always run.
+
+With binary=True, the scanner runs on the raw, XML escaped bytes of texts, so
+texts without candidates need not even be decoded. Literals are then cut at
+characters that may be escaped and at non-ASCII characters, whose case the
+scanner cannot ignore in bytes, and for patterns that ignore case, at ASCII
+characters that re.IGNORECASE takes for non-ASCII ones.
+"""
+import functools
+import re
+import sys
+
+try:
+    from _sre import unicode_tolower
+except ImportError:
+    unicode_tolower = None
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+try:
+    from re._casefix import _EXTRA_CASES as EXTRA_CASES
+except ImportError:
+    try:
+        from sre_compile import _ignorecase_fixes as EXTRA_CASES
+    except ImportError:
+        EXTRA_CASES = None
+
+# Whether texts can be folded the way re.IGNORECASE compares characters
+FOLD_CASE = unicode_tolower is not None and EXTRA_CASES is not None
+
+# Shorter literals occur in nearly every text and would not filter anything
+MIN_LITERAL_LENGTH = 3
+
+# May be written as entities in dumps
+XML_SPECIAL_PATTERN = re.compile("[&<>\"']")
+NON_ASCII_PATTERN = re.compile("[^\x00-\x7f]")
+
+REPEATS = tuple(
+    getattr(sre_constants, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_constants, name))
+
+
+class FoldTable(dict):
+
+    """str.translate() table of characters to the lowest character that
+    re.IGNORECASE takes them for, filled in as characters are looked up"""
+
+    def __missing__(self, code):
+        lower = unicode_tolower(code)
+        folded = min((lower,) + tuple(EXTRA_CASES.get(lower, ())))
+        self[code] = folded
+        return folded
+
+
+FOLD_TABLE = FoldTable()
+
+
+def fold_case(text):
+    """text with every character replaced by the lowest one re.IGNORECASE
+    takes it for, so two strings that match each other ignoring case have
+    the same fold_case(). Needs FOLD_CASE."""
+    return text.translate(FOLD_TABLE)
+
+
+@functools.lru_cache(maxsize=None)
+def ascii_with_non_ascii_cases():
+    """Pattern of the ASCII characters that re.IGNORECASE takes for a
+    non-ASCII character, e.g. "k" for the Kelvin sign"""
+    non_ascii = "".join(map(chr, range(0x80, sys.maxunicode + 1)))
+    found = set(re.findall("[\x00-\x7f]", non_ascii, re.IGNORECASE))
+    chars = set(c for c in map(chr, range(0x80)) if fold_case(c) in
+                set(map(fold_case, found)))
+    return re.compile("[" + re.escape("".join(sorted(chars))) + "]")
+
+
+def read_patterns(path):
+    """One pattern per line, empty lines and lines starting with # are
+    skipped"""
+    with open(path, encoding="utf-8") as f:
+        return [ln.rstrip("\r\n") for ln in f
+                if ln.strip() and not ln.startswith("#")]
+
+
+def _best(candidates):
+    """The alternatives whose shortest literal is the longest"""
+    best = None
+    for literals in candidates:
+        if literals and (best is None or
+                         min(map(len, literals)) > min(map(len, best))):
+            best = literals
+    return best
+
+
+def _required_literals(subpattern):
+    """A list of literals of which one occurs in every match of subpattern,
+    or None"""
+    candidates = []
+    run = []
+    for op, av in subpattern:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            candidates.append(["".join(run)])
+            run = []
+        if op is sre_constants.SUBPATTERN:
+            # Literals of a group that ignores case would have to be cut
+            # like those of a pattern that does
+            if not av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                candidates.append(_required_literals(av[-1]))
+        elif op is sre_constants.BRANCH:
+            branches = [_required_literals(branch) for branch in av[1]]
+            if all(branches):
+                candidates.append(sum(branches, []))
+        elif op in REPEATS and av[0] >= 1:
+            candidates.append(_required_literals(av[2]))
+    if run:
+        candidates.append(["".join(run)])
+    return _best(candidates)
+
+
+def required_literals(pattern, flags=0):
+    """Literals of which one occurs in every match of pattern, or None if
+    there are no useful ones"""
+    literals = _required_literals(sre_parse.parse(pattern, flags))
+    if not literals or min(map(len, literals)) < MIN_LITERAL_LENGTH:
+        return None
+    return sorted(set(literals))
+
+
+def binary_literal(literal, ignore_case=False):
+    """The longest part of literal that occurs as it is in escaped bytes,
+    also in texts matched ignoring case if ignore_case"""
+    parts = NON_ASCII_PATTERN.split(literal)
+    parts = [part for p in parts for part in XML_SPECIAL_PATTERN.split(p)]
+    if ignore_case:
+        parts = [part for p in parts for part in ascii_with_non_ascii_cases().split(p)]
+    return max(parts, key=len)
+
+
+def trie_regex(literals):
+    """A regular expression matching any of literals, longest first, shaped
+    like a trie so that the re engine never tries a prefix twice"""
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        end = "" in node
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        regex = "(?:" + "|".join(branches) + ")"
+        return regex + "?" if end else regex
+
+    return build(trie)
+
+
+class PatternSet:
+
+    """
+    A list of patterns, scanned for together. Patterns are referred to by
+    their index in the list.
+    """
+
+    def __init__(self, patterns, flags=0, binary=False):
+        self.patterns = list(patterns)
+        self.binary = binary
+        self.regexes = [re.compile(pattern, flags) for pattern in self.patterns]
+        # Patterns that are run on every text
+        self.unfiltered = []
+        # literal -> indexes of the patterns that need it
+        self.literal_patterns = {}
+        for index, pattern in enumerate(self.patterns):
+            ignore_case = self.regexes[index].flags & re.IGNORECASE
+            literals = None
+            if FOLD_CASE or not ignore_case:
+                literals = required_literals(pattern, flags)
+            if literals is not None and binary:
+                literals = [binary_literal(literal, ignore_case) for literal in literals]
+                if min(map(len, literals)) < MIN_LITERAL_LENGTH:
+                    literals = None
+            if literals is None:
+                self.unfiltered.append(index)
+                continue
+            for literal in set(map(self.fold, literals)):
+                self.literal_patterns.setdefault(literal, []).append(index)
+        self.scanner = None
+        if self.literal_patterns:
+            # A lookahead matches at every position where a literal starts,
+            # also where matches overlap. Case is ignored, which only lets
+            # more texts through to the full patterns. Every literal folds
+            # to a string that re.IGNORECASE takes for it. Without
+            # FOLD_CASE, literals are only case sensitive.
+            regex = "(?=(" + trie_regex(self.literal_patterns) + "))"
+            if binary:
+                regex = regex.encode("ascii")
+            self.scanner = re.compile(regex, re.IGNORECASE if FOLD_CASE else 0)
+        # The longest literal starting at a position is found, the literals
+        # that are a prefix of it are there too
+        self.prefixes = {}
+        for literal in self.literal_patterns:
+            self.prefixes[literal] = [
+                literal[:end]
+                for end in range(MIN_LITERAL_LENGTH, len(literal) + 1)
+                if literal[:end] in self.literal_patterns]
+
+    def candidates(self, text, pos=0, endpos=None):
+        """Indexes of the patterns that may match text[pos:endpos], which is
+        the escaped bytes of a text if the set is binary"""
+        found = set(self.unfiltered)
+        if self.scanner is not None:
+            if endpos is None:
+                endpos = len(text)
+            seen = set()
+            for match in self.scanner.finditer(text, pos, endpos):
+                found_text = match.group(1)
+                if found_text in seen:
+                    continue
+                seen.add(found_text)
+                if self.binary:
+                    found_text = found_text.decode("ascii")
+                literal = self.fold(found_text)
+                for prefix in self.prefixes.get(literal, ()):
+                    found.update(self.literal_patterns[prefix])
+        return found
+
+    def fold(self, literal):
+        """The key of a literal: its folded case, or for binary sets,
+        where literals and the scanner are ASCII only, lower(). Without
+        FOLD_CASE, the literal itself."""
+        if not FOLD_CASE:
+            return literal
+        return literal.lower() if self.binary else fold_case(literal)
+
+    def count(self, text):
+        """Returns {pattern index: number of matches} of the patterns that
+        match text"""
+        counts = {}
+        for index in self.candidates(text):
+            n = sum(1 for __ in self.regexes[index].finditer(text))
+            if n:
+                counts[index] = n
+        return counts
+
+    def __len__(self):
+        return len(self.patterns)
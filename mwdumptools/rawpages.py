@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Working with <page> nodes as raw bytes, without parsing them.
+
+Page texts are XML escaped in dumps, so the byte strings <page> and </page>
+can only occur as tags and pages can be found with plain bytes.find().
+"""
+import html
+import re
+
+from .exceptions import ParseError
+
+PAGE_START = b"<page>"
+PAGE_END = b"</page>"
+REVISION_START = b"<revision>"
+REVISION_END = b"</revision>"
+
+# Bytes read at a time when splitting a stream into pages
+CHUNK_SIZE = 256 * 1024
+
+# Parts of pages yielded by iter_page_parts
+PART_HEADER = "header"
+PART_REVISION = "revision"
+PART_END = "end"
+PART_SKIPPED = "skipped"
+
+# Fields of the page header, i.e. everything before the first <revision>
+HEADER_TITLE_PATTERN = re.compile(rb"<title>(.*?)</title>", re.S)
+HEADER_NS_PATTERN = re.compile(rb"<ns>(-?\d+)</ns>")
+HEADER_ID_PATTERN = re.compile(rb"<id>(\d+)</id>")
+
+
+class PageFilter:
+
+    """
+    Cheap predicates that decide from the page header whether a page should
+    be handled at all. Everything that is not given matches.
+
+    namespaces:   iterable of namespace keys, e.g. ["6"] or [0, 10]
+    title_prefix: title must start with this string, e.g. "File:"
+    title_regex:  title must match this regular expression (re.search)
+    min_id:       lowest page id, inclusive
+    max_id:       highest page id, inclusive
+    """
+
+    def __init__(self, namespaces=None, title_prefix=None, title_regex=None,
+                 min_id=None, max_id=None):
+        self.namespaces = None
+        if namespaces is not None:
+            self.namespaces = set(str(ns).strip().encode("ascii") for ns in namespaces)
+        self.title_prefix = title_prefix
+        self.title_regex = re.compile(title_regex) if title_regex else None
+        self.min_id = int(min_id) if min_id is not None else None
+        self.max_id = int(max_id) if max_id is not None else None
+
+    def match_header(self, header):
+        """Evaluate the predicates on the raw bytes of a page header, the
+        cheapest ones first. Titles are only decoded if needed."""
+        if self.namespaces is not None:
+            match = HEADER_NS_PATTERN.search(header)
+            if not match or match.group(1) not in self.namespaces:
+                return False
+        if self.min_id is not None or self.max_id is not None:
+            match = HEADER_ID_PATTERN.search(header)
+            if not match:
+                return False
+            page_id = int(match.group(1))
+            if self.min_id is not None and page_id < self.min_id:
+                return False
+            if self.max_id is not None and page_id > self.max_id:
+                return False
+        if self.title_prefix is not None or self.title_regex is not None:
+            match = HEADER_TITLE_PATTERN.search(header)
+            if not match:
+                return False
+            title = html.unescape(match.group(1).decode("utf-8"))
+            if self.title_prefix is not None and not title.startswith(self.title_prefix):
+                return False
+            if self.title_regex is not None and not self.title_regex.search(title):
+                return False
+        return True
+
+
+def iter_pages(stream, offset=0, page_filter=None, chunk_size=CHUNK_SIZE,
+               between=None):
+    """
+    Split a binary stream into <page> nodes. Yields (start, end, raw) with
+    the absolute byte offsets of each page, offset being the position of
+    stream. When page_filter rejects the header of a page, raw is None and
+    the rest of the page is skipped without being kept in memory.
+
+    between is called with the bytes outside of pages, i.e. the header, the
+    whitespace between pages and the footer, in stream order.
+    """
+    buf = bytearray()
+    buf_offset = offset  # Absolute offset of buf[0]
+    eof = False
+
+    def fill():
+        nonlocal eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf.extend(chunk)
+
+    def discard(n):
+        nonlocal buf_offset
+        del buf[:n]
+        buf_offset += n
+
+    def discard_between(n):
+        if between is not None and n:
+            between(bytes(buf[:n]))
+        discard(n)
+
+    while True:
+        start = buf.find(PAGE_START)
+        if start == -1:
+            if eof:
+                discard_between(len(buf))
+                return
+            # Keep what could be the beginning of a split <page> tag
+            discard_between(max(len(buf) - len(PAGE_START) + 1, 0))
+            fill()
+            continue
+        discard_between(start)
+
+        search_from = len(PAGE_START)
+        if page_filter is not None:
+            # Read the header, which ends with <revision> or </page>
+            while True:
+                found = [i for i in (buf.find(REVISION_START, search_from),
+                                     buf.find(PAGE_END, search_from)) if i != -1]
+                if found:
+                    header_end = min(found)
+                    break
+                if eof:
+                    raise ParseError("Unexpected end of dump in <page>")
+                search_from = max(len(buf) - len(REVISION_START) + 1, search_from)
+                fill()
+            if not page_filter.match_header(bytes(buf[:header_end])):
+                page_start = buf_offset
+                search_from = header_end
+                while True:
+                    end = buf.find(PAGE_END, search_from)
+                    if end != -1:
+                        end += len(PAGE_END)
+                        discard(end)
+                        break
+                    if eof:
+                        raise ParseError("Unexpected end of dump in <page>")
+                    keep = len(PAGE_END) - 1
+                    discard(max(len(buf) - keep, 0))
+                    search_from = 0
+                    fill()
+                yield page_start, buf_offset, None
+                continue
+            search_from = header_end
+
+        while True:
+            end = buf.find(PAGE_END, search_from)
+            if end != -1:
+                break
+            if eof:
+                raise ParseError("Unexpected end of dump in <page>")
+            search_from = max(len(buf) - len(PAGE_END) + 1, search_from)
+            fill()
+        end += len(PAGE_END)
+        raw = bytes(buf[:end])
+        page_start = buf_offset
+        discard(end)
+        yield page_start, buf_offset, raw
+
+
+def iter_page_parts(stream, offset=0, page_filter=None, chunk_size=CHUNK_SIZE):
+    """
+    Split a binary stream into the parts of its <page> nodes, for pages too
+    large to be kept in memory as a whole, like those of full history dumps.
+    Yields (part, end, raw) with the absolute byte offset after each part:
+
+    PART_HEADER    raw is everything from <page> to the first <revision>
+    PART_REVISION  raw is one <revision> node
+    PART_END       raw is None, the page has ended
+    PART_SKIPPED   raw is None, page_filter rejected the header of the page,
+                   nothing else is yielded for it
+
+    Only one part is kept in memory at a time. Anything between revisions
+    that isn't a revision (e.g. <upload>) is dropped.
+    """
+    buf = bytearray()
+    buf_offset = offset  # Absolute offset of buf[0]
+    eof = False
+
+    def fill():
+        nonlocal eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf.extend(chunk)
+
+    def discard(n):
+        nonlocal buf_offset
+        del buf[:n]
+        buf_offset += n
+
+    def find(tags, search_from, keep=True):
+        """(position, tag) of the first of tags in buf at or after
+        search_from, reading more of the stream until one is found. Unless
+        keep, what has been searched is dropped on the way."""
+        longest = max(map(len, tags))
+        while True:
+            found = [(i, tag) for i, tag in ((buf.find(tag, search_from), tag) for tag in tags)
+                     if i != -1]
+            if found:
+                return min(found)
+            if eof:
+                raise ParseError("Unexpected end of dump in <page>")
+            search_from = max(len(buf) - longest + 1, search_from)
+            if not keep:
+                discard(search_from)
+                search_from = 0
+            fill()
+
+    while True:
+        start = buf.find(PAGE_START)
+        if start == -1:
+            if eof:
+                return
+            # Keep what could be the beginning of a split <page> tag
+            discard(max(len(buf) - len(PAGE_START) + 1, 0))
+            fill()
+            continue
+        discard(start)
+
+        header_end, __ = find((REVISION_START, PAGE_END), len(PAGE_START))
+        header = bytes(buf[:header_end])
+        if page_filter is not None and not page_filter.match_header(header):
+            end, __ = find((PAGE_END,), header_end, keep=False)
+            discard(end + len(PAGE_END))
+            yield PART_SKIPPED, buf_offset, None
+            continue
+        discard(header_end)
+        yield PART_HEADER, buf_offset, header
+
+        while True:
+            start, tag = find((REVISION_START, PAGE_END), 0, keep=False)
+            if tag == PAGE_END:
+                discard(start + len(PAGE_END))
+                yield PART_END, buf_offset, None
+                break
+            discard(start)
+            end, __ = find((REVISION_END,), len(REVISION_START))
+            end += len(REVISION_END)
+            raw = bytes(buf[:end])
+            discard(end)
+            yield PART_REVISION, buf_offset, raw
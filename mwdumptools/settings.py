@@ -1,7 +1,10 @@
 import logging
+import os
 
 # Log all messages raw to stderr
 FORMAT = '%(message)s'
+# E.g. MWDUMPTOOLS_LOG_LEVEL=DEBUG, debug messages cost time in hot paths
+LOG_LEVEL = os.environ.get("MWDUMPTOOLS_LOG_LEVEL", "INFO").upper()
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('mw-tools')
-logger.setLevel(logging.DEBUG)
\ No newline at end of file
+logger.setLevel(LOG_LEVEL)
@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+=================================
+python-mwdump-tools - shards
+=================================
+
+Runs a job over a dump on several machines. The dump is cut into shards,
+byte ranges that start at a <page> tag, or groups of bz2 streams of a
+multistream dump, and the shards are listed in a coordinator file, an
+SQLite database on a filesystem shared by all machines.
+
+Workers claim one shard at a time with a lease, which they renew while the
+shard is being processed. A shard whose lease has expired, because its
+worker died or lost the shared filesystem, is issued again to the next
+worker that asks. A shard that fails, or whose lease expires, --max-attempts
+times is marked failed and left out; "shards retry" issues failed shards
+again. Every shard is handed to the parser as a dump of its own: the header
+of the dump followed by the bytes of the shard.
+
+Each shard writes its output to the shard directory next to the coordinator
+file, under a name of its worker, which is renamed into place only while
+the worker still holds the lease. Once all shards are done, one worker takes
+a lease on the merge and merges the outputs into the output of the job, in a
+way that depends on the tool. If it dies, another worker merges them once
+that lease has expired. The dump must be at the same path on every machine.
+
+Example:
+  shards plan jobs.sqlite dump.xml
+  shards plan --index=dump-index.txt.bz2 jobs.sqlite dump-multistream.xml.bz2
+  patternmatcher --coordinator=jobs.sqlite --out-file=counts.tsv patterns.txt   # on every node
+  shards status jobs.sqlite
+
+Usage:
+  shards plan [--index=FILE] [--shard-size=BYTES] [--max-attempts=N] COORDINATOR DUMP
+  shards status COORDINATOR
+  shards retry COORDINATOR
+  shards (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --index=FILE       Cut the *-pages-articles-multistream.xml.bz2 DUMP at the
+                     bz2 streams listed in its *-multistream-index.txt.bz2
+  --shard-size=BYTES  Bytes of the dump file per shard, the last shard may be
+                     smaller [default: 134217728]
+  --max-attempts=N   Times a shard is issued before it is marked failed
+                     [default: 3]
+"""
+import collections
+import contextlib
+import io
+import functools
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+from docopt import docopt
+
+from . import compression
+from . import multistream
+from . import rawpages
+from . import settings
+from .exceptions import ShardError
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+DEFAULT_SHARD_SIZE = 128 * 1024 * 1024
+
+DEFAULT_LEASE = 300  # seconds
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Leases are renewed this many times per lease period
+RENEWALS_PER_LEASE = 3
+
+# Bytes read at a time when looking for <page> and copying shards
+READ_SIZE = 1024 * 1024
+
+# Spaces and tabs before <page> that are moved to the shard with the page
+MAX_INDENT = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    start_offset INTEGER NOT NULL,
+    end_offset INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+);
+"""
+
+# Characters of worker ids that are replaced in file names
+UNSAFE_FILENAME_PATTERN = re.compile(r"[^\w.-]")
+
+Shard = collections.namedtuple("Shard", "id start end")
+
+
+def default_worker_id():
+    return "{}-{:d}".format(socket.gethostname(), os.getpid())
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def find_forward(f, offset, needle):
+    """Absolute offset of the first needle at or after offset in the file
+    f, or None"""
+    f.seek(offset)
+    tail = b""
+    position = offset  # Of tail
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            return None
+        data = tail + chunk
+        found = data.find(needle)
+        if found != -1:
+            return position + found
+        keep = len(needle) - 1
+        position += len(data) - keep
+        tail = data[-keep:]
+
+
+def find_page(f, offset):
+    """Offset of the line of the first <page> tag at or after offset, with
+    its indentation, like the streams of multistream dumps. Page texts are
+    escaped, so <page> is always a tag."""
+    found = find_forward(f, offset, rawpages.PAGE_START)
+    if found is None:
+        return None
+    start = max(found - MAX_INDENT, offset)
+    f.seek(start)
+    before = f.read(found - start)
+    return found - (len(before) - len(before.rstrip(b" \t")))
+
+
+def plan_plain(dump_file, shard_size=DEFAULT_SHARD_SIZE):
+    """Returns (header_length, ranges) of an uncompressed dump: the header is
+    everything before the first <page>, and ranges are (start, end) byte
+    ranges of about shard_size bytes, each starting at the line of a <page>
+    tag"""
+    with open(dump_file, "rb") as f:
+        if compression.detect_format(f) is not None:
+            raise ValueError("Compressed dumps can only be cut into shards at the "
+                             "streams of a multistream dump, pass its index")
+        size = os.fstat(f.fileno()).st_size
+        header_length = find_page(f, 0)
+        if header_length is None:
+            raise ValueError("No <page> in " + dump_file)
+        boundaries = [header_length]
+        target = header_length + shard_size
+        while target < size:
+            boundary = find_page(f, target)
+            if boundary is None:
+                break
+            boundaries.append(boundary)
+            target = boundary + shard_size
+    ends = boundaries[1:] + [size]
+    return header_length, list(zip(boundaries, ends))
+
+
+def plan_multistream(dump_file, index_file, shard_size=DEFAULT_SHARD_SIZE):
+    """Returns (header_length, ranges) of a bz2 multistream dump: the header
+    is the first stream, and ranges are (start, end) byte ranges of whole
+    streams, about shard_size bytes each"""
+    header_length, streams = multistream.get_stream_ranges(dump_file, index_file)
+    ranges = []
+    start = None
+    for offset, length in streams:
+        if start is None:
+            start = offset
+        if offset + length - start >= shard_size:
+            ranges.append((start, offset + length))
+            start = None
+    if start is not None:
+        ranges.append((start, streams[-1][0] + streams[-1][1]))
+    return header_length, ranges
+
+
+class ShardReader(io.RawIOBase):
+
+    """The header of a dump followed by the bytes of one shard, read from
+    the dump file. Compressed dumps stay compressed."""
+
+    def __init__(self, dump_file, header_length, shard):
+        self.f = open(dump_file, "rb")
+        self.ranges = collections.deque([(0, header_length), (shard.start, shard.end)])
+        self.position = None  # In the dump file
+        self.end = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.position is None or self.position >= self.end:
+            if not self.ranges:
+                return 0
+            self.position, self.end = self.ranges.popleft()
+            self.f.seek(self.position)
+        data = self.f.read(min(len(b), self.end - self.position))
+        if not data:
+            raise EOFError("Dump ends before offset {:d}".format(self.end))
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        io.RawIOBase.close(self)
+
+
+class Coordinator:
+
+    """
+    The shards of a job and their leases, in an SQLite file on a shared
+    filesystem. Every change is a short transaction, so many workers can
+    use the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.splitext(path)[0] + ".shards"
+        self.lock = threading.Lock()
+        # Transactions are explicit, BEGIN IMMEDIATE takes the write lock
+        # before a shard is picked, so two workers never pick the same one
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def plan(self, dump_file, header_length, ranges, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """List the shards of dump_file, once"""
+        with self.transaction() as connection:
+            if connection.execute("SELECT COUNT(*) FROM shards").fetchone()[0]:
+                raise ValueError("Shards have been planned already: " + self.path)
+            connection.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [("dump_file", os.path.abspath(dump_file)),
+                 ("header_length", str(header_length)),
+                 ("max_attempts", str(max_attempts))])
+            connection.executemany(
+                "INSERT INTO shards (start_offset, end_offset, status) VALUES (?, ?, ?)",
+                [(start, end, STATUS_PENDING) for start, end in ranges])
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+
+    @property
+    def dump_file(self):
+        return self.get_meta("dump_file")
+
+    @property
+    def header_length(self):
+        return int(self.get_meta("header_length"))
+
+    def claim(self, worker, lease=DEFAULT_LEASE):
+        """Lease the first pending shard, or a shard whose lease has
+        expired, to worker. Shards that have been issued max_attempts times
+        are marked failed instead. Returns the Shard or None."""
+        now = time.time()
+        shard = None
+        failed = []
+        with self.transaction() as connection:
+            max_attempts = connection.execute(
+                "SELECT value FROM meta WHERE key = ?", ("max_attempts",)).fetchone()
+            max_attempts = int(max_attempts[0]) if max_attempts else DEFAULT_MAX_ATTEMPTS
+            while shard is None:
+                row = connection.execute(
+                    "SELECT id, start_offset, end_offset, status, worker, attempts FROM shards "
+                    "WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (STATUS_PENDING, STATUS_LEASED, now)).fetchone()
+                if row is None:
+                    break
+                shard_id, start, end, status, previous, attempts = row
+                if attempts >= max_attempts:
+                    connection.execute(
+                        "UPDATE shards SET status = ?, lease_expires = NULL, updated = ? "
+                        "WHERE id = ?", (STATUS_FAILED, now, shard_id))
+                    failed.append((shard_id, attempts))
+                    continue
+                connection.execute(
+                    "UPDATE shards SET status = ?, worker = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (STATUS_LEASED, worker, now + lease, now, shard_id))
+                shard = Shard(shard_id, start, end)
+        for shard_id, attempts in failed:
+            settings.logger.error(
+                "Shard {:d} has been issued {:d} times, marking it failed".format(
+                    shard_id, attempts))
+        if shard is not None and status == STATUS_LEASED:
+            settings.logger.warning(
+                "Lease of shard {:d} by {} has expired, issuing it again".format(
+                    shard_id, previous))
+        return shard
+
+    def _update(self, shard, worker, assignments, values):
+        """Update the shard if worker still holds its lease, returns False
+        if not"""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE shards SET {}, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = ?".format(assignments),
+                tuple(values) + (time.time(), shard.id, worker, STATUS_LEASED))
+            return cursor.rowcount == 1
+
+    def renew(self, shard, worker, lease=DEFAULT_LEASE):
+        return self._update(shard, worker, "lease_expires = ?", (time.time() + lease,))
+
+    def complete(self, shard, worker, part=None, output=None):
+        """Mark the shard done if worker still holds its lease, and rename
+        its output from part to output in the same transaction, so that a
+        worker whose lease has been issued again never replaces the output.
+        Returns False if the lease is gone."""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE shards SET status = ?, lease_expires = NULL, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (STATUS_DONE, time.time(), shard.id, worker, STATUS_LEASED))
+            if cursor.rowcount != 1:
+                return False
+            if part is not None:
+                # Rolled back if this fails
+                os.replace(part, output)
+        return True
+
+    def release(self, shard, worker):
+        """Give a shard back, e.g. after an error, so any worker can retry it
+        until it has been issued max_attempts times"""
+        return self._update(shard, worker, "status = ?, lease_expires = NULL",
+                            (STATUS_PENDING,))
+
+    def counts(self):
+        """Number of shards per status, leases that have expired count as
+        pending"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT CASE WHEN status = ? AND lease_expires < ? THEN ? ELSE status END, "
+                "COUNT(*) FROM shards GROUP BY 1",
+                (STATUS_LEASED, time.time(), STATUS_PENDING)).fetchall()
+        counts = dict.fromkeys((STATUS_PENDING, STATUS_LEASED, STATUS_DONE, STATUS_FAILED), 0)
+        counts.update(rows)
+        return counts
+
+    def iter_leases(self):
+        """Yields (shard id, worker, seconds until the lease expires,
+        attempts) of the shards being processed"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, worker, lease_expires, attempts FROM shards "
+                "WHERE status = ? ORDER BY id", (STATUS_LEASED,)).fetchall()
+        now = time.time()
+        for shard_id, worker, expires, attempts in rows:
+            yield shard_id, worker, expires - now, attempts
+
+    def iter_failed(self):
+        """Yields (shard id, last worker, attempts) of the shards that have
+        failed"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, worker, attempts FROM shards WHERE status = ? ORDER BY id",
+                (STATUS_FAILED,)).fetchall()
+        yield from rows
+
+    def retry(self):
+        """Issue the shards that have failed again, returns their number"""
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE shards SET status = ?, worker = NULL, attempts = 0, updated = ? "
+                "WHERE status = ?", (STATUS_PENDING, time.time(), STATUS_FAILED)).rowcount
+
+    def is_merged(self):
+        return self.get_meta("merged_by") is not None
+
+    def claim_merge(self, worker, lease=DEFAULT_LEASE):
+        """Lease the merge of the outputs to worker once all shards are
+        done, unless it is done or another worker holds the lease. Returns
+        True if worker is to merge."""
+        now = time.time()
+        with self.transaction() as connection:
+            pending = connection.execute(
+                "SELECT COUNT(*) FROM shards WHERE status != ?", (STATUS_DONE,)).fetchone()[0]
+            if pending:
+                return False
+            meta = dict(connection.execute(
+                "SELECT key, value FROM meta WHERE key IN (?, ?, ?)",
+                ("merged_by", "merge_worker", "merge_expires")))
+            if "merged_by" in meta:
+                return False
+            previous = meta.get("merge_worker")
+            if previous not in (None, worker) and float(meta["merge_expires"]) >= now:
+                return False
+            connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("merge_worker", worker), ("merge_expires", repr(now + lease))])
+        if previous not in (None, worker):
+            settings.logger.warning(
+                "Lease of the merge by {} has expired, merging again".format(previous))
+        return True
+
+    def _update_merge(self, worker, key, value):
+        """Set a meta key if worker still holds the lease of the merge,
+        returns False if not"""
+        with self.transaction() as connection:
+            meta = dict(connection.execute(
+                "SELECT key, value FROM meta WHERE key IN (?, ?)",
+                ("merged_by", "merge_worker")))
+            if "merged_by" in meta or meta.get("merge_worker") != worker:
+                return False
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            return True
+
+    def renew_merge(self, worker, lease=DEFAULT_LEASE):
+        return self._update_merge(worker, "merge_expires", repr(time.time() + lease))
+
+    def complete_merge(self, worker):
+        """Record that the outputs have been merged, after the merge has
+        written everything"""
+        return self._update_merge(worker, "merged_by", worker)
+
+    def release_merge(self, worker):
+        """Give the merge back, e.g. after an error, so any worker can retry
+        it"""
+        return self._update_merge(worker, "merge_expires", repr(0.0))
+
+    def output_path(self, shard_id, suffix=""):
+        return os.path.join(self.directory, "shard-{:05d}{}".format(shard_id, suffix))
+
+    def part_path(self, shard_id, worker, suffix=""):
+        """Path of the output of a shard while worker writes it. Workers
+        never share one, also when a lease has been issued again."""
+        return self.output_path(shard_id, ".{}.part{}".format(
+            UNSAFE_FILENAME_PATTERN.sub("_", worker), suffix))
+
+    def outputs(self, suffix=""):
+        """Output paths of all shards, in dump order"""
+        with self.lock:
+            ids = [shard_id for shard_id, in self.connection.execute(
+                "SELECT id FROM shards ORDER BY start_offset")]
+        return [self.output_path(shard_id, suffix) for shard_id in ids]
+
+    def open_shard(self, shard):
+        """Buffered binary stream of the dump with only the pages of shard"""
+        return io.BufferedReader(
+            ShardReader(self.dump_file, self.header_length, shard), READ_SIZE)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class LeaseKeeper:
+
+    """Renews a lease in a background thread while a shard or the merge is
+    being processed. renew() returns False once the lease is gone."""
+
+    def __init__(self, renew, name, lease=DEFAULT_LEASE):
+        self.renew = renew
+        self.name = name
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease / RENEWALS_PER_LEASE):
+            if not self.renew():
+                settings.logger.warning("Lost the lease of {}".format(self.name))
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(coordinator, process_shard, merge_outputs, worker=None,
+               lease=DEFAULT_LEASE, suffix=""):
+    """
+    Process shards until none is left, then merge their outputs if this
+    worker gets the lease of the merge. process_shard(stream, output) reads
+    the dump stream of a shard and writes its output to the path output,
+    which is renamed to the output of the shard if the worker still holds
+    the lease when it returns. A shard that raises is logged and given back.
+    merge_outputs(paths) gets the output paths of all shards, in dump order.
+    Paths end with suffix.
+    While other workers hold leases, of shards or of the merge, this waits
+    for them to finish or expire.
+
+    Returns True if this worker merged the outputs. Raises ShardError if
+    shards have failed.
+    """
+    worker = worker or default_worker_id()
+    lease = float(lease)
+    while True:
+        shard = coordinator.claim(worker, lease)
+        if shard is None:
+            counts = coordinator.counts()
+            if not counts[STATUS_PENDING] and not counts[STATUS_LEASED]:
+                break
+            # Leased by others, wait for them to finish or to expire
+            time.sleep(lease / RENEWALS_PER_LEASE)
+            continue
+        settings.logger.info("Processing shard {:d}, bytes {:d}-{:d}".format(
+            shard.id, shard.start, shard.end))
+        output = coordinator.output_path(shard.id, suffix)
+        part = coordinator.part_path(shard.id, worker, suffix)
+        renew = functools.partial(coordinator.renew, shard, worker, lease)
+        try:
+            with LeaseKeeper(renew, "shard {:d}".format(shard.id), lease) as keeper:
+                stream = coordinator.open_shard(shard)
+                try:
+                    process_shard(stream, part)
+                finally:
+                    stream.close()
+        except Exception:
+            settings.logger.exception("Shard {:d} failed".format(shard.id))
+            coordinator.release(shard, worker)
+            remove_file(part)
+            continue
+        except BaseException:
+            coordinator.release(shard, worker)
+            remove_file(part)
+            raise
+        if keeper.lost or not coordinator.complete(shard, worker, part, output):
+            # Issued to another worker, which writes an output of its own
+            settings.logger.warning(
+                "Shard {:d} has been issued to another worker, discarding its output".format(
+                    shard.id))
+            remove_file(part)
+    failed = coordinator.counts()[STATUS_FAILED]
+    if failed:
+        raise ShardError("{:d} shards have failed, see shards status and shards retry".format(
+            failed))
+    while not coordinator.is_merged():
+        if not coordinator.claim_merge(worker, lease):
+            # Merged by another worker, wait for it to finish or to expire
+            time.sleep(lease / RENEWALS_PER_LEASE)
+            continue
+        settings.logger.info("Merging the outputs of all shards")
+        renew = functools.partial(coordinator.renew_merge, worker, lease)
+        try:
+            with LeaseKeeper(renew, "the merge", lease):
+                merge_outputs(coordinator.outputs(suffix))
+        except BaseException:
+            coordinator.release_merge(worker)
+            raise
+        if coordinator.complete_merge(worker):
+            return True
+        settings.logger.warning("Lost the lease of the merge, another worker merged again")
+        return False
+    return False
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    coordinator = Coordinator(arguments["COORDINATOR"])
+    if arguments["plan"]:
+        shard_size = int(arguments["--shard-size"])
+        if arguments["--index"]:
+            header_length, ranges = plan_multistream(
+                arguments["DUMP"], arguments["--index"], shard_size)
+        else:
+            header_length, ranges = plan_plain(arguments["DUMP"], shard_size)
+        coordinator.plan(arguments["DUMP"], header_length, ranges,
+                         int(arguments["--max-attempts"]))
+        settings.logger.info("Planned {:d} shards".format(len(ranges)))
+    elif arguments["retry"]:
+        settings.logger.info("Issuing {:d} failed shards again".format(coordinator.retry()))
+    else:
+        counts = coordinator.counts()
+        print("\t".join("{}: {:d}".format(status, n) for status, n in counts.items()))
+        for shard_id, worker, remaining, attempts in coordinator.iter_leases():
+            print("shard {:d}\t{}\tlease {:+.0f}s\tattempt {:d}".format(
+                shard_id, worker, remaining, attempts))
+        for shard_id, worker, attempts in coordinator.iter_failed():
+            print("shard {:d}\t{}\tfailed\tattempt {:d}".format(shard_id, worker, attempts))
+    coordinator.close()
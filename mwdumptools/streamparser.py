@@ -1,14 +1,55 @@
 # -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
 from datetime import datetime
 import io
+import json
+import os
 import sys
-from xml.etree import cElementTree as etree
+try:
+    from xml.etree import cElementTree as etree
+except ImportError:
+    # Removed in Python 3.9, ElementTree uses the C accelerator by itself
+    from xml.etree import ElementTree as etree
 
+from . import compression
+from . import metrics
+from . import multistream
+from . import pageindex
+from . import pagestate
+from . import rawpages
 from . import settings
+from . import workers
+from .exceptions import ParseError
+from .page import Page
+from .page import Revision
 
 
-class ParseError(Exception):
-    pass
+# Read size when skipping forward in a stream that cannot seek
+SPOOL_BUFFER_SIZE = 1024 * 1024
+
+# Write a checkpoint every N pages
+CHECKPOINT_INTERVAL = 1000
+
+# Page parsing engines:
+# "lines" collects the lines from <page> to </page> and parses them at once,
+# "pull" feeds the raw stream in chunks to an incremental XMLPullParser,
+# "revisions" passes the revisions of a page one at a time to
+# handle_revision, so a page never has to fit in memory as a whole.
+ENGINE_LINES = "lines"
+ENGINE_PULL = "pull"
+ENGINE_REVISIONS = "revisions"
+ENGINES = (ENGINE_LINES, ENGINE_PULL, ENGINE_REVISIONS)
+
+# Bytes read at a time by the pull engine
+PULL_CHUNK_SIZE = 256 * 1024
+
+# Pipeline mode: pages per message sent to a worker process, unless the
+# batch reaches PIPELINE_BATCH_BYTES first
+PIPELINE_BATCH_SIZE = 100
+PIPELINE_BATCH_BYTES = 4 * 1024 * 1024
+# Batches that may be queued or in progress per worker process
+PIPELINE_QUEUE_PER_PROCESS = 2
 
 
 class Parser:
@@ -30,13 +71,23 @@ class Parser:
 
     def __init__(self, in_file=None, out_file=None, err_file=None, **kwargs):
 
+        # Keep the path for modes that need to seek in the file themselves
+        self.in_file = in_file if isinstance(in_file, str) else None
+        # Input is read as bytes: that way, byte offsets can be counted and
+        # only the parts of the dump that are needed get decoded. Compressed
+        # input is decompressed, byte offsets are in the decompressed data.
         if isinstance(in_file, str):
-            self._in_stream = open(in_file)
+            in_stream = open(in_file, "rb")
         elif in_file is not None:
-            self._in_stream = in_file
+            in_stream = in_file
         else:
-            self._in_stream = io.TextIOWrapper(
-                sys.stdin.buffer, encoding='utf-8')
+            in_stream = sys.stdin.buffer
+        decompress_processes = kwargs.get("decompress_processes", None)
+        self._in_stream = compression.open_input(
+            in_stream, int(decompress_processes) if decompress_processes else None)
+        # Closed by close(), modes reading the dump themselves replace
+        # _in_stream
+        self._input_streams = [self._in_stream, in_stream]
         if isinstance(out_file, str):
             self._out_stream = open(out_file)
         elif out_file is not None:
@@ -48,6 +99,19 @@ class Parser:
         raise NotImplementedError(
             "You need to overwrite execute with your own calls")
 
+    def close(self):
+        """Close the input, also a stream passed as in_file but not STDIN.
+        Stops the processes decompressing a bz2 dump."""
+        for stream in [self._in_stream] + self._input_streams:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 class XmlStreamParser(Parser):
 
@@ -68,15 +132,71 @@ class XmlStreamParser(Parser):
             "generator",
             "MediaWiki 1.22wmf8"
         )
-        self.resume = kwargs.get("resume", 0)
-        self.line_no = 0  # Maintain line count for resuming
+        self.resume = int(kwargs.get("resume", 0))
+        self.line_no = 0  # Lines read, only counted by the lines engine
+        self.offset = 0  # Byte offset in the input stream
         self.pages_processed = 0
+        self.pages_skipped = 0  # Pages rejected by page_filter
+        self.revisions_processed = 0  # By the revisions engine
+        # Position after the last page that handle_page completed
+        self.last_page_offset = 0
+        self.last_page_line_no = 0
+        # Sidecar file for periodic checkpoints of the position
+        self.checkpoint = kwargs.get("checkpoint", None)
+        self.checkpoint_interval = int(kwargs.get(
+            "checkpoint_interval", CHECKPOINT_INTERVAL))
+        self.checkpoint_pages = 0  # Pages processed and skipped at last write
+        self.engine = kwargs.get("engine", ENGINE_LINES)
+        if self.engine not in ENGINES:
+            raise ValueError("Unknown engine: {}".format(self.engine))
+        # A rawpages.PageFilter evaluated on the raw page header: pages that
+        # don't match are skipped before being parsed
+        self.page_filter = kwargs.get("page_filter", None)
+        # Incremental runs: a pagestate.PageState file, pages with the same
+        # revision as when it was written are skipped like filtered ones
+        self.page_state_file = kwargs.get("page_state", None)
+        self.page_state = None
+        if self.page_state_file:
+            if self.engine == ENGINE_REVISIONS:
+                raise ValueError("The revisions engine cannot check the page state, "
+                                 "it needs the last revision before the page is handled")
+            self.page_state = pagestate.PageState(self.page_state_file)
+        # Keys of the pages that passed check_page and are not recorded yet,
+        # in dump order
+        self.page_keys = collections.deque()
+        self.started_on = datetime.now()
+        # Multistream mode: path of the *-multistream-index.txt[.bz2] file
+        self.index = kwargs.get("index", None)
+        # Indexed mode: only the pages with these titles or ids are read,
+        # through the pageindex.PageIndex file page_index
+        self.page_index = kwargs.get("page_index", None)
+        self.titles = kwargs.get("titles", None) or []
+        self.page_ids = kwargs.get("page_ids", None) or []
+        self.indexed_dump = None
+        self.parse_processes = kwargs.get("parse_processes", None)
+        if self.parse_processes is not None:
+            self.parse_processes = int(self.parse_processes)
+        # Pipeline mode: pages are split out by this process and parsed and
+        # handled by parse_processes worker processes
+        self.pipeline = kwargs.get("pipeline", False)
+        self.batch_size = int(kwargs.get("batch_size", PIPELINE_BATCH_SIZE))
+        self.unordered = kwargs.get("unordered", False)
+        self.pipeline_pending = 0  # Batches queued or in progress
+        # Export metrics.snapshot() to this file while executing
+        self.metrics_file = kwargs.get("metrics", None)
+        self.metrics_interval = kwargs.get("metrics_interval", metrics.DEFAULT_INTERVAL)
+        self.metrics_exporter = None
+        self._kwargs = kwargs
 
     def parse_etree(self, lines, start_tag):
+        """Parse a list of stripped str lines or a list of raw bytes lines"""
         start_tag = "<" + start_tag + ">"
+        if isinstance(lines[0], bytes):
+            if start_tag.encode("utf-8") not in lines[0]:
+                raise ParseError("Expected: " + start_tag)
+            return etree.fromstring(b"".join(lines))
         if start_tag not in lines[0]:
             raise ParseError("Expected: " + start_tag)
-        lines[0].replace(start_tag, "")
         return etree.fromstring("\n".join(lines))
 
     def parse_site_info(self, lines):
@@ -116,54 +236,602 @@ class XmlStreamParser(Parser):
             raise ParseError("Illegal schema")
         return is_ok
 
-    def execute(self):
-        """ Check schema - just check the first line
+    def parse_header(self):
+        """ Check schema - just check the first line - and read siteinfo
         """
-        ln = self._in_stream.readline().strip()
+        self.header = []  # Raw lines, sent to the worker processes
+        ln = self.readline_header()
         if not self.parse_schema([ln]):
-            return
-
-        started_on = datetime.now()
+            return False
 
         # Site info
         lines = []
         while ln != "</siteinfo>":
-            ln = self._in_stream.readline().strip()
+            ln = self.readline_header()
             lines.append(ln)
         self.parse_site_info(lines)
+        self.header = b"".join(self.header)
+        return True
 
-        if self.resume:
-            settings.logger.debug(
-                "Spooling forward to line: {}".format(self.resume))
+    def readline_header(self):
+        raw = self._in_stream.readline()
+        if not raw:
+            raise ParseError("Unexpected end of dump in header")
+        self.offset += len(raw)
+        self.header.append(raw)
+        return raw.decode("utf-8").strip()
 
-        # Main parser
-        while not self._in_stream.closed:
-            ln = self._in_stream.readline().strip()
+    def parse_pages(self):
+        """Handle all <page> nodes until </mediawiki> or the end of the
+        stream"""
+        if self.engine == ENGINE_PULL:
+            self.parse_pages_pull()
+        elif self.engine == ENGINE_REVISIONS:
+            self.parse_pages_revisions()
+        else:
+            self.parse_pages_lines()
+
+    def parse_pages_lines(self):
+        stream = self._in_stream
+        while not stream.closed:
+            raw = stream.readline()
+            if not raw:
+                break
+            self.offset += len(raw)
             self.line_no += 1
-            if ln == "<page>":
-                page_lines = [ln]
-                while ln != "</page>":
-                    ln = self._in_stream.readline()
-                    page_lines.append(ln)
-                    ln = ln.strip()
-                page = self.parse_etree(page_lines, "page")
-                self.handle_page(page)
-                if self.pages_processed % 1000 == 0:
-                    process_time = started_on - datetime.now()
-                    pps = self.pages_processed / process_time.total_seconds()
-                    settings.logger.info("Processed {} pages - {} pages per second".format(
-                        self.pages_processed, pps
-                    ))
-                self.pages_processed += 1
-            elif ln == "</mediawiki>":
+            ln = raw.strip()
+            if ln == b"<page>":
+                page_lines = [raw]
+                in_header = self.page_filter is not None
+                skip = False
+                while ln != b"</page>":
+                    raw = stream.readline()
+                    if not raw:
+                        raise ParseError("Unexpected end of dump in <page>")
+                    self.offset += len(raw)
+                    self.line_no += 1
+                    ln = raw.strip()
+                    if in_header and (ln == b"<revision>" or ln == b"</page>"):
+                        in_header = False
+                        if not self.page_filter.match_header(b"".join(page_lines)):
+                            skip = True
+                            break
+                    page_lines.append(raw)
+                if skip:
+                    if ln != b"</page>":
+                        self.skip_page_lines()
+                    self.pages_skipped += 1
+                else:
+                    raw = b"".join(page_lines)
+                    if self.check_page(raw):
+                        with metrics.timer("handle_page"):
+                            self.handle_page(Page.from_bytes(raw))
+                        self.page_handled()
+                    else:
+                        self.pages_skipped += 1
+                self.last_page_offset = self.offset
+                self.last_page_line_no = self.line_no
+                self.checkpoint_reached()
+            elif ln == b"</mediawiki>":
                 settings.logger.debug(
                     "Successfully finished parsing -- waiting for sub processes to finish")
+                if self.checkpoint:
+                    self.write_checkpoint()
                 break
             else:
-                settings.logger.debug("Did not understand " + ln)
+                settings.logger.debug("Did not understand %r", ln)
+
+    def skip_page_lines(self):
+        """Read forward to the end of the current page without keeping
+        anything"""
+        stream = self._in_stream
+        while True:
+            raw = stream.readline()
+            if not raw:
+                raise ParseError("Unexpected end of dump in <page>")
+            self.offset += len(raw)
+            self.line_no += 1
+            if raw.strip() == b"</page>":
+                return
+
+    def parse_pages_pull(self):
+        """Feed the raw stream to an incremental pull parser and handle each
+        <page> element as soon as it is complete. Handled pages are removed
+        from the tree, so memory is bounded by the largest page and lines
+        don't matter. Lines are not counted, positions are byte offsets."""
+        if self.page_filter is not None or self.page_state is not None:
+            return self.parse_pages_split()
+        stream = self._in_stream
+        parser = etree.XMLPullParser(events=("start", "end"))
+        # The header has been read already: open a root element without the
+        # export namespace, so tags are "page", "title" etc. like with the
+        # lines engine. This also works for multistream chunks.
+        parser.feed(b"<mediawiki>")
+        __, root = next(parser.read_events())
+        tail = b""
+        finished = False
+        while not finished:
+            chunk = stream.read(PULL_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk_offset = self.offset
+            self.offset += len(chunk)
+            parser.feed(chunk)
+            pages_before = self.pages_processed
+            for event, elem in parser.read_events():
+                if event != "end":
+                    continue
+                if elem.tag == "page":
+                    with metrics.timer("handle_page"):
+                        self.handle_page(Page.from_element(elem))
+                    root.clear()
+                    self.page_handled()
+                elif elem.tag == "mediawiki":
+                    settings.logger.debug(
+                        "Successfully finished parsing -- waiting for sub processes to finish")
+                    finished = True
+            if self.pages_processed > pages_before:
+                # All pages ending in this chunk have been handled, so the
+                # position after the last </page> is a safe resume point.
+                # Page texts are escaped, so </page> is always a tag.
+                end = (tail + chunk).rfind(b"</page>") + len(b"</page>")
+                self.last_page_offset = chunk_offset - len(tail) + end
+                self.checkpoint_reached()
+            tail = chunk[-(len(b"</page>") - 1):]
+        if finished and self.checkpoint:
+            self.write_checkpoint()
+
+    def parse_pages_split(self):
+        """Pull engine with a page filter or page state: pages are split out
+        of the raw stream with bytes.find() and only those with a matching
+        header are parsed, so skipped pages cost little more than reading
+        them."""
+        for start, end, raw in rawpages.iter_pages(
+                self._in_stream, self.offset, self.page_filter):
+            self.offset = end
+            if raw is None or not self.check_page(raw):
+                self.pages_skipped += 1
+            else:
+                with metrics.timer("handle_page"):
+                    self.handle_page(Page.from_bytes(raw))
+                self.page_handled()
+            self.last_page_offset = end
+            self.checkpoint_reached()
+        if self.checkpoint:
+            self.write_checkpoint()
+
+    def parse_pages_revisions(self):
+        """Revisions engine: pages are split into their header and their
+        revisions, which are passed to handle_page_start, handle_revision
+        and handle_page_end as they are read. Revisions are dropped once
+        handled, so memory is bounded by the largest revision, not by the
+        largest page of a full history dump."""
+        page = None
+        for part, end, raw in rawpages.iter_page_parts(
+                self._in_stream, self.offset, self.page_filter):
+            self.offset = end
+            if part == rawpages.PART_REVISION:
+                with metrics.timer("handle_revision"):
+                    self.handle_revision(page, Revision.from_bytes(raw))
+                self.revisions_processed += 1
+                continue
+            if part == rawpages.PART_HEADER:
+                page = Page.from_bytes(raw)
+                self.handle_page_start(page)
+                continue
+            if part == rawpages.PART_SKIPPED:
+                self.pages_skipped += 1
+            else:
+                self.handle_page_end(page)
+                page = None
+                self.page_handled()
+            self.last_page_offset = end
+            self.checkpoint_reached()
+        if self.checkpoint:
+            self.write_checkpoint()
+
+    def parse_pages_pipeline(self):
+        """Split the raw stream into batches of pages, which worker processes
+        turn into pages and pass to process_page. The return values come back
+        to handle_result in this process, in dump order or, if unordered, as
+        soon as a batch is done. Checkpoints only advance over batches that
+        are done in dump order, so when resuming, pages that finished out of
+        order are processed again."""
+        processes = self.parse_processes or os.cpu_count()
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=workers.init_pipeline_parser,
+            initargs=(type(self), self.get_worker_kwargs(), self.header,
+                      metrics.enabled())
+        )
+        max_pending = processes * PIPELINE_QUEUE_PER_PROCESS
+        pending = collections.deque()
+        batch, batch_bytes, skipped = [], 0, 0
+        try:
+            for start, end, raw in rawpages.iter_pages(
+                    self._in_stream, self.offset, self.page_filter):
+                self.offset = end
+                if raw is None or not self.check_page(raw):
+                    skipped += 1
+                    continue
+                batch.append(raw)
+                batch_bytes += len(raw)
+                if len(batch) >= self.batch_size or batch_bytes >= PIPELINE_BATCH_BYTES:
+                    # Time spent waiting for the workers
+                    with metrics.timer("pipeline_wait"):
+                        self.pipeline_collect(pending, max_pending - 1)
+                    pending.append(PipelineBatch(
+                        executor.submit(workers.process_raw_pages, batch),
+                        self.offset, len(batch), skipped))
+                    self.pipeline_pending = len(pending)
+                    batch, batch_bytes, skipped = [], 0, 0
+            if batch:
+                pending.append(PipelineBatch(
+                    executor.submit(workers.process_raw_pages, batch),
+                    self.offset, len(batch), skipped))
+                skipped = 0
+            self.pipeline_collect(pending, 0)
+            self.pipeline_pending = 0
+            self.pages_skipped += skipped
+        finally:
+            executor.shutdown(wait=True)
+        self.last_page_offset = self.offset
+        if self.checkpoint:
+            self.write_checkpoint()
+
+    def pipeline_collect(self, pending, max_pending):
+        """Pass the results of finished batches to handle_result, blocking
+        until at most max_pending batches are left"""
+        while pending:
+            if self.unordered:
+                for batch in pending:
+                    if not batch.handled and batch.future.done():
+                        self.pipeline_results(batch)
+            elif len(pending) > max_pending or pending[0].future.done():
+                self.pipeline_results(pending[0])
+            # Retire batches that are done in dump order
+            while pending and pending[0].handled:
+                batch = pending.popleft()
+                self.page_handled(batch.pages)
+                self.pages_skipped += batch.skipped
+                self.last_page_offset = batch.end
+                self.checkpoint_reached()
+            if len(pending) <= max_pending:
+                if self.unordered or not pending or not pending[0].future.done():
+                    return
+            elif self.unordered:
+                concurrent.futures.wait(
+                    [batch.future for batch in pending if not batch.handled],
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def pipeline_results(self, batch):
+        results, worker_metrics = batch.future.result()
+        metrics.merge(worker_metrics)
+        with metrics.timer("handle_results"):
+            for result in results:
+                self.handle_result(result)
+        batch.handled = True
+
+    def check_page(self, raw):
+        """Called with the raw bytes of every page that passed page_filter,
+        in dump order. Returns False if the page is to be skipped because
+        page_state has the same revision of it."""
+        if self.page_state is None:
+            return True
+        key = pagestate.read_key(raw)
+        if self.page_state.is_unchanged(key):
+            metrics.incr("pages_unchanged")
+            return False
+        self.page_keys.append(key)
+        return True
+
+    def page_handled(self, count=1):
+        # Log every 1000 pages, also when counting several pages at once
+        if (self.pages_processed + count - 1) // 1000 > (self.pages_processed - 1) // 1000:
+            process_time = datetime.now() - self.started_on
+            pps = self.pages_processed / max(process_time.total_seconds(), 1e-6)
+            settings.logger.info("Processed {} pages - {} pages per second".format(
+                self.pages_processed, pps
+            ))
+        self.pages_processed += count
+        if self.page_state is not None:
+            self.pages_done([self.page_keys.popleft() for __ in range(count)])
+
+    def pages_done(self, keys):
+        """Record the pagestate keys of handled pages. Override to record
+        them later, e.g. once the jobs started by handle_page have
+        succeeded."""
+        self.page_state.add(keys)
+
+    def checkpoint_reached(self):
+        """Called when last_page_offset has moved to a new page boundary"""
+        pages = self.pages_processed + self.pages_skipped
+        if self.checkpoint and pages - self.checkpoint_pages >= self.checkpoint_interval:
+            self.write_checkpoint()
+
+    def execute(self):
+        started = self.start_metrics()
+        try:
+            self.parse_dump()
+            if self.page_state is not None:
+                self.page_state.commit()
+        finally:
+            self.close()
+            if started:
+                self.stop_metrics()
+
+    def start_metrics(self):
+        """Start exporting metrics if a metrics file is given and this hasn't
+        happened yet. Returns True if the exporter has been started."""
+        if not self.metrics_file or self.metrics_exporter is not None:
+            return False
+        self.metrics_exporter = metrics.start(self.metrics_file, self.metrics_interval)
+        self.register_metrics()
+        return True
+
+    def stop_metrics(self):
+        self.metrics_exporter.stop()
+        self.metrics_exporter = None
+
+    def register_metrics(self):
+        """Register gauges, extend to add your own"""
+        metrics.gauge("bytes_read", lambda: self.offset)
+        metrics.gauge("pages_processed", lambda: self.pages_processed)
+        metrics.gauge("pages_skipped", lambda: self.pages_skipped)
+        metrics.gauge("revisions_processed", lambda: self.revisions_processed)
+        metrics.gauge("pipeline_batches_pending", lambda: self.pipeline_pending)
+
+    def parse_dump(self):
+        if self.titles or self.page_ids:
+            return self.execute_indexed()
+        if self.index:
+            return self.execute_multistream(self.index, self.parse_processes)
+
+        self.started_on = datetime.now()
+        if not self.parse_header():
+            return
+
+        self.last_page_offset = self.offset
+        state = self.read_checkpoint() if self.checkpoint else None
+        if state:
+            settings.logger.info(
+                "Resuming from checkpoint: byte {offset}, "
+                "{pages_processed} pages processed".format(**state))
+            self.seek(state["offset"])
+            self.line_no = state.get("line_no", 0)
+            self.pages_processed = state["pages_processed"]
+            self.pages_skipped = state.get("pages_skipped", 0)
+            self.checkpoint_pages = self.pages_processed + self.pages_skipped
+            self.last_page_offset = self.offset
+            self.last_page_line_no = self.line_no
+            self.resume_jobs(state["outstanding_jobs"])
+        elif self.resume:
+            settings.logger.debug("Spooling forward to line: %d", self.resume)
+            while self.line_no < self.resume:
+                raw = self._in_stream.readline()
+                if not raw:
+                    raise ParseError("Dump ends before line {}".format(self.resume))
+                self.offset += len(raw)
+                self.line_no += 1
+
+        if self.pipeline:
+            self.parse_pages_pipeline()
+        else:
+            self.parse_pages()
+
+    def seek(self, offset):
+        """Move the input to a byte offset. Files are seeked directly, pipes
+        are read forward without decoding or parsing anything."""
+        if self._in_stream.seekable():
+            self._in_stream.seek(offset)
+        else:
+            remaining = offset - self.offset
+            while remaining > 0:
+                chunk = self._in_stream.read(min(remaining, SPOOL_BUFFER_SIZE))
+                if not chunk:
+                    raise ParseError("Dump ends before offset {}".format(offset))
+                remaining -= len(chunk)
+        self.offset = offset
+
+    @property
+    def counts_lines(self):
+        """Only the lines engine counts lines, the other engines and the
+        pipeline split the raw stream and work with byte offsets"""
+        return self.engine == ENGINE_LINES and not self.pipeline
+
+    def describe_position(self):
+        """Where the parser is, for log messages"""
+        if self.counts_lines:
+            return "line no: {}".format(self.line_no)
+        return "byte: {}".format(self.offset)
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_checkpoint(self):
+        """Replace the checkpoint file with the position after the last
+        completed page. Written to a temporary file and renamed, so a crash
+        never leaves a truncated checkpoint behind."""
+        state = {
+            "offset": self.last_page_offset,
+            "pages_processed": self.pages_processed,
+            "pages_skipped": self.pages_skipped,
+            "outstanding_jobs": list(self.get_outstanding_jobs()),
+        }
+        if self.counts_lines:
+            state["line_no"] = self.last_page_line_no
+        tmp_file = self.checkpoint + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.checkpoint)
+        if self.page_state is not None:
+            self.page_state.commit()
+        self.checkpoint_pages = self.pages_processed + self.pages_skipped
+
+    def get_outstanding_jobs(self):
+        """Override to store jobs started by handle_page that have not
+        finished yet. They must be JSON serializable."""
+        return []
+
+    def resume_jobs(self, jobs):
+        """Override to restart the jobs from get_outstanding_jobs when
+        resuming from a checkpoint"""
+        pass
+
+    def execute_multistream(self, index, processes=None):
+        """Parse a bz2 multistream dump using the offsets of its index file:
+        each independent bz2 stream is decompressed and parsed by a worker
+        process, which runs process_page on its own parser instance. Results
+        are passed to handle_result as streams finish."""
+        if not self.in_file:
+            raise ParseError("Multistream mode needs a dump file, not a pipe")
+        header_length, ranges = multistream.get_stream_ranges(self.in_file, index)
+
+        self.started_on = datetime.now()
+        self._in_stream = io.BytesIO(
+            multistream.read_stream(self.in_file, 0, header_length))
+        if not self.parse_header():
+            return
+
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=workers.init_multistream_parser,
+            initargs=(type(self), self.get_worker_kwargs(),
+                      self.in_file, header_length, metrics.enabled())
+        )
+        # Keep a few streams queued per worker but don't submit them all
+        max_pending = (processes or os.cpu_count()) * 4
+        pending = set()
+        try:
+            for offset, length in ranges:
+                if len(pending) >= max_pending:
+                    with metrics.timer("pipeline_wait"):
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.streams_done(done)
+                pending.add(executor.submit(
+                    workers.parse_multistream_chunk, self.in_file, offset, length))
+                self.pipeline_pending = len(pending)
+            self.streams_done(concurrent.futures.wait(pending).done)
+        finally:
+            executor.shutdown(wait=True)
+
+    def execute_indexed(self):
+        """Handle only the pages given by titles and page_ids, each read by
+        a lookup in the page index instead of parsing the whole dump"""
+        if not self.in_file or not self.page_index:
+            raise ParseError("Reading pages by title or id needs in_file and page_index")
+        self.started_on = datetime.now()
+        dump = self.get_indexed_dump()
+        self._in_stream = dump.open_header()
+        if not self.parse_header():
+            return
+        for entry, raw in dump.iter_raw(self.titles, self.page_ids):
+            if not self.check_page(raw):
+                self.pages_skipped += 1
+                continue
+            with metrics.timer("handle_page"):
+                self.handle_page(Page.from_bytes(raw))
+            self.page_handled()
+        settings.logger.info("Processed {} of {} pages".format(
+            self.pages_processed, len(self.titles) + len(self.page_ids)))
+
+    def get_indexed_dump(self):
+        """The pageindex.IndexedDump of in_file and page_index, opened on
+        first use"""
+        if self.indexed_dump is None:
+            self.indexed_dump = pageindex.IndexedDump(self.in_file, self.page_index)
+        return self.indexed_dump
+
+    def get_page(self, title=None, page_id=None):
+        """The page.Page with title or page_id, read through the page index,
+        or None if the dump has no such page"""
+        dump = self.get_indexed_dump()
+        entry = dump.find(title=title, page_id=page_id)
+        if entry is None:
+            return None
+        return Page.from_bytes(dump.get_raw(entry))
+
+    def streams_done(self, futures):
+        """Collect page counts and results from finished multistream jobs"""
+        for future in futures:
+            pages, skipped, results, keys, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            self.pages_processed += pages
+            self.pages_skipped += skipped
+            with metrics.timer("handle_results"):
+                for result in results:
+                    self.handle_result(result)
+            if self.page_state is not None:
+                self.pages_done(keys)
+        process_time = datetime.now() - self.started_on
+        settings.logger.info("Processed {} pages - {} pages per second".format(
+            self.pages_processed,
+            self.pages_processed / max(process_time.total_seconds(), 1e-6)
+        ))
+
+    def get_worker_kwargs(self):
+        """Keyword arguments used to construct the parser of each worker
+        process. Subclasses taking their own arguments must add them."""
+        kwargs = dict(self._kwargs)
+        kwargs.pop("index", None)
+        kwargs.pop("checkpoint", None)
+        kwargs.pop("pipeline", None)
+        kwargs.pop("metrics", None)
+        kwargs.pop("titles", None)
+        kwargs.pop("page_ids", None)
+        kwargs["in_file"] = self.in_file
+        return kwargs
+
+    def finish(self):
+        """Called in worker processes when they exit"""
+        pass
+
+    def process_page(self, page):
+        """Runs in the worker processes in pipeline and multistream mode,
+        the return value is passed to handle_result in the main process,
+        unless it is None. Defaults to calling handle_page."""
+        return self.handle_page(page)
+
+    def handle_result(self, result):
+        """Override to receive the return values of process_page"""
+        pass
 
     def handle_page(self, page):
-        settings.logger.debug(page.find("title").text)
+        """Override to process each page.Page of the dump"""
+        settings.logger.debug(page.title)
+
+    def handle_page_start(self, page):
+        """Revisions engine: override to process each page.Page before its
+        revisions, page.revisions is empty"""
+        settings.logger.debug(page.title)
+
+    def handle_revision(self, page, revision):
+        """Revisions engine: override to process each page.Revision of page,
+        in dump order. Revisions are not kept, copy what you need of them."""
+        pass
+
+    def handle_page_end(self, page):
+        """Revisions engine: called after the last revision of page"""
+        pass
+
+
+class PipelineBatch:
+
+    """A batch of pages submitted to the worker processes"""
+
+    __slots__ = ("future", "end", "pages", "skipped", "handled")
+
+    def __init__(self, future, end, pages, skipped):
+        self.future = future
+        self.end = end  # Offset after the last page of the batch
+        self.pages = pages
+        self.skipped = skipped  # Pages skipped by page_filter before this batch
+        self.handled = False
 
 
 if __name__ == "__main__":
@@ -172,7 +840,12 @@ if __name__ == "__main__":
     try:
         p.execute()
     except ParseError as e:
-        settings.logger.error("Failed to parse, line no: {}".format(p.line_no))
+        settings.logger.error("Failed to parse, {}".format(p.describe_position()))
         settings.logger.error(e)
-        settings.logger.error(
-            "You can set resume={} after fixing to resume".format(p.line_no))
+        if p.counts_lines:
+            settings.logger.error(
+                "You can set resume={} after fixing to resume".format(p.line_no))
+        else:
+            settings.logger.error(
+                "Run again with checkpoint=FILE to be able to resume after the "
+                "last completed page")
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================
+python-mwdump-tools - syntheticdump
+=====================================
+
+Generates a synthetic pages-articles dump for benchmarks, of any size. Texts
+are random wiki markup with [[File:...]] links, templates, references and
+entities. The same seed gives the same dump.
+
+Text sizes follow a log-normal distribution around --text-size, like real
+wikis where most pages are short and a few are very long. --namespaces is a
+mix of namespace:weight pairs, pages in namespace 6 are File: pages.
+
+With --revisions, every page has that many revisions with a text of its own,
+like the pages-meta-history dumps.
+
+Example:
+  python3 -m mwdumptools.syntheticdump --pages=100000 synthetic.xml
+  python3 -m mwdumptools.syntheticdump --pages=100000 --index=synthetic-index.txt.bz2 synthetic.xml.bz2
+  python3 -m mwdumptools.syntheticdump --pages=100 --revisions=1000 history.xml
+
+Usage:
+  syntheticdump [--pages=N] [--text-size=BYTES] [--text-sigma=SIGMA]
+                [--namespaces=SPEC] [--file-links=N] [--files=N]
+                [--revisions=N] [--seed=N] [--index=FILE] FILE
+  syntheticdump (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --pages=N          Number of pages [default: 10000]
+  --text-size=BYTES  Median text size [default: 2000]
+  --text-sigma=SIGMA  Spread of the log-normal text sizes [default: 1.0]
+  --namespaces=SPEC  Namespace mix as namespace:weight pairs
+                     [default: 0:70,6:10,10:10,14:10]
+  --file-links=N     Average [[File:...]] links per 1000 bytes of text
+                     [default: 2]
+  --files=N          Number of distinct file names that are linked
+                     (defaults to a tenth of --pages)
+  --revisions=N      Revisions per page [default: 1]
+  --seed=N           Random seed [default: 1]
+  --index=FILE       Write FILE as a bz2 multistream dump (FILE must end with
+                     .bz2) with this *-multistream-index.txt.bz2 file
+"""
+import bz2
+import random
+
+from docopt import docopt
+
+from . import compression
+from .page import escape, sha1_base36
+
+DEFAULT_NAMESPACES = {0: 70, 6: 10, 10: 10, 14: 10}
+
+NAMESPACE_PREFIXES = {
+    0: "",
+    6: "File:",
+    10: "Template:",
+    14: "Category:",
+}
+
+# Pages per bz2 stream of multistream dumps, like Wikimedia's
+PAGES_PER_STREAM = 100
+
+HEADER = b"""<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.8/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.mediawiki.org/xml/export-0.8/ http://www.mediawiki.org/xml/export-0.8.xsd" version="0.8" xml:lang="en">
+  <siteinfo>
+    <sitename>Synthetic</sitename>
+    <base>http://synthetic.invalid/wiki/Main_Page</base>
+    <generator>MediaWiki 1.22wmf8</generator>
+    <case>first-letter</case>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="6" case="first-letter">File</namespace>
+      <namespace key="10" case="first-letter">Template</namespace>
+      <namespace key="14" case="first-letter">Category</namespace>
+    </namespaces>
+  </siteinfo>
+"""
+
+FOOTER = b"</mediawiki>\n"
+
+PAGE = """  <page>
+    <title>{title}</title>
+    <ns>{ns}</ns>
+    <id>{id}</id>
+"""
+
+REVISION = """    <revision>
+      <id>{revision_id}</id>
+      <timestamp>2013-07-02T00:00:00Z</timestamp>
+      <contributor>
+        <username>Synthetic</username>
+        <id>1</id>
+      </contributor>
+      <text xml:space="preserve" bytes="{bytes}">"""
+
+REVISION_END = """</text>
+      <sha1>{sha1}</sha1>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+    </revision>
+"""
+
+PAGE_END = """  </page>
+"""
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt labore dolore magna aliqua enim minim veniam quis "
+    "nostrud exercitation ullamco laboris nisi aliquip commodo consequat "
+    "wiki river mountain village history language people century region"
+).split()
+
+EXTENSIONS = ["jpg", "jpg", "jpg", "png", "png", "gif", "svg"]
+
+
+def parse_namespaces(spec):
+    """"0:70,6:10" -> {0: 70, 6: 10}"""
+    namespaces = {}
+    for pair in spec.split(","):
+        ns, __, weight = pair.partition(":")
+        namespaces[int(ns)] = float(weight or 1)
+    return namespaces
+
+
+class SyntheticDump:
+
+    def __init__(self, pages=10000, text_size=2000, text_sigma=1.0,
+                 namespaces=None, file_links=2, files=None, revisions=1, seed=1):
+        self.pages = int(pages)
+        self.text_size = int(text_size)
+        self.text_sigma = float(text_sigma)
+        self.namespaces = namespaces or DEFAULT_NAMESPACES
+        self.file_links = float(file_links)
+        self.files = int(files) if files else max(self.pages // 10, 1)
+        self.revisions = int(revisions)
+        self.seed = int(seed)
+
+    def file_name(self, n):
+        return "Synthetic image {:d}.{}".format(n, EXTENSIONS[n % len(EXTENSIONS)])
+
+    def make_text(self, rnd, size):
+        """Random markup of about size characters"""
+        parts = []
+        length = 0
+        link_probability = self.file_links * 6 / 1000.0
+        while length < size:
+            r = rnd.random()
+            if r < link_probability:
+                part = "[[File:{}|thumb|{}]]".format(
+                    self.file_name(rnd.randrange(self.files)), rnd.choice(WORDS))
+            elif r < 0.02:
+                part = "{{Infobox|name=" + rnd.choice(WORDS) + "}}"
+            elif r < 0.03:
+                part = "<ref>" + rnd.choice(WORDS) + " &amp; " + rnd.choice(WORDS) + "</ref>"
+            elif r < 0.05:
+                part = "[[" + rnd.choice(WORDS).capitalize() + "]]"
+            elif r < 0.07:
+                part = "\n\n== " + rnd.choice(WORDS).capitalize() + " ==\n"
+            else:
+                part = rnd.choice(WORDS)
+            parts.append(part)
+            length += len(part) + 1
+        return " ".join(parts)
+
+    def iter_pages(self):
+        """Yields (page id, title, raw bytes of the <page> node)"""
+        rnd = random.Random(self.seed)
+        namespaces = list(self.namespaces)
+        weights = [self.namespaces[ns] for ns in namespaces]
+        for n in range(self.pages):
+            page_id = n + 1
+            ns = rnd.choices(namespaces, weights)[0]
+            if ns == 6:
+                title = "File:" + self.file_name(n % self.files)
+            else:
+                title = "{}Synthetic page {:d}".format(NAMESPACE_PREFIXES.get(ns, ""), page_id)
+            parts = [PAGE.format(
+                title=escape(title).decode("utf-8"),
+                ns=ns,
+                id=page_id,
+            ).encode("utf-8")]
+            for n_revision in range(self.revisions):
+                size = int(rnd.lognormvariate(0, self.text_sigma) * self.text_size)
+                data = self.make_text(rnd, size).encode("utf-8")
+                parts.extend((
+                    REVISION.format(
+                        revision_id=page_id * 10 * self.revisions + n_revision,
+                        bytes=len(data),
+                    ).encode("utf-8"),
+                    escape(data.decode("utf-8")),
+                    REVISION_END.format(sha1=sha1_base36(data).decode("ascii")).encode("utf-8"),
+                ))
+            parts.append(PAGE_END.encode("utf-8"))
+            yield page_id, title, b"".join(parts)
+
+    def write(self, path):
+        """Write the dump, compressed if path ends with .bz2 or .gz"""
+        with compression.open_output(path) as f:
+            f.write(HEADER)
+            for __, __, raw in self.iter_pages():
+                f.write(raw)
+            f.write(FOOTER)
+
+    def write_multistream(self, path, index_path, pages_per_stream=PAGES_PER_STREAM):
+        """Write a bz2 multistream dump and its index"""
+        with open(path, "wb") as f, bz2.open(index_path, "wt", encoding="utf-8") as index:
+            f.write(bz2.compress(HEADER))
+            stream = []
+            for page_id, title, raw in self.iter_pages():
+                if len(stream) == pages_per_stream:
+                    f.write(bz2.compress(b"".join(stream)))
+                    stream = []
+                if not stream:
+                    offset = f.tell()
+                index.write("{:d}:{:d}:{}\n".format(offset, page_id, title))
+                stream.append(raw)
+            if stream:
+                f.write(bz2.compress(b"".join(stream)))
+            f.write(bz2.compress(FOOTER))
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    dump = SyntheticDump(
+        pages=arguments["--pages"],
+        text_size=arguments["--text-size"],
+        text_sigma=arguments["--text-sigma"],
+        namespaces=parse_namespaces(arguments["--namespaces"]),
+        file_links=arguments["--file-links"],
+        files=arguments["--files"],
+        revisions=arguments["--revisions"],
+        seed=arguments["--seed"],
+    )
+    if arguments["--index"]:
+        dump.write_multistream(arguments["FILE"], arguments["--index"])
+    else:
+        dump.write(arguments["FILE"])
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mwdumptools import downloader
+from mwdumptools import httpstub
+from mwdumptools import rawpages
+from mwdumptools import streamparser
+from mwdumptools.imagedownloader import ARTICLE_FILE_PATTERN
+from mwdumptools.imagedownloader import ImageDownloader
+from mwdumptools.page import Page
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+ENGINES = ("threads", "async")
+
+# Seconds to wait for the outstanding jobs, they are done long before
+JOIN_TIMEOUT = 30
+
+
+class FailingCallbacksTest(unittest.TestCase):
+
+    """Every job ends, also when handling a finished download raises"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = httpstub.serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def make_downloader(self, engine, manifest_name):
+        return ImageDownloader(
+            in_file=DUMP_FILE,
+            output=self.output,
+            namespaces=["0"],
+            revisiontext=True,
+            scale=False,
+            downloader=engine,
+            manifest=os.path.join(self.output, manifest_name),
+            dlurls=["http://127.0.0.1:{:d}/{{h1:s}}/{{h2:s}}/{{fname:s}}".format(
+                self.server.server_address[1])],
+        )
+
+    def run_downloader(self, p):
+        """Parse the dump, returns whether all jobs have ended"""
+        try:
+            streamparser.XmlStreamParser.execute(p)
+            return p.jobs.join(JOIN_TIMEOUT)
+        finally:
+            p.shutdown(0)
+
+    def test_record_fails(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                p = self.make_downloader(engine, engine + ".sqlite")
+
+                def record_image(*args, **kwargs):
+                    raise sqlite3.OperationalError("database is locked")
+
+                p.record_image = record_image
+                self.assertTrue(self.run_downloader(p))
+                self.assertEqual(p.jobs.running, 0)
+                self.assertEqual(p.get_outstanding_jobs(), [])
+
+    def test_existing_fails(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                # Download everything, so the second run finds the files
+                self.assertTrue(self.run_downloader(
+                    self.make_downloader(engine, engine + "-first.sqlite")))
+                p = self.make_downloader(engine, engine + "-second.sqlite")
+                used = []
+
+                def use_existing(fname, local_path):
+                    used.append(fname)
+                    raise OSError("Input/output error")
+
+                p.use_existing = use_existing
+                self.assertTrue(self.run_downloader(p))
+                self.assertTrue(used)
+                self.assertEqual(p.jobs.running, 0)
+
+    def test_download_callback_fails(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                p = self.make_downloader(engine, engine + ".sqlite")
+
+                def image_downloaded(*args, **kwargs):
+                    raise OSError("No space left on device")
+
+                # Bound when get_images is called
+                p.image_downloaded = image_downloaded
+                self.assertTrue(self.run_downloader(p))
+                self.assertEqual(p.jobs.running, 0)
+
+
+class IncrementalTest(unittest.TestCase):
+
+    """Page state and refreshing files across runs, against a server of its
+    own per test"""
+
+    def setUp(self):
+        self.server = httpstub.serve()
+        self.output = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.output, "manifest.sqlite")
+        self.page_state = os.path.join(self.output, "pages.sqlite")
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.output)
+
+    def run_downloader(self, **kwargs):
+        """Run a whole job, returns the ImageDownloader and the names of the
+        files that were found unchanged"""
+        kwargs.setdefault("scale", False)
+        p = ImageDownloader(
+            in_file=DUMP_FILE,
+            output=self.output,
+            namespaces=["0"],
+            revisiontext=True,
+            manifest=self.manifest,
+            output_table=False,
+            dlurls=["http://127.0.0.1:{:d}/{{h1:s}}/{{h2:s}}/{{fname:s}}".format(
+                self.server.server_address[1])],
+            **kwargs
+        )
+        unchanged = []
+        image_unchanged = p.image_unchanged
+
+        def record_unchanged(fname, local_path):
+            unchanged.append(fname)
+            image_unchanged(fname, local_path)
+
+        p.image_unchanged = record_unchanged
+        p.execute()
+        if p.page_state is not None:
+            p.page_state.close()
+        return p, sorted(unchanged)
+
+    def get_files(self):
+        """{name: (status, width, height, size)} of the manifest"""
+        connection = sqlite3.connect(self.manifest)
+        try:
+            return dict(
+                (row[0], row[1:]) for row in connection.execute(
+                    "SELECT name, status, width, height, size FROM files"))
+        finally:
+            connection.close()
+
+    def get_recorded_pages(self):
+        connection = sqlite3.connect(self.page_state)
+        try:
+            return set(page_id for page_id, in connection.execute("SELECT id FROM pages"))
+        finally:
+            connection.close()
+
+    def get_done(self):
+        return sorted(name for name, row in self.get_files().items() if row[0] == "done")
+
+    def test_failed_pages_again(self):
+        # Pages of namespace 0 and whether the server has all their files
+        pages = {}
+        with open(DUMP_FILE, "rb") as f:
+            for __, __, raw in rawpages.iter_pages(f):
+                page = Page.from_bytes(raw)
+                if page.ns == 0:
+                    extensions = [os.path.splitext(match[1])[1][1:].lower()
+                                  for match in ARTICLE_FILE_PATTERN.findall(page.text or "")]
+                    pages[page.id] = all(e in httpstub.FORMATS for e in extensions)
+        with_files = set(page_id for page_id, served in pages.items() if served)
+        self.assertTrue(set(pages) - with_files)
+
+        # Every file is missing
+        self.server.names = set()
+        self.run_downloader(page_state=self.page_state)
+        self.assertGreater(self.server.requests, 0)
+        self.assertEqual(self.get_done(), [])
+        first_run = self.get_recorded_pages()
+        self.assertTrue(first_run)
+        self.assertFalse(first_run & (set(pages) - with_files))
+
+        self.server.names = None
+        requests = self.server.requests
+        p, __ = self.run_downloader(page_state=self.page_state)
+        self.assertGreater(self.server.requests, requests)
+        self.assertTrue(self.get_done())
+        self.assertEqual(p.pages_processed, len(pages) - len(first_run))
+        # Pages with files the server doesn't have stay out
+        self.assertEqual(self.get_recorded_pages(), with_files)
+
+    def test_not_modified(self):
+        self.run_downloader()
+        done = self.get_done()
+        self.assertTrue(done)
+        self.assertEqual(self.server.not_modified, 0)
+        requests = self.server.requests
+        __, unchanged = self.run_downloader(refresh=True)
+        # Files that failed are tried again, those that are done are asked
+        # for with If-None-Match
+        self.assertEqual(self.server.not_modified, len(done))
+        self.assertGreater(self.server.requests, requests + len(done))
+        self.assertEqual(unchanged, done)
+        self.assertEqual(self.get_done(), done)
+
+    def test_same_sha1(self):
+        self.run_downloader()
+        done = self.get_done()
+        # Validators the server doesn't know, it sends the file again
+        connection = sqlite3.connect(self.manifest)
+        connection.execute("UPDATE files SET etag = '\"stale\"', last_modified = NULL")
+        connection.commit()
+        connection.close()
+        __, unchanged = self.run_downloader(refresh=True)
+        self.assertEqual(self.server.not_modified, 0)
+        self.assertEqual(unchanged, done)
+
+    def test_refresh_changed_original(self):
+        self.run_downloader(scale=True, keep_original=True)
+        before = self.get_files()
+        done = self.get_done()
+        self.assertTrue(done)
+        self.assertEqual(before[done[0]][1:3], httpstub.IMAGE_SIZE)
+        # The server has new versions of all files
+        size = (800, 600)
+        self.server.images = dict(
+            (extension, httpstub.make_image(extension, size)) for extension in httpstub.FORMATS)
+        p, unchanged = self.run_downloader(scale=True, keep_original=True, refresh=True)
+        self.assertEqual(unchanged, [])
+        after = self.get_files()
+        for fname in done:
+            local_path = p.get_local_path(*p.get_hash(fname), fname)
+            with open(local_path, "rb") as f:
+                data = f.read()
+            extension = os.path.splitext(fname)[1][1:].lower()
+            self.assertEqual(data, self.server.images[extension])
+            self.assertEqual(after[fname], ("done",) + size + (len(data),))
+
+    def test_conditional_headers(self):
+        self.assertEqual(downloader.conditional_headers(), {})
+        self.assertEqual(
+            downloader.conditional_headers('"abc"', "Wed, 21 Oct 2015 07:28:00 GMT"),
+            {"If-None-Match": '"abc"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mwdumptools import imagetable
+
+ROWS = [
+    ("Example.jpg", 800, 600, 12345),
+    ("Quote's.png", 20, 10, 300),
+    ("Back\\slash.gif", 1, 1, 43),
+    ("Tab\tand\nnewline\r.svg", None, None, 0),
+    ("नेपाल.jpg", 1024, 768, 99999),
+    ("Last.jpg", 3, 4, 5),
+    ("Seventh.png", 6, 7, 8),
+]
+
+BATCH_SIZE = 3
+
+
+def write(writer):
+    for row in ROWS:
+        writer.write(*row)
+    writer.close()
+
+
+class ImageTableTest(unittest.TestCase):
+
+    def test_sql(self):
+        output = io.StringIO()
+        write(imagetable.SQLWriter(output, BATCH_SIZE))
+        statements = output.getvalue().split(";\n")
+        # Nothing after the last statement
+        self.assertEqual(statements.pop(), "")
+        self.assertEqual(len(statements), 3)
+        for statement, rows in zip(statements, (ROWS[:3], ROWS[3:6], ROWS[6:])):
+            lines = statement.splitlines()
+            self.assertEqual(lines[0] + "\n", imagetable.SQL_INSERT)
+            self.assertEqual(lines[-1][-1], ")")
+            self.assertEqual(statement.count("\n('"), len(rows))
+        self.assertIn("('Quote''s.png', '20', '10', '300'),\n", statements[0])
+        self.assertIn("('Back\\\\slash.gif', '1', '1', '43')", statements[0])
+        # Missing sizes are written as 0
+        self.assertIn("', '0', '0', '0'),\n", statements[1])
+
+    def test_tsv(self):
+        output = io.StringIO()
+        write(imagetable.TSVWriter(output, BATCH_SIZE))
+        lines = output.getvalue().split("\n")
+        self.assertEqual(lines.pop(), "")
+        self.assertEqual(len(lines), len(ROWS))
+        self.assertEqual(lines[0], "Example.jpg\t800\t600\t12345")
+        self.assertEqual(lines[2], "Back\\\\slash.gif\t1\t1\t43")
+        self.assertEqual(lines[3], "Tab\\tand\\nnewline\\r.svg\t0\t0\t0")
+        self.assertEqual(lines[4], "नेपाल.jpg\t1024\t768\t99999")
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "image.sqlite")
+        # Larger than the number of rows, so all are written by close()
+        writer = imagetable.SQLiteWriter(path, len(ROWS) + 1)
+        for row in ROWS:
+            writer.write(*row)
+        writer.close()
+        connection = sqlite3.connect(path)
+        self.addCleanup(connection.close)
+        rows = connection.execute(
+            "SELECT img_name, img_width, img_height, img_size FROM image").fetchall()
+        self.assertEqual(sorted(rows), sorted(
+            (name, width or 0, height or 0, filesize) for name, width, height, filesize in ROWS))
+
+    def test_get_writer(self):
+        for table_format, writer_class in ((imagetable.FORMAT_SQL, imagetable.SQLWriter),
+                                           (imagetable.FORMAT_TSV, imagetable.TSVWriter)):
+            with self.subTest(table_format=table_format):
+                writer = imagetable.get_writer(table_format, io.StringIO(), BATCH_SIZE)
+                self.assertIsInstance(writer, writer_class)
+                self.assertEqual(writer.batch_size, BATCH_SIZE)
+        writer = imagetable.get_writer(imagetable.FORMAT_SQLITE, ":memory:")
+        self.assertIsInstance(writer, imagetable.SQLiteWriter)
+        self.assertEqual(writer.batch_size, imagetable.DEFAULT_BATCH_SIZE)
+        writer.close()
+        with self.assertRaises(ValueError):
+            imagetable.get_writer("csv", io.StringIO())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import unittest
+import xml.etree.ElementTree as ET
+
+from mwdumptools import rawpages
+from mwdumptools.page import Page
+from mwdumptools.page import Revision
+from mwdumptools.page import escape
+from mwdumptools.page import unescape
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+TEXTS = [
+    "",
+    "Plain text",
+    'Quotes " and \' and <tags attr="1"> & entities &amp; &lt;',
+    "&#39; &#x27; stay literal",
+    "नेपाल\nमा\tउनीहरू",
+]
+
+PAGE_TEMPLATE = """<page>
+    <title>{title}</title>
+    <ns>0</ns>
+    <id>7</id>
+    <redirect title="{title}" />
+    <revision>
+      <id>100</id>
+      <timestamp>2013-01-01T00:00:00Z</timestamp>
+      <contributor>
+        <username>Example</username>
+        <id>55</id>
+      </contributor>
+      {first}
+      <sha1>first</sha1>
+    </revision>
+    <revision>
+      <id>101</id>
+      <parentid>100</parentid>
+      <timestamp>2013-01-02T00:00:00Z</timestamp>
+      {second}
+      <sha1>second</sha1>
+    </revision>
+  </page>
+"""
+
+
+def make_page(title="Example", first='<text xml:space="preserve">First</text>',
+              second='<text xml:space="preserve">Second</text>'):
+    return PAGE_TEMPLATE.format(title=title, first=first, second=second).encode("utf-8")
+
+
+def read_raw_pages():
+    with open(DUMP_FILE, "rb") as f:
+        return [raw for __, __, raw in rawpages.iter_pages(f)]
+
+
+def fields(page):
+    return (page.id, page.ns, page.title, page.redirect,
+            [(r.id, r.parentid, r.timestamp, r.sha1, r.text) for r in page.revisions])
+
+
+class PageTest(unittest.TestCase):
+
+    def test_from_element(self):
+        raw_pages = read_raw_pages()
+        for raw in raw_pages:
+            page = Page.from_bytes(raw)
+            with self.subTest(title=page.title):
+                self.assertEqual(fields(page), fields(Page.from_element(ET.fromstring(raw))))
+        self.assertTrue(any(Page.from_bytes(raw).redirect for raw in raw_pages))
+        raw = make_page()
+        self.assertEqual(fields(Page.from_bytes(raw)),
+                         fields(Page.from_element(ET.fromstring(raw))))
+
+    def test_fields(self):
+        page = Page.from_bytes(make_page())
+        self.assertEqual((page.id, page.ns, page.title, page.redirect),
+                         (7, 0, "Example", "Example"))
+        # The <id> of the contributor is not the one of the revision
+        self.assertEqual([(r.id, r.parentid) for r in page.revisions],
+                         [(100, None), (101, 100)])
+        # Those of the last revision
+        self.assertEqual((page.text, page.timestamp, page.sha1),
+                         ("Second", "2013-01-02T00:00:00Z", "second"))
+        self.assertIs(page.revision, page.revisions[-1])
+        self.assertEqual(page.raw, make_page())
+        empty = Page(id=1)
+        self.assertIsNone(empty.revision)
+        self.assertIsNone(empty.text)
+        self.assertIsNone(empty.raw)
+
+    def test_unescape(self):
+        raw = make_page(
+            title="Q&amp;A &quot;x&quot; &#2344;&#x947;",
+            second='<text xml:space="preserve">&lt;b&gt;&amp;lt;&apos;&#39;&#x27;</text>')
+        page = Page.from_bytes(raw)
+        self.assertEqual(page.title, 'Q&A "x" ने')
+        self.assertEqual(page.redirect, page.title)
+        # &amp; is decoded last, only once
+        self.assertEqual(page.text, "<b>&lt;'''")
+        self.assertEqual(fields(page), fields(Page.from_element(ET.fromstring(raw))))
+
+    def test_empty_and_deleted(self):
+        for text, expected in (('<text xml:space="preserve" />', ""),
+                               ('<text bytes="0" xml:space="preserve"></text>', ""),
+                               ('<text deleted="deleted" />', None),
+                               ("", None)):
+            with self.subTest(text=text):
+                raw = make_page(second=text)
+                for page in (Page.from_bytes(raw), Page.from_element(ET.fromstring(raw))):
+                    self.assertEqual(page.text, expected)
+                    self.assertEqual(page.sha1, "second")
+                    self.assertEqual(page.revisions[0].text, "First")
+
+    def test_lazy_text(self):
+        raw = make_page()
+        page = Page.from_bytes(raw)
+        revision = page.revision
+        self.assertIsNone(revision._text)
+        start, end = revision.text_span
+        self.assertEqual(raw[start:end], b"Second")
+        self.assertEqual(revision.text_bytes, b"Second")
+        self.assertIsNone(revision._text)
+        self.assertEqual(revision.text, "Second")
+        # Decoded once, the raw bytes are no longer needed
+        self.assertIsNone(revision._raw)
+        self.assertEqual(revision.text_span, (start, end))
+        self.assertEqual(revision.text_bytes, b"Second")
+        self.assertIsNone(Revision(text="Text").text_span)
+
+    def test_pickle(self):
+        raw = make_page(title="&quot;Pickled&quot;")
+        for materialize in (False, True):
+            with self.subTest(materialize=materialize):
+                page = Page.from_bytes(raw)
+                if materialize:
+                    page.text
+                copy = pickle.loads(pickle.dumps(page, pickle.HIGHEST_PROTOCOL))
+                self.assertEqual(fields(copy), fields(Page.from_bytes(raw)))
+                self.assertEqual(copy.raw, raw)
+                self.assertFalse(hasattr(copy, "__dict__"))
+
+    def test_escape_round_trip(self):
+        for text in TEXTS:
+            with self.subTest(text=text):
+                self.assertEqual(unescape(escape(text)), text)
+                # Escaped the same way, read from bytes or not
+                self.assertEqual(Revision(text=text).text_bytes, escape(text))
+                raw = make_page(second='<text xml:space="preserve">{}</text>'.format(
+                    escape(text).decode("utf-8")))
+                revision = Page.from_bytes(raw).revision
+                self.assertEqual(revision.text_bytes, escape(text))
+                self.assertEqual(revision.text, text)
+                self.assertEqual(Revision(text=revision.text).text_bytes, escape(text))
+        self.assertEqual(escape('a "b" <c> & d'), b"a &quot;b&quot; &lt;c&gt; &amp; d")
+        self.assertIsNone(Revision().text_bytes)
+
+    def test_dump_round_trip(self):
+        """Texts of the dump are escaped back to their bytes in the dump"""
+        for raw in read_raw_pages():
+            revision = Page.from_bytes(raw).revision
+            text_bytes = revision.text_bytes
+            with self.subTest(id=revision.id):
+                self.assertEqual(escape(revision.text), text_bytes)
+                self.assertEqual(Revision(text=revision.text).text_bytes, text_bytes)
+
+
+if __name__ == "__main__":
+    unittest.main()
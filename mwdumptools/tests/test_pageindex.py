@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from mwdumptools import pageindex
+from mwdumptools import rawpages
+from mwdumptools.page import Page
+from mwdumptools.tests.test_streamparser import PAGES_PER_STREAM
+from mwdumptools.tests.test_streamparser import write_multistream
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+# Records and titles sorted in memory at a time, so building spills runs
+SORT_RUN_SIZE = 7
+
+
+class PageIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.multistream = os.path.join(cls.directory, "dump.xml.bz2")
+        write_multistream(cls.multistream, os.path.join(cls.directory, "index.txt"))
+        with open(DUMP_FILE, "rb") as f:
+            cls.pages = [raw for __, __, raw in rawpages.iter_pages(f)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def build(self, dump_file):
+        index_name = os.path.basename(dump_file) + ".pageindex"
+        index_file = os.path.join(self.directory, index_name)
+        before = set(os.listdir(self.directory))
+        with mock.patch.object(pageindex, "SORT_RUN_SIZE", SORT_RUN_SIZE):
+            self.assertEqual(pageindex.build_index(dump_file, index_file), len(self.pages))
+        # Neither runs nor the temporary index are left behind
+        self.assertLessEqual(set(os.listdir(self.directory)) - before, {index_name})
+        dump = pageindex.IndexedDump(dump_file, index_file)
+        self.addCleanup(dump.close)
+        return dump
+
+    def assert_lookups(self, dump):
+        page_ids = [entry.page_id for entry in dump.index]
+        self.assertEqual(page_ids, sorted(Page.from_bytes(raw).id for raw in self.pages))
+        for raw in self.pages:
+            page = Page.from_bytes(raw)
+            entry = dump.find(title=page.title)
+            self.assertEqual((entry.page_id, entry.ns), (page.id, page.ns))
+            self.assertEqual(dump.get_raw(entry), raw)
+            self.assertEqual(dump.find(page_id=page.id), entry)
+        self.assertIsNone(dump.find(title="No such page"))
+        self.assertIsNone(dump.find(page_id=max(page_ids) + 1))
+        self.assertIsNone(dump.find(page_id=0))
+
+    def test_plain(self):
+        dump = self.build(DUMP_FILE)
+        self.assertEqual(dump.index.kind, pageindex.KIND_PLAIN)
+        self.assert_lookups(dump)
+
+    def test_multistream(self):
+        dump = self.build(self.multistream)
+        self.assertEqual(dump.index.kind, pageindex.KIND_MULTISTREAM)
+        self.assert_lookups(dump)
+
+    def test_underscores(self):
+        dump = self.build(DUMP_FILE)
+        page = next(page for page in map(Page.from_bytes, self.pages) if " " in page.title)
+        self.assertEqual(dump.find(title=page.title.replace(" ", "_")).page_id, page.id)
+
+    def test_iter_raw(self):
+        dump = self.build(self.multistream)
+        pages = [Page.from_bytes(raw) for raw in self.pages]
+        # In dump order, missing ones left out
+        found = list(dump.iter_raw(
+            titles=[pages[40].title, "No such page"], page_ids=[pages[3].id, 0]))
+        self.assertEqual([raw for __, raw in found], [self.pages[3], self.pages[40]])
+
+    def test_stream_cache(self):
+        dump = self.build(self.multistream)
+        pages = [Page.from_bytes(raw) for raw in self.pages]
+        # A page of each of three streams
+        first, second, third = (pages[n * PAGES_PER_STREAM] for n in range(3))
+        with mock.patch.object(pageindex, "STREAM_CACHE_SIZE", 2), \
+                mock.patch.object(pageindex.bz2, "decompress",
+                                  wraps=pageindex.bz2.decompress) as decompress:
+            for page in (first, second, first, third, first, second):
+                entry = dump.find(page_id=page.id)
+                self.assertEqual(Page.from_bytes(dump.get_raw(entry)).title, page.title)
+            # The second was evicted by the third, the first was used since
+            self.assertEqual(decompress.call_count, 4)
+            self.assertEqual(len(dump.streams), 2)
+            # Other pages of cached streams are read without decompressing
+            dump.get_raw(dump.find(page_id=pages[PAGES_PER_STREAM + 1].id))
+            self.assertEqual(decompress.call_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
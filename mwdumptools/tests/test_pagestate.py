@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwdumptools import pagestate
+from mwdumptools import rawpages
+from mwdumptools import streamparser
+from mwdumptools.page import Page
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+PAGES = 75
+
+
+def read_raw_pages():
+    with open(DUMP_FILE, "rb") as f:
+        return [raw for __, __, raw in rawpages.iter_pages(f)]
+
+
+class IdParser(streamparser.XmlStreamParser):
+
+    def __init__(self, **kwargs):
+        streamparser.XmlStreamParser.__init__(self, **kwargs)
+        self.handled = []
+
+    def handle_page(self, page):
+        self.handled.append(page.id)
+
+
+class PageStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "pages.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_key(self):
+        for raw in read_raw_pages():
+            page = Page.from_bytes(raw)
+            self.assertEqual(pagestate.read_key(raw),
+                             (page.id, page.revision.id, page.sha1))
+
+    def test_changed(self):
+        state = pagestate.PageState(self.path)
+        state.add([(1, 10, "a"), None])
+        self.assertTrue(state.is_unchanged((1, 10, "a")))
+        # A new revision, or the same one with another text
+        self.assertFalse(state.is_unchanged((1, 11, "a")))
+        self.assertFalse(state.is_unchanged((1, 10, "b")))
+        self.assertFalse(state.is_unchanged((2, 10, "a")))
+        self.assertFalse(state.is_unchanged((1, None, None)))
+        self.assertFalse(state.is_unchanged(None))
+        state.close()
+        state = pagestate.PageState(self.path)
+        self.assertEqual(len(state), 1)
+        self.assertTrue(state.is_unchanged((1, 10, "a")))
+        state.close()
+
+    def parse(self, in_file, engine):
+        p = IdParser(in_file=in_file, page_state=self.path, engine=engine)
+        p.execute()
+        p.page_state.close()
+        return p
+
+    def test_skip_unchanged(self):
+        raw_pages = read_raw_pages()
+        changed = Page.from_bytes(raw_pages[10])
+        # The same dump with another text of one page
+        changed_file = os.path.join(self.directory, "changed.xml")
+        with open(DUMP_FILE, "rb") as f:
+            dump = f.read()
+        old_sha1 = "<sha1>{}</sha1>".format(changed.sha1).encode("ascii")
+        self.assertEqual(dump.count(old_sha1), 1)
+        with open(changed_file, "wb") as f:
+            f.write(dump.replace(old_sha1, b"<sha1>changed</sha1>"))
+        for engine in (streamparser.ENGINE_LINES, streamparser.ENGINE_PULL):
+            with self.subTest(engine=engine):
+                p = self.parse(DUMP_FILE, engine)
+                self.assertEqual(len(p.handled), PAGES)
+                p = self.parse(DUMP_FILE, engine)
+                self.assertEqual(p.handled, [])
+                self.assertEqual(p.pages_skipped, PAGES)
+                p = self.parse(changed_file, engine)
+                self.assertEqual(p.handled, [changed.id])
+                os.remove(self.path)
+
+
+class PendingPagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = pagestate.PageState(os.path.join(self.directory, "pages.sqlite"))
+        self.pending = pagestate.PendingPages(self.state)
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.directory)
+
+    def recorded(self):
+        return sorted(page_id for page_id, in self.state.connection.execute(
+            "SELECT id FROM pages"))
+
+    def test_without_jobs(self):
+        self.pending.add([(1, 10, "a"), (2, 20, "b")])
+        self.assertEqual(self.recorded(), [1, 2])
+
+    def test_jobs_succeed(self):
+        self.pending.start("a.jpg")
+        self.pending.start("b.jpg")
+        self.pending.add([(1, 10, "a")])
+        # A job that is running already
+        self.pending.depend("b.jpg")
+        self.pending.add([(2, 20, "b")])
+        self.pending.end("b.jpg")
+        self.assertEqual(self.recorded(), [2])
+        self.pending.end("a.jpg")
+        self.assertEqual(self.recorded(), [1, 2])
+
+    def test_job_ended_before_add(self):
+        self.pending.start("a.jpg")
+        self.pending.end("a.jpg")
+        self.pending.add([(1, 10, "a")])
+        self.assertEqual(self.recorded(), [1])
+
+    def test_job_fails(self):
+        self.pending.start("a.jpg")
+        self.pending.start("b.jpg")
+        self.pending.add([(1, 10, "a")])
+        self.pending.end("a.jpg", ok=False)
+        self.pending.end("b.jpg")
+        # Pages needing the failed file later in the run
+        self.pending.depend("a.jpg")
+        self.pending.add([(2, 20, "b")])
+        # Done in an earlier run
+        self.pending.depend("c.jpg")
+        self.pending.add([(3, 30, "c")])
+        self.assertEqual(self.recorded(), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwdumptools import pagestore
+from mwdumptools import rawpages
+from mwdumptools.page import Page
+from mwdumptools.tests.test_streamparser import write_multistream
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+PAGES = 75
+
+# Shards of 20 pages in row groups of 7, so both end with a partial one
+SHARD_PAGES = 20
+ROW_GROUP_PAGES = 7
+
+
+def read_rows():
+    """The rows of the pages of the fixture, in dump order"""
+    with open(DUMP_FILE, "rb") as f:
+        return [pagestore.page_row(Page.from_bytes(raw))
+                for __, __, raw in rawpages.iter_pages(f)]
+
+
+class PageStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rows = read_rows()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, "pages")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, in_file=DUMP_FILE, **kwargs):
+        p = pagestore.PageExporter(self.output, in_file=in_file, shard_pages=SHARD_PAGES,
+                                   **kwargs)
+        p.execute()
+        return pagestore.PageStore(self.output)
+
+    def assert_round_trip(self, store_format):
+        writer = pagestore.PageStoreWriter(self.output, store_format, SHARD_PAGES,
+                                           ROW_GROUP_PAGES)
+        for row in self.rows:
+            writer.write(row)
+        writer.close()
+        store = pagestore.PageStore(self.output)
+        self.assertEqual(len(store), PAGES)
+        self.assertEqual([shard["pages"] for shard in store.shards], [20, 20, 20, 15])
+        with open(os.path.join(self.output, pagestore.STORE_FILENAME)) as f:
+            self.assertEqual(json.load(f)["format"], store_format)
+        rows = [tuple(row[name] for name in pagestore.COLUMN_NAMES)
+                for row in store.iter_rows()]
+        self.assertEqual(rows, self.rows)
+        # Only some columns, some shards
+        self.assertEqual(
+            list(store.iter_rows(["title", "id"], shards=[1])),
+            [{"title": row[2], "id": row[0]} for row in self.rows[20:40]])
+        pages = list(store.iter_pages(["title"]))
+        self.assertEqual([page.title for page in pages], [row[2] for row in self.rows])
+        self.assertIsNone(pages[0].id)
+        self.assertIsNone(pages[0].text)
+
+    def test_columnar(self):
+        self.assert_round_trip(pagestore.FORMAT_COLUMNAR)
+
+    @unittest.skipIf(pagestore.pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        self.assert_round_trip(pagestore.FORMAT_PARQUET)
+
+    def test_export(self):
+        store = self.export()
+        self.assertEqual([tuple(row.values()) for row in store.iter_rows()], self.rows)
+
+    def test_pipeline(self):
+        store = self.export(pipeline=True, parse_processes=2, batch_size=7)
+        self.assertEqual([tuple(row.values()) for row in store.iter_rows()], self.rows)
+
+    def test_multistream(self):
+        multistream = os.path.join(self.directory, "dump.xml.bz2")
+        index = os.path.join(self.directory, "index.txt")
+        write_multistream(multistream, index)
+        store = self.export(in_file=multistream, index=index, parse_processes=2)
+        self.assertEqual(sum(shard["pages"] for shard in store.shards), PAGES)
+        # The order is not defined
+        self.assertEqual(sorted(tuple(row.values()) for row in store.iter_rows()),
+                         sorted(self.rows))
+
+    def test_namespaces(self):
+        store = self.export(namespaces=["10"])
+        self.assertEqual([row["id"] for row in store.iter_rows(["id"])],
+                         [row[0] for row in self.rows if row[1] == 10])
+
+    def test_unknown(self):
+        store = self.export()
+        with self.assertRaises(ValueError):
+            list(store.iter_rows(["title", "size"]))
+        with self.assertRaises(ValueError):
+            pagestore.PageExporter(self.output, in_file=DUMP_FILE, format="csv")
+
+    def test_tsv(self):
+        store = self.export()
+        output = io.StringIO()
+        pagestore.write_tsv(store, ["id", "title"], output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "id\ttitle")
+        self.assertEqual(lines[1:], ["{:d}\t{}".format(row[0], row[2]) for row in self.rows])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import bz2
+import io
+import os
+import random
+import unittest
+from unittest import mock
+
+from mwdumptools import compression
+from mwdumptools import parallelbz2
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+PROCESSES = 2
+
+
+def make_text(size, seed=1):
+    """Text that compresses to blocks of varied bits"""
+    rnd = random.Random(seed)
+    words = [b"page", b"title", b"revision", b"text", b"wiki", b"File:", b"[[", b"]]"]
+    parts = []
+    while size > 0:
+        part = rnd.choice(words) + str(rnd.randrange(100000)).encode("ascii") + b" "
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+
+def decompress(data, read_size=parallelbz2.READ_SIZE):
+    with mock.patch.object(parallelbz2, "READ_SIZE", read_size):
+        with parallelbz2.open_parallel(io.BytesIO(data), PROCESSES) as f:
+            return f.read()
+
+
+def magic_bytes(data, magic, needles):
+    """Byte offsets of the magics in data"""
+    return [offset // 8 for offset in parallelbz2.find_magic(data, magic, needles)]
+
+
+class ParallelBz2Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(DUMP_FILE, "rb") as f:
+            cls.dump = f.read()
+        # Blocks of 100 kB with compresslevel=1
+        cls.text = make_text(1200 * 1000)
+        cls.single = bz2.compress(cls.text, 1)
+        # A stream every ~100 pages, like multistream dumps
+        cls.streams = [cls.dump[n:n + 20000] for n in range(0, len(cls.dump), 20000)]
+        cls.multistream = b"".join(bz2.compress(stream, 1) for stream in cls.streams)
+
+    def test_single_stream(self):
+        blocks = magic_bytes(self.single, parallelbz2.BLOCK_MAGIC, parallelbz2.BLOCK_NEEDLES)
+        self.assertGreater(len(blocks), 10)
+        self.assertEqual(decompress(self.single), self.text)
+
+    def test_multistream(self):
+        ends = magic_bytes(self.multistream, parallelbz2.END_OF_STREAM_MAGIC,
+                           parallelbz2.END_OF_STREAM_NEEDLES)
+        self.assertEqual(len(ends), len(self.streams))
+        self.assertEqual(decompress(self.multistream), self.dump)
+
+    def test_close_early(self):
+        f = parallelbz2.open_parallel(io.BytesIO(self.multistream), PROCESSES)
+        self.assertEqual(f.read(50000), self.dump[:50000])
+        f.close()
+        self.assertTrue(f.closed)
+
+    def test_empty_streams(self):
+        data = bz2.compress(b"") + bz2.compress(b"abc") + bz2.compress(b"")
+        self.assertEqual(decompress(data), b"abc")
+
+    def test_magic_on_read_edge(self):
+        """Every magic found, whichever byte of it a read ends in"""
+        for data, expected in ((self.single, self.text), (self.multistream, self.dump)):
+            magics = (magic_bytes(data, parallelbz2.BLOCK_MAGIC, parallelbz2.BLOCK_NEEDLES) +
+                      magic_bytes(data, parallelbz2.END_OF_STREAM_MAGIC,
+                                  parallelbz2.END_OF_STREAM_NEEDLES))
+            for magic in magics[1:4]:
+                for edge in range(magic - 1, magic + parallelbz2.MAGIC_WINDOW + 1):
+                    with self.subTest(edge=edge):
+                        self.assertEqual(decompress(data, edge), expected)
+
+    def test_small_reads(self):
+        # Reads shorter than a magic number
+        self.assertEqual(decompress(bz2.compress(self.dump[:30000], 1), 5),
+                         self.dump[:30000])
+
+    def test_truncated(self):
+        ends = magic_bytes(self.single, parallelbz2.END_OF_STREAM_MAGIC,
+                           parallelbz2.END_OF_STREAM_NEEDLES)
+        blocks = magic_bytes(self.single, parallelbz2.BLOCK_MAGIC, parallelbz2.BLOCK_NEEDLES)
+        cuts = [4, 100, blocks[3], blocks[3] + 1, blocks[-1] + 100,
+                ends[-1], ends[-1] + 3, ends[-1] + 7, len(self.single) - 1]
+        for cut in cuts:
+            with self.subTest(cut=cut):
+                # Like bz2
+                with self.assertRaises(EOFError):
+                    bz2.BZ2File(io.BytesIO(self.single[:cut])).read()
+                with self.assertRaises(EOFError):
+                    decompress(self.single[:cut])
+
+    def test_truncated_multistream(self):
+        data = self.multistream[:len(self.multistream) - len(bz2.compress(self.streams[-1], 1))]
+        # Complete streams are fine
+        self.assertEqual(decompress(data), b"".join(self.streams[:-1]))
+        with self.assertRaises(EOFError):
+            decompress(data[:-2])
+
+    def test_truncated_output(self):
+        """The data before the end that has been cut off is returned first"""
+        blocks = magic_bytes(self.single, parallelbz2.BLOCK_MAGIC, parallelbz2.BLOCK_NEEDLES)
+        with parallelbz2.open_parallel(io.BytesIO(self.single[:blocks[5] + 100]),
+                                       PROCESSES) as f:
+            self.assertEqual(f.read(len(self.text) // 3), self.text[:len(self.text) // 3])
+            with self.assertRaises(EOFError):
+                f.read()
+
+
+class OpenInputTest(unittest.TestCase):
+
+    def test_one_process(self):
+        data = bz2.compress(b"abc")
+        with mock.patch.object(os, "cpu_count", return_value=1):
+            self.assertIsInstance(compression.open_input(io.BytesIO(data)), bz2.BZ2File)
+        self.assertIsInstance(compression.open_input(io.BytesIO(data), 1), bz2.BZ2File)
+        f = compression.open_input(io.BytesIO(data), 2)
+        self.assertNotIsInstance(f, bz2.BZ2File)
+        self.assertEqual(f.read(), b"abc")
+        f.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
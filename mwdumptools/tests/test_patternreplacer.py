@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import tempfile
+import unittest
+
+from mwdumptools import rawpages
+from mwdumptools.page import Page, escape, sha1_base36
+from mwdumptools.patternreplacer import PatternReplacer
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.8/" version="0.8" xml:lang="tr">
+  <siteinfo>
+    <sitename>Vikipedi</sitename>
+  </siteinfo>
+  <page>
+    <title>Test</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>10</id>
+      <timestamp>2013-07-02T00:00:00Z</timestamp>
+      <text xml:space="preserve" bytes="0">{}</text>
+      <sha1>0000000000000000000000000000000</sha1>
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+# (replacements, ignore_case, text) where str.lower() and re.IGNORECASE
+# disagree
+NON_ASCII_CASES = [
+    ([("İstanbul", "Konstantiniye")], False, "İstanbul büyük"),
+    # Found again by the set of text patterns, once the first pair changed
+    # the text
+    ([("büyük", "large"), ("İstanbul", "Konstantiniye")], False, "İstanbul büyük"),
+    ([("istanbul", "X")], True, "İSTANBUL"),
+    ([("İstanbul", "X")], True, "ıstanbul &amp; İstanbul"),
+    ([("first", "1st")], True, "the firſt &lt; day"),
+    ([("kelvin", "K")], True, "0 \u212aELVIN"),
+    ([("σοφίας", "sophia")], True, "ΣΟΦΊΑΣ σοφίαϲ"),
+]
+
+
+def replace_each(replacements, ignore_case, text):
+    flags = re.IGNORECASE if ignore_case else 0
+    for search, replace in replacements:
+        text = re.sub(search, replace, text, flags=flags)
+    return text
+
+
+def read_pages(data):
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.seek(0)
+        return [raw for __, __, raw in rawpages.iter_pages(f)]
+
+
+class PatternReplacerTest(unittest.TestCase):
+
+    def replace(self, replacements, ignore_case, in_file):
+        with tempfile.TemporaryDirectory() as tmp:
+            out_file = os.path.join(tmp, "out.xml")
+            p = PatternReplacer(replacements, in_file=in_file, out_file=out_file,
+                                ignore_case=ignore_case)
+            p.execute()
+            with open(out_file, "rb") as f:
+                return f.read()
+
+    def assert_replaced(self, replacements, ignore_case, raw_in, raw_out):
+        revisions_in = Page.from_bytes(raw_in).revisions
+        revisions_out = Page.from_bytes(raw_out).revisions
+        self.assertEqual(len(revisions_in), len(revisions_out))
+        for before, after in zip(revisions_in, revisions_out):
+            expected = replace_each(replacements, ignore_case, before.text or "")
+            self.assertEqual(after.text or "", expected)
+            if expected == (before.text or ""):
+                continue
+            data = expected.encode("utf-8")
+            if b'bytes="' in raw_in:
+                self.assertIn(b'bytes="%d"' % len(data), raw_out)
+            self.assertEqual(after.sha1, sha1_base36(data).decode("ascii"))
+
+    def test_non_ascii(self):
+        for replacements, ignore_case, text in NON_ASCII_CASES:
+            with tempfile.TemporaryDirectory() as tmp:
+                in_file = os.path.join(tmp, "in.xml")
+                with open(in_file, "wb") as f:
+                    f.write(DUMP.format(escape(text).decode("utf-8")).encode("utf-8"))
+                data = self.replace(replacements, ignore_case, in_file)
+                with open(in_file, "rb") as f:
+                    raw_in, = read_pages(f.read())
+            raw_out, = read_pages(data)
+            self.assertNotEqual(raw_in, raw_out, (replacements, text))
+            self.assert_replaced(replacements, ignore_case, raw_in, raw_out)
+
+    def test_fixture(self):
+        replacements = [(r"\[\[File:", "[[चित्र:"), (r"नेपाल", "Nepal"),
+                        (r"(\d{4})", r"<\1>"), (r"wiki", "Wiki")]
+        with open(DUMP_FILE, "rb") as f:
+            pages_in = read_pages(f.read())
+        for ignore_case in (False, True):
+            pages_out = read_pages(self.replace(replacements, ignore_case, DUMP_FILE))
+            self.assertEqual(len(pages_in), len(pages_out))
+            changed = 0
+            for raw_in, raw_out in zip(pages_in, pages_out):
+                self.assert_replaced(replacements, ignore_case, raw_in, raw_out)
+                changed += raw_in != raw_out
+            self.assertTrue(changed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import unittest
+from unittest import mock
+
+from mwdumptools import patterns
+from mwdumptools import rawpages
+from mwdumptools.page import Page, escape
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+FIXTURE_PATTERNS = [
+    r"\[\[File:([^|\]]+)",
+    r"\[\[(?:Image|File|चित्र):",
+    r"https?://\S+",
+    r"\{\{[Ii]nfobox",
+    r"(?i:category)",
+    r"नेपाल",
+    r"[Tt]he (\w+)",
+    r"\d{4}",
+    r"foo|bar|wiki",
+    r"(?:wiki)+pedia",
+    r"&lt;ref",
+    r"<ref[^>]*>",
+]
+
+# (patterns, flags, text) where str.lower() and re.IGNORECASE disagree
+NON_ASCII_CASES = [
+    (["İstanbul"], 0, "İstanbul is big"),
+    (["istanbul"], re.IGNORECASE, "İSTANBUL"),
+    (["İstanbul"], re.IGNORECASE, "istanbul ıstanbul ISTANBUL"),
+    (["istanbul", "İSTANBUL"], re.IGNORECASE, "İstanbul"),
+    (["first"], re.IGNORECASE, "firſt FIRST"),
+    (["firſt"], 0, "firſt first"),
+    (["kelvin"], re.IGNORECASE, "KELVIN"),
+    (["straße"], re.IGNORECASE, "STRASSE strasse STRAẞE"),
+    (["σοφίας"], re.IGNORECASE, "ΣΟΦΊΑΣ σοφίαϲ σοφίασ"),
+    (["ǅemal"], re.IGNORECASE, "Ǆemal ǆEMAL"),
+    (["ﬅop"], re.IGNORECASE, "ﬆop STOP"),
+]
+
+
+def read_texts():
+    texts = []
+    with open(DUMP_FILE, "rb") as f:
+        for __, __, raw in rawpages.iter_pages(f):
+            texts.extend(revision.text for revision in Page.from_bytes(raw).revisions
+                         if revision.text)
+    return texts
+
+
+def count_each(patterns_list, flags, text):
+    """What PatternSet.count() returns, from every pattern on its own"""
+    counts = {}
+    for index, pattern in enumerate(patterns_list):
+        n = sum(1 for __ in re.finditer(pattern, text, flags))
+        if n:
+            counts[index] = n
+    return counts
+
+
+class PatternSetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.texts = read_texts()
+
+    def assert_counts(self, patterns_list, flags, texts):
+        pattern_set = patterns.PatternSet(patterns_list, flags)
+        for text in texts:
+            self.assertEqual(pattern_set.count(text), count_each(patterns_list, flags, text),
+                             (patterns_list, text[:80]))
+
+    def assert_binary_candidates(self, patterns_list, flags, texts):
+        """Candidates in the escaped bytes include every pattern that
+        matches the text"""
+        pattern_set = patterns.PatternSet(patterns_list, flags, binary=True)
+        for text in texts:
+            candidates = pattern_set.candidates(escape(text))
+            for index in count_each(patterns_list, flags, text):
+                self.assertIn(index, candidates, (patterns_list[index], text[:80]))
+
+    def test_fixture(self):
+        self.assertTrue(self.texts)
+        self.assert_counts(FIXTURE_PATTERNS, 0, self.texts)
+        self.assert_binary_candidates(FIXTURE_PATTERNS, 0, self.texts)
+
+    def test_fixture_ignore_case(self):
+        texts = self.texts + [text.upper() for text in self.texts[:20]]
+        self.assert_counts(FIXTURE_PATTERNS, re.IGNORECASE, texts)
+        self.assert_binary_candidates(FIXTURE_PATTERNS, re.IGNORECASE, texts)
+
+    def test_non_ascii(self):
+        for patterns_list, flags, text in NON_ASCII_CASES:
+            self.assert_counts(patterns_list, flags, [text])
+            self.assert_binary_candidates(patterns_list, flags, [text])
+
+    def test_non_ascii_in_fixture(self):
+        patterns_list = [pattern for case in NON_ASCII_CASES for pattern in case[0]]
+        texts = [text + " " + case[2] for text, case in zip(self.texts, NON_ASCII_CASES)]
+        self.assert_counts(patterns_list, 0, texts)
+        self.assert_counts(patterns_list, re.IGNORECASE, texts)
+
+    def test_fold_case(self):
+        for a, b in (("İ", "i"), ("ı", "I"), ("ſ", "s"), ("K", "k"), ("ς", "Σ")):
+            self.assertEqual(patterns.fold_case(a), patterns.fold_case(b))
+            self.assertTrue(re.fullmatch(re.escape(a), b, re.IGNORECASE))
+        self.assertNotEqual(patterns.fold_case("ß"), patterns.fold_case("s"))
+
+    def test_without_fold_case(self):
+        """Without the private helpers of re, literals are case sensitive
+        and patterns that ignore case are always run"""
+        with mock.patch.object(patterns, "FOLD_CASE", False):
+            texts = self.texts + [text.upper() for text in self.texts[:20]]
+            for flags in (0, re.IGNORECASE):
+                self.assert_counts(FIXTURE_PATTERNS, flags, texts)
+                self.assert_binary_candidates(FIXTURE_PATTERNS, flags, texts)
+            for patterns_list, flags, text in NON_ASCII_CASES:
+                self.assert_counts(patterns_list, flags, [text])
+                self.assert_binary_candidates(patterns_list, flags, [text])
+            pattern_set = patterns.PatternSet(["abc", "(?i)def"])
+            self.assertEqual(pattern_set.unfiltered, [1])
+            self.assertEqual(pattern_set.candidates("xABCx"), {1})
+            self.assertEqual(pattern_set.candidates("xabcx"), {0, 1})
+
+    def test_unfiltered(self):
+        pattern_set = patterns.PatternSet([r"\w+", "abc"])
+        self.assertEqual(pattern_set.unfiltered, [0])
+        self.assertEqual(pattern_set.candidates("xyz"), {0})
+        self.assertEqual(pattern_set.candidates("xABCx"), {0, 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import unittest
+
+from mwdumptools import rawpages
+from mwdumptools.page import Page
+from mwdumptools.page import escape
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+
+def make_header(title, page_id, ns=0):
+    """A raw page header, the way dumps write it"""
+    return (b"<page>\n    <title>" + escape(title) + b"</title>\n"
+            b"    <ns>" + str(ns).encode("ascii") + b"</ns>\n"
+            b"    <id>" + str(page_id).encode("ascii") + b"</id>\n    ")
+
+
+class PageFilterTest(unittest.TestCase):
+
+    def assert_matches(self, page_filter, matching, other):
+        """matching and other are (title, page_id, ns) tuples of headers
+        that must and must not match"""
+        for args in matching:
+            with self.subTest(args=args):
+                self.assertTrue(page_filter.match_header(make_header(*args)))
+        for args in other:
+            with self.subTest(args=args):
+                self.assertFalse(page_filter.match_header(make_header(*args)))
+
+    def test_empty(self):
+        self.assertTrue(rawpages.PageFilter().match_header(b"<page>\n    "))
+
+    def test_title_prefix(self):
+        self.assert_matches(
+            rawpages.PageFilter(title_prefix="File:"),
+            [("File:Example.jpg", 1, 6), ("File:", 2, 6)],
+            [("Example.jpg", 3), ("Template:File:Example", 4, 10), ("file:Example.jpg", 5)])
+        # Compared to the unescaped title
+        self.assert_matches(
+            rawpages.PageFilter(title_prefix='AT&T "<'),
+            [('AT&T "<b>"', 1)],
+            [("AT&amp;T", 2), ("AT&T", 3)])
+
+    def test_title_regex(self):
+        self.assert_matches(
+            rawpages.PageFilter(title_regex=r"\.jpe?g$"),
+            [("File:A.jpg", 1, 6), ("File:B.jpeg", 2, 6)],
+            [("File:C.png", 3, 6), ("File:D.jpg.svg", 4, 6)])
+        self.assert_matches(
+            rawpages.PageFilter(title_regex=r"^Q&A|<i>"),
+            [("Q&A", 1), ("Title <i>x</i>", 2)],
+            [("Q&amp;A", 3), ("Q and A", 4), ("&lt;i&gt;", 5)])
+        # Character references
+        page_filter = rawpages.PageFilter(title_regex="^नेपाल's$")
+        self.assertTrue(page_filter.match_header(
+            b"<page>\n    <title>&#2344;&#x947;&#x92A;&#x93E;&#x932;&#39;s</title>\n"))
+
+    def test_ids(self):
+        self.assert_matches(
+            rawpages.PageFilter(min_id=10, max_id="20"),
+            [("A", 10), ("B", 15), ("C", 20)],
+            [("D", 9), ("E", 21), ("F", 200)])
+        self.assert_matches(rawpages.PageFilter(min_id=10), [("A", 10), ("B", 10 ** 9)],
+                            [("C", 1)])
+        self.assert_matches(rawpages.PageFilter(max_id=10), [("A", 1), ("B", 10)],
+                            [("C", 11)])
+
+    def test_missing_fields(self):
+        for page_filter in (rawpages.PageFilter(title_prefix=""),
+                            rawpages.PageFilter(title_regex="."),
+                            rawpages.PageFilter(min_id=0),
+                            rawpages.PageFilter(namespaces=[0])):
+            with self.subTest(page_filter=vars(page_filter)):
+                self.assertFalse(page_filter.match_header(b"<page>\n    "))
+
+    def test_combined(self):
+        # Templates with ids from 100 to 200 whose titles end in a digit
+        self.assert_matches(
+            rawpages.PageFilter(namespaces=["10"], title_prefix="Template:",
+                                title_regex=r"\d$", min_id=100, max_id=200),
+            [("Template:Box1", 100, 10), ("Template:Box &amp; 2", 200, 10)],
+            [("Template:Box1", 100, 0), ("Template:Box1", 99, 10),
+             ("Template:Box1", 201, 10), ("Template:Box", 150, 10),
+             ("Template talk:Box1", 150, 10)])
+
+    def test_dump(self):
+        """Filtering a dump by its raw headers agrees with the parsed pages"""
+        page_filter = rawpages.PageFilter(
+            namespaces=[0, 10], title_regex="[^a-zA-Z]", min_id=2000, max_id=2200)
+        with open(DUMP_FILE, "rb") as f:
+            pages = [Page.from_bytes(raw) for __, __, raw in rawpages.iter_pages(f)]
+        with open(DUMP_FILE, "rb") as f:
+            matched = [Page.from_bytes(raw).id for __, __, raw in rawpages.iter_pages(
+                f, page_filter=page_filter) if raw is not None]
+        expected = [page.id for page in pages
+                    if page.ns in (0, 10) and re.search("[^a-zA-Z]", page.title)
+                    and 2000 <= page.id <= 2200]
+        self.assertEqual(matched, expected)
+        self.assertTrue(0 < len(matched) < len(pages))
+
+
+if __name__ == "__main__":
+    unittest.main()
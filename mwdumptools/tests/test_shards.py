@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mwdumptools import rawpages
+from mwdumptools import shards
+from mwdumptools.exceptions import ShardError
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+# Cuts the fixture into 6 shards
+SHARD_SIZE = 60000
+
+# Seconds, short enough for leases to expire within a test
+LEASE = 0.3
+
+
+def count_pages(stream, output):
+    """process_shard writing the number of pages of the shard"""
+    with open(output, "w") as f:
+        f.write(str(sum(1 for __ in rawpages.iter_pages(stream))))
+
+
+def sum_counts(paths, merged):
+    total = 0
+    for path in paths:
+        with open(path) as f:
+            total += int(f.read())
+    merged.append(total)
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "jobs.sqlite")
+        self.coordinators = []
+
+    def tearDown(self):
+        for coordinator in self.coordinators:
+            coordinator.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        """A coordinator of its own, like on another machine"""
+        coordinator = shards.Coordinator(self.path)
+        self.coordinators.append(coordinator)
+        return coordinator
+
+    def plan(self, max_attempts=shards.DEFAULT_MAX_ATTEMPTS):
+        coordinator = self.open()
+        header_length, ranges = shards.plan_plain(DUMP_FILE, SHARD_SIZE)
+        coordinator.plan(DUMP_FILE, header_length, ranges, max_attempts)
+        return coordinator
+
+    def test_plan(self):
+        coordinator = self.plan()
+        self.assertEqual(coordinator.counts()[shards.STATUS_PENDING], 6)
+        pages = []
+        for __ in range(6):
+            shard = coordinator.claim("a", LEASE)
+            stream = coordinator.open_shard(shard)
+            pages.extend(raw for __, __, raw in rawpages.iter_pages(stream))
+            stream.close()
+            self.assertTrue(coordinator.complete(shard, "a"))
+        with open(DUMP_FILE, "rb") as f:
+            self.assertEqual(pages, [raw for __, __, raw in rawpages.iter_pages(f)])
+        self.assertIsNone(coordinator.claim("a", LEASE))
+
+    def test_lease_expires(self):
+        coordinator = self.plan()
+        other = self.open()
+        shard = coordinator.claim("a", LEASE)
+        # Leased shards are not issued twice
+        self.assertNotEqual(other.claim("b", LEASE).id, shard.id)
+        time.sleep(LEASE * 1.5)
+        reclaimed = other.claim("c", 60)
+        self.assertEqual(reclaimed.id, shard.id)
+        # The stale worker has lost the shard
+        self.assertFalse(coordinator.renew(shard, "a", LEASE))
+        self.assertFalse(coordinator.release(shard, "a"))
+
+    def test_stale_complete(self):
+        coordinator = self.plan()
+        other = self.open()
+        shard = coordinator.claim("a", LEASE)
+        output = coordinator.output_path(shard.id)
+        part_a = coordinator.part_path(shard.id, "a")
+        part_c = coordinator.part_path(shard.id, "c")
+        self.assertNotEqual(part_a, part_c)
+        time.sleep(LEASE * 1.5)
+        other.claim("c", 60)
+        with open(part_c, "w") as f:
+            f.write("c")
+        self.assertTrue(other.complete(shard, "c", part_c, output))
+        with open(part_a, "w") as f:
+            f.write("a")
+        # Too late, the output of c stays
+        self.assertFalse(coordinator.complete(shard, "a", part_a, output))
+        with open(output) as f:
+            self.assertEqual(f.read(), "c")
+        self.assertTrue(os.path.exists(part_a))
+
+    def test_max_attempts(self):
+        coordinator = self.plan(max_attempts=2)
+        for __ in range(2):
+            shard = coordinator.claim("a", LEASE)
+            self.assertEqual(shard.id, 1)
+            self.assertTrue(coordinator.release(shard, "a"))
+        # Issued twice already, the next shard comes instead
+        self.assertEqual(coordinator.claim("a", LEASE).id, 2)
+        counts = coordinator.counts()
+        self.assertEqual(counts[shards.STATUS_FAILED], 1)
+        self.assertEqual(list(coordinator.iter_failed()), [(1, "a", 2)])
+        # Expired leases count as attempts too
+        time.sleep(LEASE * 1.5)
+        self.assertEqual(coordinator.claim("b", LEASE).id, 2)
+        time.sleep(LEASE * 1.5)
+        self.assertEqual(coordinator.claim("b", LEASE).id, 3)
+        self.assertEqual(coordinator.counts()[shards.STATUS_FAILED], 2)
+        self.assertEqual(coordinator.retry(), 2)
+        self.assertEqual(coordinator.counts()[shards.STATUS_FAILED], 0)
+        self.assertEqual(coordinator.claim("b", LEASE).id, 1)
+
+    def test_merge_lease(self):
+        coordinator = self.plan()
+        other = self.open()
+        self.assertFalse(coordinator.claim_merge("a", LEASE))
+        while True:
+            shard = coordinator.claim("a", 60)
+            if shard is None:
+                break
+            coordinator.complete(shard, "a")
+        self.assertTrue(coordinator.claim_merge("a", LEASE))
+        self.assertFalse(other.claim_merge("b", LEASE))
+        self.assertFalse(coordinator.is_merged())
+        # a dies while merging
+        time.sleep(LEASE * 1.5)
+        self.assertTrue(other.claim_merge("b", LEASE))
+        self.assertFalse(coordinator.complete_merge("a"))
+        self.assertTrue(other.complete_merge("b"))
+        self.assertTrue(coordinator.is_merged())
+        self.assertFalse(coordinator.claim_merge("a", LEASE))
+
+    def test_workers(self):
+        self.plan()
+        merged = []
+        results = {}
+
+        def work(worker):
+            results[worker] = shards.run_worker(
+                self.open(), count_pages, lambda paths: sum_counts(paths, merged),
+                worker, LEASE)
+
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in "abc"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Merged once, by one of them
+        self.assertEqual(merged, [75])
+        self.assertEqual(sorted(results.values()), [False, False, True])
+        self.assertEqual(sorted(os.listdir(self.open().directory)),
+                         ["shard-{:05d}".format(n) for n in range(1, 7)])
+
+    def test_worker_fails(self):
+        self.plan(max_attempts=2)
+        calls = []
+
+        def fail_second(stream, output):
+            calls.append(output)
+            if os.path.basename(output).startswith("shard-00002."):
+                raise ValueError("Broken shard")
+            count_pages(stream, output)
+
+        coordinator = self.open()
+        with self.assertRaises(ShardError):
+            shards.run_worker(coordinator, fail_second, self.fail, "a", LEASE)
+        self.assertEqual(list(coordinator.iter_failed()), [(2, "a", 2)])
+        self.assertEqual(len(calls), 7)
+        self.assertFalse(coordinator.is_merged())
+        # Fixed and issued again
+        coordinator.retry()
+        merged = []
+        self.assertTrue(shards.run_worker(
+            coordinator, count_pages, lambda paths: sum_counts(paths, merged), "a", LEASE))
+        self.assertEqual(merged, [75])
+
+    def test_lost_lease_discards_output(self):
+        self.plan()
+        other = self.open()
+        merged = []
+
+        def taken_over(stream, output):
+            if os.path.basename(output).startswith("shard-00001."):
+                # The lease of a expires while it works, b takes the shard
+                # over and is done first
+                with other.transaction() as connection:
+                    connection.execute(
+                        "UPDATE shards SET lease_expires = 0 WHERE id = 1")
+                shard = other.claim("b", 60)
+                part = other.part_path(shard.id, "b")
+                with open(part, "w") as f:
+                    f.write("75")
+                other.complete(shard, "b", part, other.output_path(shard.id))
+            count_pages(stream, output)
+
+        coordinator = self.open()
+        self.assertTrue(shards.run_worker(
+            coordinator, taken_over, lambda paths: sum_counts(paths, merged), "a", LEASE))
+        with open(coordinator.output_path(1)) as f:
+            self.assertEqual(f.read(), "75")
+        self.assertEqual(sorted(os.listdir(coordinator.directory)),
+                         ["shard-{:05d}".format(n) for n in range(1, 7)])
+
+if __name__ == "__main__":
+    unittest.main()
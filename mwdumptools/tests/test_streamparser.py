@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+import bz2
+import collections
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from mwdumptools import metrics
+from mwdumptools import rawpages
+from mwdumptools import streamparser
+from mwdumptools import syntheticdump
+from mwdumptools import workers
+from mwdumptools.page import Page
+
+DUMP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                         "ngwiki-20130702-pages-articles-multistream.xml")
+
+PAGES = 75
+
+# Pages per bz2 stream of the multistream copy of the dump
+PAGES_PER_STREAM = 10
+
+# Pages handled before the first run is interrupted
+INTERRUPT_AFTER = 30
+
+
+class TitleParser(streamparser.XmlStreamParser):
+
+    """Collects the titles of the pages it handles, at module level so worker
+    processes find it"""
+
+    def __init__(self, **kwargs):
+        streamparser.XmlStreamParser.__init__(self, **kwargs)
+        self.handled = []
+        # Raise Interrupted instead of handling more pages than this
+        self.crash_after = None
+
+    def process_page(self, page):
+        metrics.incr("titles_found")
+        return page.title
+
+    def handle_result(self, result):
+        self.handled.append(result)
+
+    def handle_page(self, page):
+        if self.crash_after is not None and len(self.handled) >= self.crash_after:
+            raise Interrupted(page.title)
+        self.handled.append(page.title)
+
+
+class RevisionParser(streamparser.XmlStreamParser):
+
+    """Records the calls of the revisions engine, and what the other engines
+    pass to handle_page in the same form"""
+
+    def __init__(self, **kwargs):
+        streamparser.XmlStreamParser.__init__(self, **kwargs)
+        self.calls = []
+
+    def handle_page(self, page):
+        self.handle_page_start(page)
+        for revision in page.revisions:
+            self.handle_revision(page, revision)
+        self.handle_page_end(page)
+
+    def handle_page_start(self, page):
+        self.calls.append(("start", page.id, page.ns, page.title))
+
+    def handle_revision(self, page, revision):
+        self.calls.append(("revision", page.id, revision.id, revision.parentid,
+                           revision.text))
+
+    def handle_page_end(self, page):
+        self.calls.append(("end", page.id))
+
+
+# Full history of a page: revisions with entities, a deleted and an empty
+# text, and an <upload> between them
+HISTORY_PAGES = b"""  <page>
+    <title>History &amp; more</title>
+    <ns>0</ns>
+    <id>7</id>
+    <revision>
+      <id>71</id>
+      <timestamp>2013-01-01T00:00:00Z</timestamp>
+      <contributor>
+        <username>Someone</username>
+        <id>5</id>
+      </contributor>
+      <text xml:space="preserve">First &lt;b&gt;text&lt;/b&gt;</text>
+      <sha1>a</sha1>
+    </revision>
+    <upload>
+      <timestamp>2013-01-02T00:00:00Z</timestamp>
+      <filename>Example.jpg</filename>
+    </upload>
+    <revision>
+      <id>72</id>
+      <parentid>71</parentid>
+      <text deleted="deleted" />
+    </revision>
+    <revision>
+      <id>73</id>
+      <parentid>72</parentid>
+      <text xml:space="preserve" />
+    </revision>
+  </page>
+  <page>
+    <title>Template:Other</title>
+    <ns>10</ns>
+    <id>8</id>
+    <revision>
+      <id>81</id>
+      <text xml:space="preserve">Only</text>
+    </revision>
+  </page>
+"""
+
+HISTORY_CALLS = [
+    ("start", 7, 0, "History & more"),
+    ("revision", 7, 71, None, "First <b>text</b>"),
+    ("revision", 7, 72, 71, None),
+    ("revision", 7, 73, 72, ""),
+    ("end", 7),
+    ("start", 8, 10, "Template:Other"),
+    ("revision", 8, 81, None, "Only"),
+    ("end", 8),
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def parse(in_file=DUMP_FILE, crash_after=None, **kwargs):
+    with TitleParser(in_file=in_file, **kwargs) as p:
+        p.crash_after = crash_after
+        p.execute()
+    return p
+
+
+def write_multistream(path, index_path):
+    """Compress the dump to path as a bz2 stream of the header and streams
+    of PAGES_PER_STREAM pages, and write its index"""
+    with open(DUMP_FILE, "rb") as f:
+        dump = f.read()
+    with open(DUMP_FILE, "rb") as f:
+        pages = [(start, Page.from_bytes(raw)) for start, __, raw in rawpages.iter_pages(f)]
+    cuts = [0] + [start for start, __ in pages[::PAGES_PER_STREAM]] + [len(dump)]
+    with open(path, "wb") as f, open(index_path, "w", encoding="utf-8") as index:
+        for n, (start, end) in enumerate(zip(cuts, cuts[1:])):
+            offset = f.tell()
+            f.write(bz2.compress(dump[start:end]))
+            if n:
+                for __, page in pages[(n - 1) * PAGES_PER_STREAM:n * PAGES_PER_STREAM]:
+                    index.write("{:d}:{:d}:{}\n".format(offset, page.id, page.title))
+
+
+class PipelineTest(unittest.TestCase):
+
+    """The pipeline hands the same pages to handle_result as the serial
+    engines to handle_page"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serial = parse().handled
+
+    def test_serial(self):
+        self.assertEqual(len(self.serial), PAGES)
+        self.assertEqual(parse(engine=streamparser.ENGINE_PULL).handled, self.serial)
+
+    def test_ordered(self):
+        p = parse(pipeline=True, parse_processes=2, batch_size=7)
+        self.assertEqual(p.handled, self.serial)
+        self.assertEqual(p.pages_processed, PAGES)
+
+    def test_unordered(self):
+        p = parse(pipeline=True, unordered=True, parse_processes=2, batch_size=7)
+        self.assertEqual(collections.Counter(p.handled), collections.Counter(self.serial))
+        self.assertEqual(p.pages_processed, PAGES)
+
+
+class RevisionsEngineTest(unittest.TestCase):
+
+    def parse_history(self, **kwargs):
+        dump = syntheticdump.HEADER + HISTORY_PAGES + syntheticdump.FOOTER
+        p = RevisionParser(in_file=io.BytesIO(dump), engine=streamparser.ENGINE_REVISIONS,
+                           **kwargs)
+        p.execute()
+        return p
+
+    def test_calls(self):
+        p = self.parse_history()
+        self.assertEqual(p.calls, HISTORY_CALLS)
+        self.assertEqual(p.pages_processed, 2)
+        self.assertEqual(p.revisions_processed, 4)
+
+    def test_page_filter(self):
+        p = self.parse_history(page_filter=rawpages.PageFilter(namespaces=[10]))
+        self.assertEqual(p.calls, HISTORY_CALLS[5:])
+        self.assertEqual(p.pages_skipped, 1)
+
+    def test_parts(self):
+        # Tags split across chunks
+        for chunk_size in (1, 7, rawpages.CHUNK_SIZE):
+            with self.subTest(chunk_size=chunk_size):
+                parts = list(rawpages.iter_page_parts(
+                    io.BytesIO(HISTORY_PAGES), 100, chunk_size=chunk_size))
+                self.assertEqual([part for part, __, __ in parts], [
+                    rawpages.PART_HEADER, rawpages.PART_REVISION, rawpages.PART_REVISION,
+                    rawpages.PART_REVISION, rawpages.PART_END,
+                    rawpages.PART_HEADER, rawpages.PART_REVISION, rawpages.PART_END])
+                for part, end, raw in parts:
+                    if raw is not None:
+                        self.assertEqual(HISTORY_PAGES[end - 100 - len(raw):end - 100], raw)
+                self.assertEqual(parts[-1][1], 100 + HISTORY_PAGES.rindex(b"</page>") + 7)
+
+    def test_same_pages(self):
+        p = RevisionParser(in_file=DUMP_FILE, engine=streamparser.ENGINE_PULL)
+        p.execute()
+        self.assertEqual(sum(1 for call in p.calls if call[0] == "start"), PAGES)
+        revisions = RevisionParser(in_file=DUMP_FILE, engine=streamparser.ENGINE_REVISIONS)
+        revisions.execute()
+        self.assertEqual(revisions.calls, p.calls)
+        self.assertEqual(revisions.pages_processed, PAGES)
+
+
+class CloseTest(unittest.TestCase):
+
+    """execute() closes the input, also when handling a page raises"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.compressed = os.path.join(cls.directory, "dump.xml.bz2")
+        write_multistream(cls.compressed, os.path.join(cls.directory, "index.txt"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assert_closed(self, p):
+        self.assertTrue(p._in_stream.closed)
+        # The file opened from in_file and the parallel bz2 reader
+        self.assertTrue(all(stream.closed for stream in p._input_streams))
+        self.assertIsNone(p._in_stream.raw.executor)
+
+    def test_execute(self):
+        p = TitleParser(in_file=self.compressed, decompress_processes=2)
+        p.execute()
+        self.assertEqual(len(p.handled), PAGES)
+        self.assert_closed(p)
+
+    def test_error(self):
+        p = TitleParser(in_file=self.compressed, decompress_processes=2)
+        p.crash_after = INTERRUPT_AFTER
+        with self.assertRaises(Interrupted):
+            p.execute()
+        self.assert_closed(p)
+
+    def test_context_manager(self):
+        with TitleParser(in_file=self.compressed, decompress_processes=2) as p:
+            pass
+        self.assert_closed(p)
+
+    def test_worker(self):
+        main = TitleParser(in_file=self.compressed, decompress_processes=2)
+        main.parse_header()
+        main.close()
+        with mock.patch.object(streamparser, "open", create=True, wraps=open) as opened:
+            workers.init_pipeline_parser(TitleParser, main.get_worker_kwargs(), main.header)
+        # Only reads the header it is given, but keeps the path of the dump
+        self.assertEqual(opened.call_count, 0)
+        self.assertEqual(workers._parser.in_file, self.compressed)
+        self.assertEqual(workers._parser.header, main.header)
+        workers._parser = None
+
+    def test_stdin(self):
+        with mock.patch.object(sys, "stdin", mock.Mock(buffer=io.BytesIO(b""))):
+            p = TitleParser()
+            p.close()
+            self.assertFalse(sys.stdin.buffer.closed)
+
+
+class CheckpointTest(unittest.TestCase):
+
+    """A run interrupted after some pages and resumed from its checkpoint
+    handles every page once"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.multistream = os.path.join(cls.directory, "dump.xml.bz2")
+        write_multistream(cls.multistream, os.path.join(cls.directory, "index.txt"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.checkpoint = os.path.join(self.directory, "checkpoint.json")
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def assert_resumes(self, in_file, **kwargs):
+        expected = parse(**kwargs).handled
+        # Checkpoints after every page, so none is handled twice
+        kwargs.update(checkpoint=self.checkpoint, checkpoint_interval=1)
+        with self.assertRaises(Interrupted):
+            parse(in_file, crash_after=INTERRUPT_AFTER, **kwargs)
+        self.assertTrue(os.path.exists(self.checkpoint))
+        p = parse(in_file, **kwargs)
+        self.assertEqual(expected[:INTERRUPT_AFTER] + p.handled, expected)
+        self.assertEqual(p.pages_processed, len(expected))
+        self.assertEqual(p.pages_processed + p.pages_skipped, PAGES)
+
+    def assert_engines_resume(self, in_file, **kwargs):
+        filtered = rawpages.PageFilter(namespaces=["0", "10"])
+        for engine, page_filter in ((streamparser.ENGINE_LINES, None),
+                                    (streamparser.ENGINE_LINES, filtered),
+                                    (streamparser.ENGINE_PULL, filtered)):
+            with self.subTest(engine=engine, page_filter=page_filter is not None):
+                self.assert_resumes(in_file, engine=engine, page_filter=page_filter,
+                                    **kwargs)
+                os.remove(self.checkpoint)
+
+    def test_seek(self):
+        self.assert_engines_resume(DUMP_FILE)
+
+    def test_multistream(self):
+        # Not seekable, the offset of the checkpoint is in the decompressed
+        # data and read forward to
+        self.assert_engines_resume(self.multistream, decompress_processes=2)
+
+
+class WorkerMetricsTest(unittest.TestCase):
+
+    """Metrics recorded in worker processes are exported by the main
+    process"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.multistream = os.path.join(cls.directory, "dump.xml.bz2")
+        cls.index = os.path.join(cls.directory, "index.txt")
+        write_multistream(cls.multistream, cls.index)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assert_exported(self, in_file, **kwargs):
+        path = os.path.join(self.directory, "metrics.json")
+        p = parse(in_file, parse_processes=2, metrics=path, **kwargs)
+        with open(path) as f:
+            data = json.loads(f.readlines()[-1])
+        os.remove(path)
+        self.assertEqual(len(p.handled), PAGES)
+        self.assertEqual(data["counters"]["titles_found"], PAGES)
+        self.assertEqual(data["timers"]["process_page"]["count"], PAGES)
+        self.assertEqual(data["timers"]["handle_results"]["count"],
+                         -(-PAGES // PAGES_PER_STREAM))
+
+    def test_pipeline(self):
+        self.assert_exported(DUMP_FILE, pipeline=True, batch_size=PAGES_PER_STREAM)
+
+    def test_multistream(self):
+        self.assert_exported(self.multistream, index=self.index)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+from PIL import features
+
+from mwdumptools import thumbnails
+
+
+def make_image(size, img_format, mode="RGB"):
+    img = Image.new(mode, size, (40, 120, 200, 128)[:len(mode)])
+    output = io.BytesIO()
+    img.save(output, format=img_format)
+    return output.getvalue()
+
+
+class ThumbnailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_thumbnails(self, data, sizes, **kwargs):
+        """make_thumbnails of a spec like --sizes, returns its result and
+        the number of times an image was decoded"""
+        thumbs = []
+        for n, (size, img_format) in enumerate(thumbnails.parse_sizes(sizes)):
+            path = os.path.join(self.directory, "{:d}-{}".format(n, img_format))
+            thumbs.append((path, size, img_format))
+        with mock.patch.object(Image, "_getdecoder", wraps=Image._getdecoder) as decoder:
+            result = thumbnails.make_thumbnails(data, thumbs, **kwargs)
+        return thumbs, result, decoder.call_count
+
+    def assert_written(self, thumbs, sizes, img_format=None):
+        for (path, __, thumb_format), size in zip(thumbs, sizes):
+            with Image.open(path) as img:
+                self.assertEqual(img.size, size)
+                self.assertEqual(img.format, thumb_format or img_format)
+
+    def test_sizes(self):
+        data = make_image((1600, 1200), "JPEG")
+        thumbs, (original_size, sizes), decodes = self.make_thumbnails(
+            data, "800x800,320x320,100x50,3200x3200")
+        self.assertEqual(decodes, 1)
+        self.assertEqual(original_size, (1600, 1200))
+        # Never larger than the original
+        self.assertEqual(sizes, [(800, 600), (320, 240), (67, 50), (1600, 1200)])
+        self.assert_written(thumbs, sizes, "JPEG")
+
+    def test_draft(self):
+        data = make_image((1600, 1200), "JPEG")
+        opened = []
+        image_open = Image.open
+
+        def record_open(fp):
+            opened.append(image_open(fp))
+            return opened[-1]
+
+        with mock.patch.object(thumbnails.Image, "open", record_open):
+            __, (__, sizes), __ = self.make_thumbnails(data, "200x200,100x100")
+        self.assertEqual(sizes, [(200, 150), (100, 75)])
+        # Decoded at 1/4, still twice the largest thumbnail
+        self.assertEqual(opened[0].size, (400, 300))
+
+    def test_formats(self):
+        data = make_image((600, 400), "PNG", mode="RGBA")
+        spec = "300x300,200x200:jpg,100x100:gif"
+        if features.check("webp"):
+            spec += ",50x50:webp"
+        thumbs, (__, sizes), decodes = self.make_thumbnails(data, spec)
+        self.assertEqual(decodes, 1)
+        self.assertEqual(sizes[:3], [(300, 200), (200, 133), (100, 67)])
+        self.assert_written(thumbs, sizes, "PNG")
+        with Image.open(thumbs[1][0]) as img:
+            self.assertEqual(img.mode, "RGB")
+
+    @unittest.skipUnless(features.check("webp"), "Pillow is built without WebP")
+    def test_webp(self):
+        data = make_image((600, 400), "JPEG")
+        thumbs, (__, sizes), __ = self.make_thumbnails(data, "600x600:webp,120x120:webp")
+        self.assertEqual(sizes, [(600, 400), (120, 80)])
+        self.assert_written(thumbs, sizes)
+
+    def test_max_pixels(self):
+        data = make_image((1600, 1200), "PNG")
+        with mock.patch.object(Image, "_getdecoder", wraps=Image._getdecoder) as decoder:
+            with self.assertRaises(ValueError):
+                thumbnails.make_thumbnails(
+                    data, [(os.path.join(self.directory, "thumb.png"), (100, 100), None)],
+                    max_pixels=1600 * 1200 - 1)
+        self.assertEqual(decoder.call_count, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_parse_sizes(self):
+        self.assertEqual(thumbnails.parse_sizes("1024x1024, 320x240:webp,64x64:JPG"), [
+            ((1024, 1024), None), ((320, 240), "WEBP"), ((64, 64), "JPEG")])
+        for spec in ("1024", "320x320:tiff", "x100"):
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    thumbnails.parse_sizes(spec)
+        self.assertEqual(thumbnails.thumbnail_filename("Example.jpg", (320, 320)),
+                         "320px-Example.jpg")
+        self.assertEqual(thumbnails.thumbnail_filename("Example.jpg", (320, 320), "WEBP"),
+                         "320px-Example.jpg.webp")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling a downloaded image to several thumbnail sizes with a single decode.
+
+Decoding is the expensive part of scaling. JPEGs are decoded at a reduced
+resolution (draft mode: the decoder skips DCT coefficients and returns the
+image at 1/2, 1/4 or 1/8 of its size), at the smallest scale that is still
+REDUCING_GAP times the largest thumbnail. Every thumbnail is then resized from
+that one decoded image, other formats with reduce() first, which averages
+blocks of pixels before the final resampling. This is what Image.thumbnail()
+does for a single size.
+
+Images whose header announces more than max_pixels pixels are rejected
+before anything is decoded.
+
+A size is written as WIDTHxHEIGHT[:FORMAT], e.g. 1024x1024 or 320x320:webp.
+Thumbnails fit in WIDTHxHEIGHT, keep their aspect ratio and are never larger
+than the original. Without a format, the format of the original is kept.
+"""
+import io
+import os
+import re
+
+from PIL import Image
+
+# Decode and reduce to at least this many times the thumbnail size before
+# resampling with Lanczos, as Image.thumbnail() does
+REDUCING_GAP = 2.0
+
+# Larger images are rejected, Pillow itself raises at twice its own limit
+MAX_PIXELS = Image.MAX_IMAGE_PIXELS
+
+SIZE_PATTERN = re.compile(r"^(\d+)x(\d+)(?::(\w+))?$")
+
+# Format -> file name extension of thumbnails converted to it
+EXTENSIONS = {
+    "JPEG": "jpg",
+    "PNG": "png",
+    "GIF": "gif",
+    "WEBP": "webp",
+}
+
+# Options for Image.save() per format
+SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+# Modes each format can save, others are converted to the first
+SAVE_MODES = {
+    "JPEG": ("RGB", "L", "CMYK"),
+    "WEBP": ("RGB", "RGBA"),
+}
+
+
+def parse_sizes(spec):
+    """"1024x1024,320x320:webp" -> [((1024, 1024), None), ((320, 320), "WEBP")]"""
+    sizes = []
+    for part in spec.split(","):
+        match = SIZE_PATTERN.match(part.strip())
+        if match is None:
+            raise ValueError("Invalid thumbnail size {!r}, expected WIDTHxHEIGHT[:FORMAT]".format(part))
+        img_format = match.group(3)
+        if img_format is not None:
+            img_format = img_format.upper()
+            if img_format == "JPG":
+                img_format = "JPEG"
+            if img_format not in EXTENSIONS:
+                raise ValueError("Unknown thumbnail format {!r}, expected one of {}".format(
+                    match.group(3), ", ".join(sorted(EXTENSIONS)).lower()))
+        sizes.append(((int(match.group(1)), int(match.group(2))), img_format))
+    return sizes
+
+
+def thumbnail_filename(fname, size, img_format=None):
+    """File name of a thumbnail, as in the thumb/ directory of MediaWiki,
+    e.g. 320px-Example.jpg or 320px-Example.jpg.webp"""
+    name = "{:d}px-{}".format(size[0], fname)
+    if img_format is not None:
+        name += "." + EXTENSIONS[img_format]
+    return name
+
+
+def fit_size(size, box):
+    """The largest size with the aspect ratio of size that fits in box,
+    never larger than size"""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1.0)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def has_alpha(img):
+    return "A" in img.mode or "transparency" in img.info
+
+
+def save_image(img, img_format, path):
+    modes = SAVE_MODES.get(img_format)
+    if modes and img.mode not in modes:
+        if "RGBA" in modes and has_alpha(img):
+            img = img.convert("RGBA")
+        else:
+            img = img.convert(modes[0])
+    output = io.BytesIO()
+    img.save(output, format=img_format, **SAVE_OPTIONS.get(img_format, {}))
+    save_file(output.getvalue(), path)
+
+
+def save_file(data, path):
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+    # Written to a temporary name, so an interrupted write never looks like a
+    # finished file
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    os.replace(path + ".part", path)
+
+
+def make_thumbnails(data, thumbnails, max_pixels=MAX_PIXELS):
+    """Decode image data once and write every thumbnail, a list of (path,
+    (width, height), format or None). Returns the size of the original and
+    the sizes of the thumbnails."""
+    img = Image.open(io.BytesIO(data))
+    original_size = img.size
+    if original_size[0] * original_size[1] > max_pixels:
+        raise ValueError("Image of {:d}x{:d} pixels is larger than {:d} pixels".format(
+            original_size[0], original_size[1], max_pixels))
+    original_format = img.format
+    targets = [fit_size(original_size, box) for __, box, __ in thumbnails]
+    largest = max(targets)
+    img.draft(None, (int(largest[0] * REDUCING_GAP), int(largest[1] * REDUCING_GAP)))
+    img.load()
+    if img.mode == "P" and any(target != img.size for target in targets):
+        # Palette images can only be resized with nearest neighbour
+        img = img.convert("RGBA" if has_alpha(img) else "RGB")
+    sizes = []
+    for (path, __, img_format), target in zip(thumbnails, targets):
+        if target == img.size:
+            thumb = img
+        else:
+            thumb = img.resize(target, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+        save_image(thumb, img_format or original_format, path)
+        sizes.append(thumb.size)
+    return original_size, sizes
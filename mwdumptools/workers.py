@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Functions running inside worker processes.
+
+Parsers are not picklable (they hold open streams, locks and executors), so
+instead every worker process constructs its own parser instance once, in the
+pool initializer, and the tasks submitted to the pool only carry small
+arguments such as byte offsets or the raw bytes of pages.
+
+Metrics recorded by a worker are returned with the results of each task and
+merged by the main process, which exports them.
+"""
+import io
+from multiprocessing.util import Finalize
+
+from . import metrics
+from . import multistream
+from . import rawpages
+from .page import Page
+
+# The parser instance of this worker process
+_parser = None
+
+
+def _init_parser(parser_class, kwargs, header, record_metrics):
+    global _parser
+    if record_metrics:
+        metrics.enable()
+    # Read siteinfo from the header, so it is available to process_page,
+    # without opening the dump again
+    in_file = kwargs.pop("in_file", None)
+    _parser = parser_class(in_file=io.BytesIO(header), **kwargs)
+    _parser.in_file = in_file
+    _parser.parse_header()
+    # Run when the worker process exits after the pool has been shut down
+    Finalize(_parser, _parser.finish, exitpriority=10)
+
+
+def init_multistream_parser(parser_class, kwargs, dump_file, header_length,
+                            record_metrics=False):
+    """Pool initializer: Creates the parser of this process and feeds it the
+    header stream of the dump"""
+    _init_parser(parser_class, kwargs,
+                 multistream.read_stream(dump_file, 0, header_length),
+                 record_metrics)
+
+
+def init_pipeline_parser(parser_class, kwargs, header, record_metrics=False):
+    """Pool initializer: Creates the parser of this process and feeds it the
+    raw header lines read by the main process"""
+    _init_parser(parser_class, kwargs, header, record_metrics)
+
+
+def _process_pages(raw_pages):
+    results = []
+    for raw in raw_pages:
+        with metrics.timer("process_page"):
+            result = _parser.process_page(Page.from_bytes(raw))
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def process_raw_pages(raw_pages):
+    """Run process_page on a batch of raw <page> nodes, returns the results
+    that are not None and the metrics recorded meanwhile"""
+    results = _process_pages(raw_pages)
+    return results, metrics.take()
+
+
+def parse_multistream_chunk(dump_file, offset, length):
+    """Process all pages of the stream at offset, returns the number of pages
+    processed and skipped, the results, the page state keys of the pages
+    processed and the metrics recorded meanwhile, which the main process
+    records"""
+    data = multistream.read_stream(dump_file, offset, length)
+    raw_pages = []
+    skipped = 0
+    for start, end, raw in rawpages.iter_pages(
+            io.BytesIO(data), page_filter=_parser.page_filter):
+        if raw is None or not _parser.check_page(raw):
+            skipped += 1
+        else:
+            raw_pages.append(raw)
+    results = _process_pages(raw_pages)
+    keys = list(_parser.page_keys)
+    _parser.page_keys.clear()
+    return len(raw_pages), skipped, results, keys, metrics.take()